@@ -3,6 +3,8 @@ from django.db.models import QuerySet
 
 from .models import (
     Item,
+    CanalOutboxEntry,
+    CanalWebhookEvent,
     Fulfillment,
     OrderItem,
     Order,
@@ -75,6 +77,32 @@ class AddressAdmin(admin.ModelAdmin):
     search_fields = ["user", "street_address", "apartment_address", "zip"]
 
 
+class CanalOutboxEntryAdmin(admin.ModelAdmin):
+    list_display = [
+        "topic",
+        "object_id",
+        "status",
+        "attempts",
+        "available_at",
+        "created_at",
+    ]
+    list_filter = ["status", "topic"]
+    search_fields = ["object_id", "canal_id"]
+
+
+class CanalWebhookEventAdmin(admin.ModelAdmin):
+    list_display = [
+        "topic",
+        "canal_object_id",
+        "status",
+        "attempts",
+        "available_at",
+        "created_at",
+    ]
+    list_filter = ["status", "topic"]
+    search_fields = ["canal_object_id", "event_key"]
+
+
 admin.site.register(Item)
 admin.site.register(OrderItem)
 admin.site.register(Order, OrderAdmin)
@@ -84,3 +112,5 @@ admin.site.register(Refund)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(UserProfile)
 admin.site.register(Fulfillment)
+admin.site.register(CanalOutboxEntry, CanalOutboxEntryAdmin)
+admin.site.register(CanalWebhookEvent, CanalWebhookEventAdmin)
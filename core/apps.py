@@ -1,10 +1,11 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_migrate, post_save, post_delete
 
 from core.signals import (
     item_post_save_receiver,
     item_post_delete_receiver,
     order_post_save_receiver,
+    order_post_delete_receiver,
 )
 
 
@@ -17,3 +18,13 @@ class CoreConfig(AppConfig):
         post_save.connect(item_post_save_receiver, sender="core.Item")
         post_save.connect(order_post_save_receiver, sender="core.Order")
         post_delete.connect(item_post_delete_receiver, sender="core.Item")
+        post_delete.connect(order_post_delete_receiver, sender="core.Order")
+
+        from core.search import ensure_search_triggers
+
+        post_migrate.connect(ensure_search_triggers, sender=self)
+
+        # Compile the Canal serializers up front
+        for model in self.get_models():
+            if hasattr(model, "internal_to_canal_mapping"):
+                model.get_canal_accessors()
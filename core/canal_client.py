@@ -0,0 +1,183 @@
+import threading
+import time
+from functools import partial
+from typing import Any, Dict, Optional
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential
+from urllib3.exceptions import NewConnectionError
+
+from core.constants import SHOPCANAL_DEFAULT_HEADERS
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Methods Canal applies once however many times they are sent
+IDEMPOTENT_METHODS = {"GET", "PUT", "DELETE"}
+
+
+class CanalAPIError(requests.HTTPError):
+    pass
+
+
+def is_unsent(e: BaseException) -> bool:
+    """
+    Whether the request failed before it reached Canal.
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(e, requests.ConnectionError) and isinstance(
+        reason, NewConnectionError
+    )
+
+
+def is_retryable(e: BaseException, method: str = "GET") -> bool:
+    """
+    Whether a failed call can be sent again. A POST that timed out or got a
+    5xx may have been applied, so it is only retried when it never reached
+    Canal or was rate limited.
+    """
+    if isinstance(e, CanalAPIError):
+        if e.response is None:
+            return False
+        if method not in IDEMPOTENT_METHODS:
+            return e.response.status_code == 429
+        return e.response.status_code in RETRYABLE_STATUS_CODES
+    if method not in IDEMPOTENT_METHODS:
+        return is_unsent(e)
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+
+class CanalClient:
+    """
+    Client for the Canal platform API. All calls share one pooled keep-alive
+    session, are retried on connection errors and 5xx responses (see
+    is_retryable for POSTs), and have their latency recorded per endpoint.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        pool_size: int = 10,
+        timeout: float = 10.0,
+        max_retries: int = 3,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers.update(SHOPCANAL_DEFAULT_HEADERS)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._stats_lock = threading.Lock()
+
+    def request(
+        self,
+        method: str,
+        resource: str,
+        resource_id: Optional[str] = None,
+        json: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        retrying = Retrying(
+            stop=stop_after_attempt(self.max_retries),
+            wait=wait_exponential(multiplier=0.5, max=4),
+            retry=retry_if_exception(partial(is_retryable, method=method)),
+            reraise=True,
+        )
+        return retrying(self._send, method, resource, resource_id, json)
+
+    def _send(
+        self,
+        method: str,
+        resource: str,
+        resource_id: Optional[str],
+        json: Optional[Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        if resource_id is None:
+            url = f"{self.base_url}/{resource}/"
+            endpoint = f"{method} /{resource}/"
+        else:
+            url = f"{self.base_url}/{resource}/{resource_id}/"
+            endpoint = f"{method} /{resource}/{{id}}/"
+        started = time.monotonic()
+        failed = True
+        try:
+            response = self.session.request(
+                method, url, json=json, timeout=self.timeout
+            )
+            if response.status_code >= 400:
+                raise CanalAPIError(
+                    f"{response.status_code} for {method} {url}: {response.text}",
+                    response=response,
+                )
+            failed = False
+        finally:
+            self._record(endpoint, time.monotonic() - started, failed)
+        return response.json() if response.content else {}
+
+    def _record(self, endpoint: str, seconds: float, failed: bool) -> None:
+        with self._stats_lock:
+            stats = self._stats.setdefault(
+                endpoint, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0}
+            )
+            stats["count"] += 1
+            stats["errors"] += failed
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns a snapshot of call counts and latencies (in seconds) keyed by
+        endpoint, e.g. ``"PUT /products/{id}/"``.
+        """
+        with self._stats_lock:
+            return {
+                endpoint: dict(stats, avg=stats["total"] / stats["count"])
+                for endpoint, stats in self._stats.items()
+            }
+
+    def create_product(self, product_json: Dict[str, Any]) -> Dict[str, Any]:
+        return self.request("POST", "products", json=product_json)
+
+    def update_product(
+        self, canal_id: str, product_json: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        return self.request("PUT", "products", canal_id, json=product_json)
+
+    def delete_product(self, canal_id: str) -> Dict[str, Any]:
+        return self.request("DELETE", "products", canal_id)
+
+    def update_variant(
+        self, canal_variant_id: str, variant_json: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        return self.request("PUT", "variants", canal_variant_id, json=variant_json)
+
+    def create_order(self, order_json: Dict[str, Any]) -> Dict[str, Any]:
+        return self.request("POST", "orders", json=order_json)
+
+    def create_fulfillment(self, fulfillment_json: Dict[str, Any]) -> Dict[str, Any]:
+        return self.request("POST", "fulfillments", json=fulfillment_json)
+
+
+_clients: Dict[str, CanalClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_canal_client() -> CanalClient:
+    """
+    Returns the process wide client for ``SHOPCANAL_API_BASE_URL``.
+    """
+    base_url = settings.SHOPCANAL_API_BASE_URL
+    with _clients_lock:
+        if base_url not in _clients:
+            _clients[base_url] = CanalClient(
+                base_url,
+                pool_size=settings.CANAL_CLIENT_POOL_SIZE,
+                timeout=settings.CANAL_CLIENT_TIMEOUT,
+                max_retries=settings.CANAL_CLIENT_MAX_RETRIES,
+            )
+        return _clients[base_url]
@@ -0,0 +1,140 @@
+import random
+import string
+from typing import Any, Dict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.models import Item, Order, OrderItem, Payment, get_item_by_slug
+
+# Cart invariant: a user has at most one order with ordered=False (their cart),
+# and an OrderItem with ordered=False exists exactly when its item is in that
+# cart. Both are backed by unique constraints, so the functions below can
+# change a cart with single UPDATE / DELETE statements and let the database
+# settle races between concurrent requests.
+
+
+def cart_summary_cache_key(user_id: int) -> str:
+    return f"cart-summary:{user_id}"
+
+
+def get_cart_summary(user: Any) -> Dict[str, Any]:
+    """
+    Item count and total of the user's active cart. The summary is cached until
+    one of the cart views changes the cart, so pages showing it (the navbar is
+    on every page) don't query the cart.
+    """
+    key = cart_summary_cache_key(user.pk)
+    summary = cache.get(key)
+    if summary is None:
+        order = Order.objects.filter(user=user, ordered=False).first()
+        if order is None:
+            summary = {"count": 0, "total": 0}
+        else:
+            summary = {"count": order.items.count(), "total": order.get_total()}
+        cache.set(key, summary, settings.CART_SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+
+def invalidate_cart_summary(user: Any) -> None:
+    cache.delete(cart_summary_cache_key(user.pk))
+
+
+def get_active_order(user: Any) -> Order:
+    """
+    The user's cart with its items, their products and the coupon loaded up
+    front, so the order summary, checkout and payment pages render it with a
+    fixed number of queries however many items it has.
+    """
+    return (
+        Order.objects.select_related("coupon")
+        .prefetch_related("items__item")
+        .get(user=user, ordered=False)
+    )
+
+
+def cart_items(user: Any, slug: str):
+    return OrderItem.objects.filter(user=user, ordered=False, item__slug=slug)
+
+
+def add_to_cart(user: Any, slug: str) -> bool:
+    """
+    Adds one of the item to the user's cart and returns whether it is a new
+    line. Adding an item already in the cart is a single UPDATE.
+
+    Raises Item.DoesNotExist for an unknown slug.
+    """
+    for attempt in range(2):
+        if cart_items(user, slug).update(quantity=F("quantity") + 1):
+            created = False
+            break
+        item = get_item_by_slug(slug, Item.objects.only("id"))
+        try:
+            with transaction.atomic():
+                # Writing first takes the write lock up front on SQLite too
+                order_item = OrderItem.objects.create(user=user, item=item)
+                order = (
+                    Order.objects.select_for_update()
+                    .filter(user=user, ordered=False)
+                    .first()
+                )
+                if order is None:
+                    order = Order.objects.create(user=user, ordered_date=timezone.now())
+                order.items.add(order_item)
+                created = True
+                break
+        except IntegrityError:
+            # A concurrent request created the cart or the line first, the
+            # retry takes the UPDATE path
+            if attempt:
+                raise
+    invalidate_cart_summary(user)
+    return created
+
+
+def remove_from_cart(user: Any, slug: str) -> bool:
+    """
+    Removes the item from the user's cart and returns whether it was there.
+    """
+    with transaction.atomic():
+        deleted, _ = cart_items(user, slug).delete()
+    if deleted:
+        invalidate_cart_summary(user)
+    return bool(deleted)
+
+
+def remove_single_item_from_cart(user: Any, slug: str) -> bool:
+    """
+    Takes one of the item out of the user's cart, removing the line when it was
+    the last one, and returns whether the item was in the cart.
+    """
+    if cart_items(user, slug).filter(quantity__gt=1).update(quantity=F("quantity") - 1):
+        invalidate_cart_summary(user)
+        return True
+    return remove_from_cart(user, slug)
+
+
+def create_ref_code() -> str:
+    return "".join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+
+def finalize_order(order: Order, payment: Payment, charge_id: str) -> None:
+    """
+    Turns a paid cart into an order: records the charge on its payment, marks
+    every item ordered with one UPDATE and writes the order once, which queues
+    its Canal sync (see order_post_save_receiver). Takes the same few queries
+    however many items the cart has.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        payment.stripe_charge_id = charge_id
+        payment.save(update_fields=["stripe_charge_id"])
+        order.items.update(ordered=True, updated_at=now)
+        order.ordered = True
+        order.payment = payment
+        order.ref_code = create_ref_code()
+        order.save(update_fields=["ordered", "payment", "ref_code", "updated_at"])
+    invalidate_cart_summary(order.user)
@@ -2,6 +2,8 @@ from django import forms
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
 
+from .models import CATEGORY_CHOICES, LABEL_CHOICES
+
 
 PAYMENT_CHOICES = (("S", "Stripe"), ("P", "PayPal"), ("T", "Test"))
 
@@ -65,3 +67,10 @@ class PaymentForm(forms.Form):
     stripeToken = forms.CharField(required=False)
     save = forms.BooleanField(required=False)
     use_default = forms.BooleanField(required=False)
+
+
+class ItemFilterForm(forms.Form):
+    category = forms.ChoiceField(choices=CATEGORY_CHOICES, required=False)
+    label = forms.ChoiceField(choices=LABEL_CHOICES, required=False)
+    price_min = forms.FloatField(required=False, min_value=0)
+    price_max = forms.FloatField(required=False, min_value=0)
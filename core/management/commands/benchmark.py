@@ -0,0 +1,371 @@
+import cProfile
+import pstats
+import random
+import time
+import timeit
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, models, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.template.loader import render_to_string
+from django.utils import timezone
+from unittest import mock
+
+from core.models import (
+    Address,
+    CanalModel,
+    Fulfillment,
+    Item,
+    Order,
+    OrderItem,
+    UserProfile,
+)
+from core.payments import FakeGateway
+from core.search import search_items
+from core.url_templates import core_url
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+def register_benchmark(name: str) -> Callable:
+    def decorator(f: Callable) -> Callable:
+        BENCHMARKS[name] = f
+        return f
+
+    return decorator
+
+
+def best_of(f: Callable, repeat: int = 5) -> float:
+    return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+def legacy_transform_to_canal(self: CanalModel) -> Dict[str, Any]:
+    """
+    ``CanalModel.transform_to_canal`` as it was before the mapping was compiled.
+    """
+    canal_json = {}
+    for internal_field, canal_field in self.internal_to_canal_mapping.items():
+        attributes = internal_field.split("__")
+        instance = self
+        while len(attributes) > 1:
+            instance = getattr(instance, attributes.pop(0))
+        final_attribute = attributes.pop(0)
+        if isinstance(instance, models.Model):
+            field = instance._meta.get_field(final_attribute)
+            if isinstance(field, models.ImageField):
+                try:
+                    value = getattr(instance, field.name).url
+                except ValueError:
+                    value = None
+            elif isinstance(field, models.Field):
+                value = getattr(instance, field.name)
+            else:
+                continue
+        else:
+            value = getattr(instance, final_attribute)
+        if isinstance(canal_field, tuple):
+            value = canal_field[0](value)
+            canal_field = canal_field[1]
+        canal_json[canal_field] = value
+    if self.canal_id is not None:
+        canal_json["id"] = self.canal_id
+    return canal_json
+
+
+@register_benchmark("transform")
+def bench_transform(command: BaseCommand, n: int) -> None:
+    items = [
+        Item(title=f"Shirt {i}", description="A shirt", image="shirt.jpg")
+        for i in range(n)
+    ]
+    order = Order(canal_id="canal-order")
+    fulfillments = [
+        Fulfillment(
+            name="Fulfillment",
+            order=order,
+            status="success",
+            service="manual",
+            tracking_company="UPS",
+            tracking_number=str(i),
+            tracking_url=f"https://www.ups.com/track?tracknum={i}",
+        )
+        for i in range(n)
+    ]
+    for label, objs in (("Item", items), ("Fulfillment", fulfillments)):
+        old = best_of(lambda: [legacy_transform_to_canal(o) for o in objs])
+        new = best_of(lambda: [CanalModel.transform_to_canal(o) for o in objs])
+        command.stdout.write(
+            f"{label} x{n}: legacy {old * 1e6 / n:.2f}us/obj, "
+            f"compiled {new * 1e6 / n:.2f}us/obj ({old / new:.1f}x faster)"
+        )
+
+
+def legacy_upsert_order_items(order: Order, line_items_json, user) -> None:
+    """
+    Order line item handling as it was before it was done in bulk.
+    """
+    for line_item_json in line_items_json:
+        order_item, _ = OrderItem.objects.update_or_create(
+            canal_id=line_item_json["id"],
+            defaults={
+                "item": Item.objects.get(canal_variant_id=line_item_json["variant_id"]),
+                "ordered": True,
+                "quantity": line_item_json["quantity"],
+                "user": user,
+            },
+        )
+        order.items.add(order_item)
+
+
+def bulk_upsert_order_items(order: Order, line_items_json, user) -> None:
+    order.items.add(*OrderItem.upsert_from_canal_json(line_items_json, user))
+
+
+@register_benchmark("order_ingest")
+def bench_order_ingest(command: BaseCommand, n: int) -> None:
+    user, _ = get_user_model().objects.get_or_create(
+        email="simon.xie@shopcanal.com", defaults={"username": "simon-benchmark"}
+    )
+    Item.objects.bulk_create(
+        Item(
+            title=f"Bench {i}", price=1.0, slug=f"bench-{i}", canal_variant_id=f"bv{i}"
+        )
+        for i in range(n)
+    )
+    for label, upsert in (
+        ("legacy", legacy_upsert_order_items),
+        ("bulk", bulk_upsert_order_items),
+    ):
+        for run in ("create", "update"):
+            order = (
+                # placed orders, as Canal's are, so both can belong to the user
+                Order.objects.create(
+                    user=user,
+                    ordered_date=timezone.now(),
+                    ordered=True,
+                    canal_id=f"bench-{label}",
+                )
+                if run == "create"
+                else Order.objects.get(canal_id=f"bench-{label}")
+            )
+            lines = [
+                {"id": f"{label}-l{i}", "variant_id": f"bv{i}", "quantity": 2}
+                for i in range(n)
+            ]
+            with CaptureQueriesContext(connection) as queries:
+                seconds = best_of(lambda: upsert(order, lines, user), repeat=1)
+            command.stdout.write(
+                f"{label} {run} of a {n}-line order: {seconds * 1000:.1f}ms, "
+                f"{len(queries)} queries"
+            )
+
+
+@register_benchmark("catalog_pages")
+def bench_catalog_pages(command: BaseCommand, n: int) -> None:
+    Item.objects.bulk_create(
+        Item(
+            title=f"Bench {i}",
+            price=1.0,
+            category="S",
+            label="P",
+            slug=f"bench-{i}",
+            description="A shirt",
+            image="shirt.jpg",
+        )
+        for i in range(100)
+    )
+    urls = [reverse("core:home"), reverse("core:product", args=["bench-0"])]
+    user, _ = get_user_model().objects.get_or_create(
+        email="simon.xie@shopcanal.com", defaults={"username": "simon-benchmark"}
+    )
+    middleware = [m for m in settings.MIDDLEWARE if not m.startswith("debug_toolbar")]
+    for label, timeout in (("uncached", 0), ("cached", 300)):
+        for visitor in ("anonymous", "logged in"):
+            client = Client()
+            if visitor == "logged in":
+                client.force_login(user)
+            cache.clear()
+            with override_settings(
+                CATALOG_PAGE_CACHE_TIMEOUT=timeout, MIDDLEWARE=middleware
+            ):
+                started = time.perf_counter()
+                for i in range(n):
+                    client.get(urls[i % len(urls)])
+                elapsed = time.perf_counter() - started
+            command.stdout.write(
+                f"{label} {visitor}: {n / elapsed:.0f} requests/s "
+                f"({elapsed * 1000 / n:.2f}ms each)"
+            )
+
+
+@register_benchmark("search")
+def bench_search(command: BaseCommand, n: int) -> None:
+    # a ~1000 word vocabulary, so a word matches a few hundred of 100k items
+    syllables = "ka lo mi su te ra no vi pe do ga ru fe zi bo ha".split()
+    vocabulary = [a + b + c for a in syllables for b in syllables for c in "ny"]
+    rng = random.Random(0)
+    Item.objects.bulk_create(
+        (
+            Item(
+                title=" ".join(rng.choices(vocabulary, k=3)),
+                price=1.0,
+                category=("S", "SW", "OW")[i % 3],
+                label="P",
+                slug=f"bench-{i}",
+                description=" ".join(rng.choices(vocabulary, k=12)),
+                image="shirt.jpg",
+            )
+            for i in range(n)
+        ),
+        batch_size=500,
+    )
+    word, other = vocabulary[0], vocabulary[1]
+    for query, category in ((word, None), (f"{word} {other}", None), (word, "OW")):
+        seconds = best_of(lambda: search_items(query, category=category))
+        command.stdout.write(
+            f"{query!r} in {category or 'all categories'} over {n} items: "
+            f"{seconds * 1000:.2f}ms"
+        )
+
+
+@contextmanager
+def legacy_item_urls():
+    """
+    ``Item``'s url methods as they were before the url templates.
+    """
+    with mock.patch.multiple(
+        Item,
+        get_absolute_url=lambda self: reverse("core:product", args=[self.slug]),
+        get_add_to_cart_url=lambda self: reverse("core:add-to-cart", args=[self.slug]),
+        get_remove_from_cart_url=lambda self: reverse(
+            "core:remove-from-cart", args=[self.slug]
+        ),
+        get_remove_single_item_from_cart_url=lambda self: reverse(
+            "core:remove-single-item-from-cart", args=[self.slug]
+        ),
+    ):
+        yield
+
+
+def url_time_share(f: Callable) -> float:
+    """
+    Share of f's run time spent building urls, according to cProfile.
+    """
+    profile = cProfile.Profile()
+    profile.runcall(f)
+    stats = pstats.Stats(profile)
+    in_urls = sum(
+        cumulative
+        for (_, _, function), (_, _, _, cumulative, _) in stats.stats.items()
+        if function in ("reverse", "core_url")
+    )
+    return in_urls / stats.total_tt
+
+
+@register_benchmark("item_urls")
+def bench_item_urls(command: BaseCommand, n: int) -> None:
+    user, _ = get_user_model().objects.get_or_create(
+        email="simon.xie@shopcanal.com", defaults={"username": "simon-benchmark"}
+    )
+    items = Item.objects.bulk_create(
+        Item(title=f"Bench {i}", price=1.0, slug=f"bench-{i}") for i in range(n)
+    )
+    order = Order.objects.create(user=user, ordered_date=timezone.now())
+    order.items.add(
+        *OrderItem.objects.bulk_create(
+            OrderItem(user=user, item=item) for item in items
+        )
+    )
+    order = Order.objects.prefetch_related("items__item").get(pk=order.pk)
+    core_url("product", slug="warm-up")
+
+    def urls():
+        for item in items:
+            item.get_absolute_url()
+            item.get_add_to_cart_url()
+            item.get_remove_from_cart_url()
+
+    def order_summary():
+        render_to_string("order_summary.html", {"object": order})
+
+    for label, urls_patch in (
+        ("reverse", legacy_item_urls),
+        ("templates", nullcontext),
+    ):
+        with urls_patch():
+            per_url = best_of(urls) / (3 * n)
+            page = best_of(order_summary)
+            share = url_time_share(order_summary)
+        command.stdout.write(
+            f"{label}: {per_url * 1e6:.2f}us per url, {n}-item order summary "
+            f"{page * 1000:.1f}ms ({share:.0%} of it building urls)"
+        )
+
+
+@register_benchmark("payment_page")
+def bench_payment_page(command: BaseCommand, n: int) -> None:
+    user, _ = get_user_model().objects.get_or_create(
+        email="simon.xie@shopcanal.com", defaults={"username": "simon-benchmark"}
+    )
+    # a Stripe round trip is ~100-300ms, 100ms keeps the run short
+    gateway = FakeGateway(latency=0.1)
+    customer_id = gateway.create_customer(user.email)
+    gateway.add_card(customer_id, "tok_visa")
+    UserProfile.objects.update_or_create(
+        user=user,
+        defaults={"stripe_customer_id": customer_id, "one_click_purchasing": True},
+    )
+    item = Item.objects.create(title="Bench", price=1.0, slug="bench-payment")
+    order = Order.objects.create(
+        user=user,
+        ordered_date=timezone.now(),
+        billing_address=Address.get_or_add(
+            user,
+            "B",
+            street_address="1 Main St",
+            apartment_address="",
+            country="US",
+            zip="94105",
+        ),
+    )
+    order.items.add(OrderItem.objects.create(user=user, item=item))
+    client = Client()
+    client.force_login(user)
+    url = reverse("core:payment", args=["stripe"])
+    middleware = [m for m in settings.MIDDLEWARE if not m.startswith("debug_toolbar")]
+    for label, timeout in (("uncached", -1), ("cached", 3600)):
+        gateway.calls.clear()
+        with override_settings(
+            PAYMENT_CARD_CACHE_TIMEOUT=timeout, MIDDLEWARE=middleware
+        ), mock.patch("core.payments.get_payment_gateway", return_value=gateway):
+            client.get(url)
+            started = time.perf_counter()
+            for _ in range(n):
+                client.get(url)
+            elapsed = time.perf_counter() - started
+        command.stdout.write(
+            f"{label} card: {elapsed * 1000 / n:.1f}ms per payment page view, "
+            f"{len(gateway.calls)} gateway calls for {n + 1} views"
+        )
+
+
+class Command(BaseCommand):
+    help = "Runs a micro-benchmark, rolling back anything it writes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(BENCHMARKS))
+        parser.add_argument(
+            "-n", type=int, default=10000, help="Size of the benchmark data set"
+        )
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            BENCHMARKS[kwargs["name"]](self, kwargs["n"])
+            transaction.set_rollback(True)
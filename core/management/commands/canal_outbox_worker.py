@@ -0,0 +1,11 @@
+from core.models import CanalOutboxEntry
+from core.outbox import drain
+from core.queue import QueueWorkerCommand
+
+
+class Command(QueueWorkerCommand):
+    help = "Sends queued Canal API calls from the outbox"
+    model = CanalOutboxEntry
+
+    def drain(self, workers: int, batch_size: int) -> int:
+        return drain(workers=workers, batch_size=batch_size)
@@ -0,0 +1,95 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core.canal_client import get_canal_client
+from core.models import CanalOutboxEntry, Item
+from core.outbox import push_item_to_canal
+
+
+def push_items(items: List[Item]) -> List[str]:
+    errors = []
+    try:
+        for item in items:
+            try:
+                push_item_to_canal(item)
+            except Exception as e:
+                errors.append(f"{item.id} {item}: {e!r}")
+    finally:
+        connections.close_all()
+    return errors
+
+
+class Command(BaseCommand):
+    help = (
+        "Pushes every item that changed since it was last synced to Canal, "
+        "including changes made with QuerySet.update() or bulk_create()"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=50,
+            help="Number of items each thread pushes at a time",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=8, help="Number of sender threads"
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Push every item, even ones that look unchanged",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many items would be pushed",
+        )
+
+    def handle(self, *args, **kwargs):
+        started = time.monotonic()
+        # Items with a queued outbox entry are left to the outbox worker, so the
+        # same new product can't be created twice.
+        queued = CanalOutboxEntry.objects.filter(
+            topic="product/upsert", status__in=["P", "R"]
+        ).values("object_id")
+        items = Item.objects.filter(added_from_canal=False).exclude(id__in=queued)
+        changed = [
+            item
+            for item in items.iterator(chunk_size=kwargs["chunk_size"])
+            if kwargs["all"] or item.get_canal_sync_hash() != item.canal_synced_hash
+        ]
+        self.stdout.write(
+            f"{len(changed)} changed items found in {time.monotonic() - started:.2f}s"
+        )
+        if kwargs["dry_run"] or not changed:
+            return
+
+        started = time.monotonic()
+        chunk_size = kwargs["chunk_size"]
+        chunks = [
+            changed[i : i + chunk_size] for i in range(0, len(changed), chunk_size)
+        ]
+        with ThreadPoolExecutor(max_workers=kwargs["workers"]) as executor:
+            errors = [e for chunk in executor.map(push_items, chunks) for e in chunk]
+        elapsed = time.monotonic() - started
+
+        for error in errors:
+            self.stderr.write(error)
+        pushed = len(changed) - len(errors)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Pushed {pushed} items in {elapsed:.2f}s ({pushed / elapsed:.1f}/s), "
+                f"{len(errors)} failed"
+            )
+        )
+        if kwargs["verbosity"] > 1:
+            for endpoint, stats in get_canal_client().stats().items():
+                self.stdout.write(
+                    f"  {endpoint}: {stats['count']} calls, "
+                    f"avg {stats['avg'] * 1000:.0f}ms, max {stats['max'] * 1000:.0f}ms"
+                )
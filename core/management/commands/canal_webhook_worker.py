@@ -0,0 +1,11 @@
+from core.models import CanalWebhookEvent
+from core.queue import QueueWorkerCommand
+from core.webhooks import drain
+
+
+class Command(QueueWorkerCommand):
+    help = "Applies Canal webhooks stored in the inbox"
+    model = CanalWebhookEvent
+
+    def drain(self, workers: int, batch_size: int) -> int:
+        return drain(workers=workers, batch_size=batch_size)
@@ -0,0 +1,62 @@
+# Generated by Django 2.2.14 on 2026-10-16 20:50
+
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0012_auto_20230601_1922"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CanalOutboxEntry",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("topic", models.CharField(max_length=50)),
+                ("object_id", models.UUIDField()),
+                ("canal_id", models.CharField(blank=True, max_length=36, null=True)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("P", "pending"),
+                            ("R", "running"),
+                            ("S", "sent"),
+                            ("F", "failed"),
+                        ],
+                        default="P",
+                        max_length=1,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("last_error", models.TextField(blank=True)),
+                (
+                    "available_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "Canal outbox entries",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="canaloutboxentry",
+            index=models.Index(
+                fields=["status", "available_at"], name="core_canalo_status_b8ee00_idx"
+            ),
+        ),
+    ]
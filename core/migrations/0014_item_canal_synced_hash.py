@@ -0,0 +1,18 @@
+# Generated by Django 2.2.14 on 2026-10-16 20:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0013_canaloutboxentry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="item",
+            name="canal_synced_hash",
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 2.2.14 on 2026-10-16 20:56
+
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0014_item_canal_synced_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CanalWebhookEvent",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("event_key", models.CharField(max_length=64, unique=True)),
+                ("topic", models.CharField(max_length=50)),
+                ("payload", models.TextField()),
+                (
+                    "canal_object_id",
+                    models.CharField(blank=True, max_length=36, null=True),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("P", "pending"),
+                            ("R", "running"),
+                            ("S", "processed"),
+                            ("F", "failed"),
+                        ],
+                        default="P",
+                        max_length=1,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("last_error", models.TextField(blank=True)),
+                (
+                    "available_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="canalwebhookevent",
+            index=models.Index(
+                fields=["status", "available_at"], name="core_canalw_status_143530_idx"
+            ),
+        ),
+    ]
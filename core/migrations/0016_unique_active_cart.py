@@ -0,0 +1,57 @@
+# Generated by Django 2.2.14 on 2026-10-16 20:59
+
+from django.db import migrations, models
+
+
+def merge_duplicate_carts(apps, schema_editor):
+    """
+    Keeps the newest active cart per user and one active order item per user
+    and item (the cart's, when there is one), so the constraints can be added.
+    """
+    Order = apps.get_model("core", "Order")
+    OrderItem = apps.get_model("core", "OrderItem")
+    carts = {}
+    for order in Order.objects.filter(ordered=False).order_by("-created_at"):
+        if order.user_id in carts:
+            order.delete()
+        else:
+            carts[order.user_id] = order
+    in_cart = set(
+        Order.items.through.objects.filter(
+            order__ordered=False, orderitem__ordered=False
+        ).values_list("orderitem_id", flat=True)
+    )
+    seen = set()
+    for order_item in OrderItem.objects.filter(ordered=False).order_by("-created_at"):
+        key = (order_item.user_id, order_item.item_id)
+        if order_item.id not in in_cart or key in seen:
+            order_item.delete()
+        else:
+            seen.add(key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0015_canalwebhookevent"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="order",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(ordered=False),
+                fields=("user",),
+                name="unique_active_cart",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="orderitem",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(ordered=False),
+                fields=("user", "item"),
+                name="unique_active_order_item",
+            ),
+        ),
+    ]
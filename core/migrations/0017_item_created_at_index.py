@@ -0,0 +1,19 @@
+# Generated by Django 2.2.14 on 2026-10-16 21:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0016_unique_active_cart"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                fields=["created_at", "id"], name="core_item_created_3df05f_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.14 on 2026-10-16 21:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0017_item_created_at_index"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                fields=["updated_at"], name="core_item_updated_aba937_idx"
+            ),
+        ),
+    ]
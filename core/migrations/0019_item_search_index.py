@@ -0,0 +1,100 @@
+from django.db import migrations
+
+# The search index is maintained by triggers, so item writes that bypass the
+# ORM's save() (bulk_create / bulk_update from Canal webhooks, QuerySet.update)
+# keep it current too.
+#
+# On SQLite the index points at core_item's rowids, and a migration that makes
+# Django rebuild core_item drops the triggers and renumbers the rows, so such a
+# migration must run SQLITE_FORWARDS again (it's idempotent and reindexes).
+
+SQLITE_FORWARDS = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS core_item_search USING fts5(
+        title, description, content='core_item', content_rowid='rowid'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_insert AFTER INSERT ON core_item BEGIN
+        INSERT INTO core_item_search (rowid, title, description)
+        VALUES (new.rowid, new.title, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_delete AFTER DELETE ON core_item BEGIN
+        INSERT INTO core_item_search (core_item_search, rowid, title, description)
+        VALUES ('delete', old.rowid, old.title, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_update AFTER UPDATE OF title, description
+    ON core_item BEGIN
+        INSERT INTO core_item_search (core_item_search, rowid, title, description)
+        VALUES ('delete', old.rowid, old.title, old.description);
+        INSERT INTO core_item_search (rowid, title, description)
+        VALUES (new.rowid, new.title, new.description);
+    END
+    """,
+    "INSERT INTO core_item_search (core_item_search) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER core_item_search_update",
+    "DROP TRIGGER core_item_search_delete",
+    "DROP TRIGGER core_item_search_insert",
+    "DROP TABLE core_item_search",
+]
+
+POSTGRESQL_FORWARDS = [
+    "ALTER TABLE core_item ADD COLUMN search_vector tsvector",
+    """
+    CREATE FUNCTION core_item_search_vector() RETURNS trigger AS $$
+    BEGIN
+        new.search_vector :=
+            setweight(to_tsvector('english', coalesce(new.title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(new.description, '')), 'B');
+        RETURN new;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER core_item_search_vector_update
+    BEFORE INSERT OR UPDATE OF title, description ON core_item
+    FOR EACH ROW EXECUTE PROCEDURE core_item_search_vector()
+    """,
+    "UPDATE core_item SET title = title",
+    "CREATE INDEX core_item_search_vector_idx ON core_item USING gin (search_vector)",
+]
+
+POSTGRESQL_BACKWARDS = [
+    "DROP INDEX core_item_search_vector_idx",
+    "DROP TRIGGER core_item_search_vector_update ON core_item",
+    "DROP FUNCTION core_item_search_vector()",
+    "ALTER TABLE core_item DROP COLUMN search_vector",
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0018_item_updated_at_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor(
+                {"sqlite": SQLITE_FORWARDS, "postgresql": POSTGRESQL_FORWARDS}
+            ),
+            run_for_vendor(
+                {"sqlite": SQLITE_BACKWARDS, "postgresql": POSTGRESQL_BACKWARDS}
+            ),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 2.2.14 on 2026-10-16 21:11
+
+from django.db import migrations, models
+
+
+def count_item_facets(apps, schema_editor):
+    Item = apps.get_model("core", "Item")
+    ItemFacetCount = apps.get_model("core", "ItemFacetCount")
+    ItemFacetCount.objects.bulk_create(
+        ItemFacetCount(**row)
+        for row in Item.objects.values("category", "label")
+        .annotate(count=models.Count("id"))
+        .order_by()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0019_item_search_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ItemFacetCount",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("category", models.CharField(max_length=2)),
+                ("label", models.CharField(max_length=1)),
+                ("count", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                fields=["category", "created_at", "id"],
+                name="core_item_categor_7e01fb_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                fields=["label", "created_at", "id"], name="core_item_label_d707e6_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                fields=["category", "label", "created_at", "id"],
+                name="core_item_categor_01ff08_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="itemfacetcount",
+            constraint=models.UniqueConstraint(
+                fields=("category", "label"), name="unique_item_facet_count"
+            ),
+        ),
+        migrations.RunPython(count_item_facets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+from django.utils.text import slugify
+
+
+def fix_item_slugs(apps, schema_editor):
+    """
+    Gives items with a duplicate or malformed slug (Canal imports used the
+    lowercased title) a unique one, so the slug can be made unique.
+    """
+    Item = apps.get_model("core", "Item")
+    items = list(Item.objects.order_by("created_at", "id").only("title", "slug"))
+    taken = {item.slug for item in items}
+    seen = set()
+    to_update = []
+    for item in items:
+        if item.slug and slugify(item.slug) == item.slug and item.slug not in seen:
+            seen.add(item.slug)
+            continue
+        base = slugify(item.title)[:42].strip("-") or "item"
+        slug, suffix = base, 2
+        while slug in taken:
+            slug, suffix = f"{base}-{suffix}", suffix + 1
+        taken.add(slug)
+        seen.add(slug)
+        item.slug = slug
+        to_update.append(item)
+    Item.objects.bulk_update(to_update, ["slug"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0020_itemfacetcount"),
+    ]
+
+    operations = [
+        migrations.RunPython(fix_item_slugs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.14 on 2026-10-16 22:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0021_item_slug_fix"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="item",
+            name="slug",
+            field=models.SlugField(unique=True),
+        ),
+    ]
@@ -0,0 +1,74 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def address_fingerprint(address):
+    # core.models.address_fingerprint as of this migration
+    parts = [
+        address.address_type,
+        address.street_address,
+        address.apartment_address,
+        str(address.country),
+        address.zip,
+    ]
+    normalized = "\x1f".join(
+        " ".join((part or "").split()).casefold() for part in parts
+    )
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def deduplicate_addresses(apps, schema_editor):
+    """
+    Fingerprints every address and merges the copies checkout used to create,
+    pointing their orders at the oldest one. Only each user's newest default
+    address of a type stays their default.
+    """
+    Address = apps.get_model("core", "Address")
+    Order = apps.get_model("core", "Order")
+    survivors = {}
+    to_update, duplicates = [], {}
+    for address in Address.objects.order_by("id"):
+        address.fingerprint = address_fingerprint(address)
+        key = (address.user_id, address.fingerprint)
+        survivor = survivors.get(key)
+        if survivor is None:
+            survivors[key] = address
+            to_update.append(address)
+            continue
+        survivor.default = survivor.default or address.default
+        duplicates[address.id] = survivor.id
+    for duplicate_id, survivor_id in duplicates.items():
+        Order.objects.filter(shipping_address_id=duplicate_id).update(
+            shipping_address_id=survivor_id
+        )
+        Order.objects.filter(billing_address_id=duplicate_id).update(
+            billing_address_id=survivor_id
+        )
+    Address.objects.filter(id__in=list(duplicates)).delete()
+
+    newest_defaults = {}
+    for address in to_update:
+        if address.default:
+            previous = newest_defaults.get((address.user_id, address.address_type))
+            if previous is not None:
+                previous.default = False
+            newest_defaults[(address.user_id, address.address_type)] = address
+    Address.objects.bulk_update(to_update, ["fingerprint", "default"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0022_item_slug_unique"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="address",
+            name="fingerprint",
+            field=models.CharField(default="", editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(deduplicate_addresses, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.14 on 2026-10-16 22:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("core", "0023_address_fingerprint"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="address",
+            constraint=models.UniqueConstraint(
+                fields=("user", "fingerprint"), name="unique_address_fingerprint"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="address",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(default=True),
+                fields=("user", "address_type"),
+                name="unique_default_address",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.14 on 2026-10-16 22:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0025_userprofile_default_card"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="idempotency_key",
+            field=models.CharField(max_length=64, null=True, unique=True),
+        ),
+    ]
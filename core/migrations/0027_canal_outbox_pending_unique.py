@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+def merge_pending_entries(apps, schema_editor):
+    """
+    Leaves one pending outbox entry per object and topic, the newest. The
+    others are marked sent, as the worker sends the latest state anyway.
+    """
+    CanalOutboxEntry = apps.get_model("core", "CanalOutboxEntry")
+    seen = set()
+    superseded = []
+    for entry in CanalOutboxEntry.objects.filter(status="P").order_by("-created_at"):
+        key = (entry.topic, entry.object_id)
+        if key in seen:
+            superseded.append(entry.id)
+        seen.add(key)
+    CanalOutboxEntry.objects.filter(id__in=superseded).update(status="S")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0026_payment_idempotency_key"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_pending_entries, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="canaloutboxentry",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(status="P"),
+                fields=("topic", "object_id"),
+                name="unique_pending_outbox_entry",
+            ),
+        ),
+    ]
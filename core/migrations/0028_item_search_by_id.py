@@ -0,0 +1,77 @@
+from importlib import import_module
+
+from django.db import migrations
+
+search_index = import_module("core.migrations.0019_item_search_index")
+
+# The SQLite index made by 0019 read its content from core_item by rowid, which
+# a rebuild of core_item renumbers. It's now a plain FTS5 table keeping each
+# item's id, so its rows survive rebuilds. The triggers don't, a rebuild drops
+# them with the old table: core.search.ensure_search_triggers puts them back
+# after every migrate.
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_insert AFTER INSERT ON core_item BEGIN
+        INSERT INTO core_item_search (item_id, title, description)
+        VALUES (new.id, new.title, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_delete AFTER DELETE ON core_item BEGIN
+        DELETE FROM core_item_search WHERE item_id = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_update AFTER UPDATE OF title, description
+    ON core_item BEGIN
+        DELETE FROM core_item_search WHERE item_id = old.id;
+        INSERT INTO core_item_search (item_id, title, description)
+        VALUES (new.id, new.title, new.description);
+    END
+    """,
+]
+
+SQLITE_REINDEX = [
+    "DELETE FROM core_item_search",
+    """
+    INSERT INTO core_item_search (item_id, title, description)
+    SELECT id, title, description FROM core_item
+    """,
+]
+
+SQLITE_FORWARDS = [
+    "DROP TRIGGER IF EXISTS core_item_search_update",
+    "DROP TRIGGER IF EXISTS core_item_search_delete",
+    "DROP TRIGGER IF EXISTS core_item_search_insert",
+    "DROP TABLE IF EXISTS core_item_search",
+    """
+    CREATE VIRTUAL TABLE core_item_search USING fts5(
+        item_id UNINDEXED, title, description
+    )
+    """,
+    *SQLITE_REINDEX,
+    *SQLITE_TRIGGERS,
+]
+
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS core_item_search_update",
+    "DROP TRIGGER IF EXISTS core_item_search_delete",
+    "DROP TRIGGER IF EXISTS core_item_search_insert",
+    "DROP TABLE core_item_search",
+    *search_index.SQLITE_FORWARDS,
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0027_canal_outbox_pending_unique"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            search_index.run_for_vendor({"sqlite": SQLITE_FORWARDS}),
+            search_index.run_for_vendor({"sqlite": SQLITE_BACKWARDS}),
+        ),
+    ]
@@ -0,0 +1,102 @@
+from importlib import import_module
+
+from django.db import migrations
+
+search_index = import_module("core.migrations.0019_item_search_index")
+by_id = import_module("core.migrations.0028_item_search_by_id")
+
+# 0028's index found an item's row through an UNINDEXED column, so every
+# delete and update of an item scanned the whole index. Its rows now get their
+# rowids from core_item_search_id, where an item's is an indexed lookup.
+#
+# The SQL below is core.search's as of this migration.
+
+# The SQLite index is an FTS5 table whose rowids are assigned through
+# core_item_search_id, an ordinary table mapping item ids to them. A rebuild of
+# core_item by a migration leaves both tables alone but drops the triggers with
+# the old table, ensure_search_triggers puts them back.
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_insert AFTER INSERT ON core_item BEGIN
+        INSERT INTO core_item_search_id (item_id) VALUES (new.id);
+        INSERT INTO core_item_search (rowid, title, description)
+        VALUES (
+            (SELECT rowid FROM core_item_search_id WHERE item_id = new.id),
+            new.title,
+            new.description
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_delete AFTER DELETE ON core_item BEGIN
+        DELETE FROM core_item_search WHERE rowid = (
+            SELECT rowid FROM core_item_search_id WHERE item_id = old.id
+        );
+        DELETE FROM core_item_search_id WHERE item_id = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_update AFTER UPDATE OF title, description
+    ON core_item BEGIN
+        DELETE FROM core_item_search WHERE rowid = (
+            SELECT rowid FROM core_item_search_id WHERE item_id = old.id
+        );
+        INSERT INTO core_item_search (rowid, title, description)
+        VALUES (
+            (SELECT rowid FROM core_item_search_id WHERE item_id = new.id),
+            new.title,
+            new.description
+        );
+    END
+    """,
+]
+
+SQLITE_REINDEX = [
+    "DELETE FROM core_item_search",
+    "DELETE FROM core_item_search_id",
+    "INSERT INTO core_item_search_id (item_id) SELECT id FROM core_item",
+    """
+    INSERT INTO core_item_search (rowid, title, description)
+    SELECT core_item_search_id.rowid, core_item.title, core_item.description
+    FROM core_item
+    JOIN core_item_search_id ON core_item_search_id.item_id = core_item.id
+    """,
+]
+
+SQLITE_FORWARDS = [
+    "DROP TRIGGER IF EXISTS core_item_search_update",
+    "DROP TRIGGER IF EXISTS core_item_search_delete",
+    "DROP TRIGGER IF EXISTS core_item_search_insert",
+    "DROP TABLE IF EXISTS core_item_search",
+    """
+    CREATE TABLE core_item_search_id (
+        rowid INTEGER PRIMARY KEY, item_id char(32) NOT NULL UNIQUE
+    )
+    """,
+    "CREATE VIRTUAL TABLE core_item_search USING fts5(title, description)",
+    *SQLITE_REINDEX,
+    *SQLITE_TRIGGERS,
+]
+
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS core_item_search_update",
+    "DROP TRIGGER IF EXISTS core_item_search_delete",
+    "DROP TRIGGER IF EXISTS core_item_search_insert",
+    "DROP TABLE core_item_search",
+    "DROP TABLE core_item_search_id",
+    *by_id.SQLITE_FORWARDS,
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0028_item_search_by_id"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            search_index.run_for_vendor({"sqlite": SQLITE_FORWARDS}),
+            search_index.run_for_vendor({"sqlite": SQLITE_BACKWARDS}),
+        ),
+    ]
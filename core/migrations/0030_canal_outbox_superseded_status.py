@@ -0,0 +1,28 @@
+# Generated by Django 2.2.14 on 2026-10-16 23:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0029_item_search_rowids"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="canaloutboxentry",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("P", "pending"),
+                    ("R", "running"),
+                    ("S", "sent"),
+                    ("F", "failed"),
+                    ("X", "superseded"),
+                ],
+                default="P",
+                max_length=1,
+            ),
+        ),
+    ]
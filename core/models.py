@@ -1,22 +1,27 @@
-import os
-import requests
+import hashlib
+import json
+from collections import Counter, defaultdict
+from functools import lru_cache
+from operator import attrgetter
 from random import randint
-from typing import Any, Dict, List
-from uuid import uuid4
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type
+from uuid import UUID, uuid4
 
 from django.apps import apps
 from django.db.models.signals import post_save
 from django.conf import settings
-from django.db import models
+from django.core.exceptions import FieldDoesNotExist
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Coalesce, NullIf
 from django.db.models.options import Options
-from django.shortcuts import reverse
 from django.utils import timezone
+from django.utils.text import slugify
 from django.utils.translation import gettext as _
 from django_countries.fields import CountryField
 from tenacity import retry, stop_after_attempt, wait_exponential
 
-from core.constants import SHOPCANAL_DEFAULT_HEADERS
-from core.signals import raise_response_status
+from core.canal_client import get_canal_client
+from core.url_templates import core_url
 
 
 CATEGORY_CHOICES = (("S", "Shirt"), ("SW", "Sport wear"), ("OW", "Outwear"))
@@ -40,6 +45,55 @@ def register_canal_webhook_model(topics: List[str]) -> "CanalModel":
     return decorator
 
 
+CanalAccessor = Tuple[str, Callable[[models.Model], Any]]
+
+
+def image_url_getter(getter: Callable[[models.Model], Any]) -> Callable:
+    def get_url(instance: models.Model) -> Optional[str]:
+        try:
+            return getter(instance).url
+        except ValueError:
+            # TODO validate that the url is an actual url
+            return None
+
+    return get_url
+
+
+def compile_canal_accessor(
+    model: Type[models.Model], internal_field: str, canal_field: Any
+) -> Optional[CanalAccessor]:
+    """
+    Turns one ``internal_to_canal_mapping`` entry, e.g. ``"order__canal_id"``,
+    into a getter for it. Fields are resolved through ``_meta`` here so the
+    getter itself is a plain attribute lookup. Returns None for entries that
+    aren't serializable (reverse relations).
+    """
+    attributes = internal_field.split("__")
+    related_model = model
+    for attribute in attributes[:-1]:
+        try:
+            field = related_model._meta.get_field(attribute)
+        except (AttributeError, FieldDoesNotExist):
+            related_model = None
+        else:
+            related_model = field.related_model if field.is_relation else None
+    getter = attrgetter(".".join(attributes))
+    if related_model is not None:
+        try:
+            field = related_model._meta.get_field(attributes[-1])
+        except FieldDoesNotExist:
+            field = None
+        if isinstance(field, models.ImageField):
+            getter = image_url_getter(getter)
+        elif field is not None and not isinstance(field, models.Field):
+            return None
+    if isinstance(canal_field, tuple):
+        transform, canal_field = canal_field
+        field_getter = getter
+        getter = lambda instance: transform(field_getter(instance))
+    return canal_field, getter
+
+
 class BaseModel(models.Model):
     """
     Base model that includes default created / updated timestamps.
@@ -53,39 +107,47 @@ class BaseModel(models.Model):
         abstract = True
 
 
+class CanalQuerySet(models.QuerySet):
+    def for_canal(self) -> "CanalQuerySet":
+        """
+        Loads every relation ``transform_to_canal`` reads up front, so
+        serializing any number of objects costs a fixed number of queries.
+        """
+        return self.select_related(*self.model.canal_select_related).prefetch_related(
+            *self.model.canal_prefetch_related
+        )
+
+
 class CanalModel(BaseModel):
     internal_to_canal_mapping: Dict[str, str]
+    # Relations transform_to_canal follows, loaded by CanalQuerySet.for_canal
+    canal_select_related: Tuple[str, ...] = ()
+    canal_prefetch_related: Tuple[str, ...] = ()
     _meta: Options
     canal_id = models.CharField(null=True, blank=True, max_length=36, db_index=True)
 
+    objects = CanalQuerySet.as_manager()
+
+    @classmethod
+    def get_canal_accessors(cls) -> List[CanalAccessor]:
+        """
+        ``internal_to_canal_mapping`` compiled into (canal field, getter) pairs.
+        Built once per model class (``CoreConfig.ready`` does it at startup)
+        instead of walking ``_meta`` for every serialized instance.
+        """
+        if "_canal_accessors" not in cls.__dict__:
+            accessors = (
+                compile_canal_accessor(cls, internal_field, canal_field)
+                for internal_field, canal_field in cls.internal_to_canal_mapping.items()
+            )
+            cls._canal_accessors = [a for a in accessors if a is not None]
+        return cls._canal_accessors
+
     def transform_to_canal(self) -> Dict[str, Any]:
-        canal_json = {}
-        for internal_field, canal_field in self.internal_to_canal_mapping.items():
-            attributes = internal_field.split("__")
-            instance = self
-            while len(attributes) > 1:
-                instance = getattr(instance, attributes.pop(0))
-            final_attribute = attributes.pop(0)
-            if isinstance(instance, models.Model):
-                field = instance._meta.get_field(final_attribute)
-                if isinstance(field, str):
-                    value = getattr(instance, field)
-                elif isinstance(field, models.ImageField):
-                    try:
-                        value = getattr(instance, field.name).url
-                    except ValueError:
-                        value = None
-                    # TODO validate that the url is an actual url
-                elif isinstance(field, models.Field):
-                    value = getattr(instance, field.name)
-                else:
-                    continue
-            else:
-                value = getattr(instance, final_attribute)
-            if isinstance(canal_field, tuple):
-                value = canal_field[0](value)
-                canal_field = canal_field[1]
-            canal_json[canal_field] = value
+        canal_json = {
+            canal_field: getter(self)
+            for canal_field, getter in self.get_canal_accessors()
+        }
         if self.canal_id is not None:
             canal_json["id"] = self.canal_id
         return canal_json
@@ -96,14 +158,113 @@ class CanalModel(BaseModel):
     ) -> "CanalModel":
         ...
 
+    @classmethod
+    def bulk_create_or_update_from_canal_json(
+        cls, canal_jsons: List[Dict[str, Any]]
+    ) -> List[Optional[Exception]]:
+        """
+        Applies many webhook payloads at once and returns the error for each
+        one, or None if it was applied. Models that can group their lookups
+        override this, the default applies each payload in its own savepoint.
+        """
+        errors = []
+        for canal_json in canal_jsons:
+            try:
+                with transaction.atomic():
+                    cls.create_or_update_from_canal_json(canal_json)
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
     class Meta:
         abstract = True
 
 
+OUTBOX_STATUSES = (
+    ("P", "pending"),
+    ("R", "running"),
+    ("S", "sent"),
+    ("F", "failed"),
+    # failed while a newer entry for the object was queued, which sends it
+    ("X", "superseded"),
+)
+
+
+class CanalOutboxEntry(BaseModel):
+    """
+    A pending call to the Canal API. Entries are written in the same transaction
+    as the change that caused them and drained by the ``canal_outbox_worker``
+    management command, so saves never wait on Canal.
+    """
+
+    topic = models.CharField(max_length=50)
+    object_id = models.UUIDField()
+    canal_id = models.CharField(null=True, blank=True, max_length=36)
+    status = models.CharField(choices=OUTBOX_STATUSES, max_length=1, default="P")
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    available_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "available_at"])]
+        constraints = [
+            # enqueue_canal_sync reuses the one pending entry of an object
+            models.UniqueConstraint(
+                fields=["topic", "object_id"],
+                condition=models.Q(status="P"),
+                name="unique_pending_outbox_entry",
+            )
+        ]
+        verbose_name_plural = "Canal outbox entries"
+
+    def __str__(self):
+        return f"{self.topic} {self.object_id}"
+
+
+WEBHOOK_EVENT_STATUSES = (
+    ("P", "pending"),
+    ("R", "running"),
+    ("S", "processed"),
+    ("F", "failed"),
+)
+
+
+class CanalWebhookEvent(BaseModel):
+    """
+    A webhook received from Canal. Webhooks are stored and acknowledged straight
+    away, then applied by the ``canal_webhook_worker`` management command.
+    ``event_key`` is unique, so a redelivered webhook is only applied once.
+    """
+
+    event_key = models.CharField(max_length=64, unique=True)
+    topic = models.CharField(max_length=50)
+    payload = models.TextField()
+    canal_object_id = models.CharField(null=True, blank=True, max_length=36)
+    status = models.CharField(choices=WEBHOOK_EVENT_STATUSES, max_length=1, default="P")
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    available_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "available_at"])]
+
+    def __str__(self):
+        return f"{self.topic} {self.canal_object_id}"
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     stripe_customer_id = models.CharField(max_length=50, blank=True, null=True)
     one_click_purchasing = models.BooleanField(default=False)
+    # The customer's default card as last seen at the gateway, see
+    # core.payments.get_default_card
+    default_card_id = models.CharField(max_length=50, blank=True)
+    default_card_last4 = models.CharField(max_length=4, blank=True)
+    default_card_exp_month = models.PositiveSmallIntegerField(blank=True, null=True)
+    default_card_exp_year = models.PositiveSmallIntegerField(blank=True, null=True)
+    default_card_checked_at = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return self.user.username
@@ -116,31 +277,98 @@ class Item(CanalModel):
     discount_price = models.FloatField(blank=True, null=True)
     category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
     description = models.TextField()
     image = models.ImageField()
     canal_variant_id = models.CharField(
         blank=True, null=True, max_length=36, unique=True, db_index=True
     )
     added_from_canal = models.BooleanField(default=False)
+    # Hash of the product last pushed to Canal, see get_canal_sync_hash
+    canal_synced_hash = models.CharField(blank=True, null=True, max_length=64)
 
     internal_to_canal_mapping = {
         "title": "title",
         "description": "body_html",
         "image": "image_src",
     }
+    # Fields shown on the product cards of the home page
+    card_fields = (
+        "created_at",
+        "updated_at",
+        "title",
+        "price",
+        "discount_price",
+        "category",
+        "label",
+        "slug",
+        "image",
+    )
+
+    # updated_at as loaded from the database, see invalidate_item_fragments
+    _loaded_updated_at = None
+    # (category, label) as loaded from the database, see update_item_facet_counts
+    _loaded_facet = None
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at", "id"]),
+            # for the catalog page cache's Max("updated_at")
+            models.Index(fields=["updated_at"]),
+            # for the home page's category / label filters
+            models.Index(fields=["category", "created_at", "id"]),
+            models.Index(fields=["label", "created_at", "id"]),
+            models.Index(fields=["category", "label", "created_at", "id"]),
+        ]
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        item = super().from_db(db, field_names, values)
+        item._loaded_updated_at = item.__dict__.get("updated_at")
+        if "category" in item.__dict__ and "label" in item.__dict__:
+            item._loaded_facet = (item.category, item.label)
+        return item
+
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        if not self.slug:
+            self.slug = generate_item_slugs([self.title])[0]
+        if (
+            self._loaded_facet is None
+            and not self._state.adding
+            and self.writes_facet(kwargs.get("update_fields"))
+        ):
+            # loaded without its category or label, read what they were so
+            # update_item_facet_counts can move the item between counts
+            self._loaded_facet = (
+                Item.objects.filter(pk=self.pk).values_list("category", "label").first()
+            )
+        super().save(*args, **kwargs)
+
+    def writes_facet(self, update_fields: Optional[Iterable[str]]) -> bool:
+        """
+        Whether saving with ``update_fields`` writes the category or label.
+        """
+        if update_fields is not None:
+            return bool({"category", "label"} & set(update_fields))
+        # only the loaded fields of a partly loaded item are saved
+        return not {"category", "label"} <= self.get_deferred_fields()
+
+    # The urls below are rendered for every row of the listing and cart pages,
+    # so they're built from precompiled templates instead of reverse()
     def get_absolute_url(self):
-        return reverse("core:product", kwargs={"slug": self.slug})
+        return core_url("product", slug=self.slug)
 
     def get_add_to_cart_url(self):
-        return reverse("core:add-to-cart", kwargs={"slug": self.slug})
+        return core_url("add-to-cart", slug=self.slug)
 
     def get_remove_from_cart_url(self):
-        return reverse("core:remove-from-cart", kwargs={"slug": self.slug})
+        return core_url("remove-from-cart", slug=self.slug)
+
+    def get_remove_single_item_from_cart_url(self):
+        return core_url("remove-single-item-from-cart", slug=self.slug)
 
     def transform_to_canal(self) -> Dict[str, Any]:
         canal_json = super().transform_to_canal()
@@ -166,27 +394,266 @@ class Item(CanalModel):
     def variants_json(self) -> List[Dict[str, Any]]:
         return [self.variant_json]
 
+    def get_canal_sync_hash(self) -> str:
+        """
+        Hash of everything we send to Canal for this item, ignoring the Canal
+        ids, so it only changes when the product itself changes.
+        """
+        product_json = self.transform_to_canal()
+        product_json.pop("id", None)
+        for variant_json in product_json["variants"]:
+            variant_json.pop("id", None)
+        return hashlib.sha256(
+            json.dumps(product_json, sort_keys=True).encode()
+        ).hexdigest()
+
+    # The fields fields_from_canal_json sets
+    canal_json_fields = (
+        "added_from_canal",
+        "price",
+        "canal_variant_id",
+        "description",
+        "image",
+        "title",
+    )
+
+    @classmethod
+    def fields_from_canal_json(cls, canal_json: Dict[str, Any]) -> Dict[str, Any]:
+        # Only going to push the first variant for now cause this website doesn't support variants
+        return {
+            "added_from_canal": True,
+            "price": float(canal_json["variants"][0]["price"]),
+            "canal_variant_id": canal_json["variants"][0]["id"],
+            "description": canal_json["body_html"],
+            "image": canal_json["image_src"],
+            "title": canal_json["title"],
+        }
+
     @classmethod
     @retry(
         stop=stop_after_attempt(3),
         wait=wait_exponential(min=1, max=3),
     )
     def create_or_update_from_canal_json(cls, canal_json: Dict[str, Any]) -> "Item":
-        # Only going to push the first variant for now cause this website doesn't support variants
+        fields = cls.fields_from_canal_json(canal_json)
+        # The slug is only set on create, so product urls survive renames. A
+        # concurrent create taking the same slug is an IntegrityError, retried.
+        if not Item.objects.filter(canal_id=canal_json["id"]).exists():
+            fields["slug"] = generate_item_slugs([fields["title"]])[0]
         item, _ = Item.objects.update_or_create(
-            canal_id=canal_json["id"],
-            defaults={
-                "added_from_canal": True,
-                "price": float(canal_json["variants"][0]["price"]),
-                "canal_variant_id": canal_json["variants"][0]["id"],
-                "description": canal_json["body_html"],
-                "image": canal_json["image_src"],
-                "title": canal_json["title"],
-                "slug": canal_json["title"].lower(),
-            },
+            canal_id=canal_json["id"], defaults=fields
         )
         return item
 
+    @classmethod
+    def bulk_create_or_update_from_canal_json(
+        cls, canal_jsons: List[Dict[str, Any]]
+    ) -> List[Optional[Exception]]:
+        errors: List[Optional[Exception]] = []
+        fields_by_canal_id = {}
+        for canal_json in canal_jsons:
+            try:
+                # Later events for the same product win
+                fields_by_canal_id[canal_json["id"]] = cls.fields_from_canal_json(
+                    canal_json
+                )
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        if not fields_by_canal_id:
+            return errors
+
+        existing = {
+            item.canal_id: item
+            for item in Item.objects.filter(canal_id__in=list(fields_by_canal_id))
+        }
+        new_canal_ids = [
+            canal_id for canal_id in fields_by_canal_id if canal_id not in existing
+        ]
+        slugs = dict(
+            zip(
+                new_canal_ids,
+                generate_item_slugs(
+                    [
+                        fields_by_canal_id[canal_id]["title"]
+                        for canal_id in new_canal_ids
+                    ]
+                ),
+            )
+        )
+        now = timezone.now()
+        to_create, to_update = [], []
+        for canal_id, fields in fields_by_canal_id.items():
+            item = existing.get(canal_id)
+            if item is None:
+                to_create.append(
+                    Item(canal_id=canal_id, slug=slugs[canal_id], **fields)
+                )
+                continue
+            for name, value in fields.items():
+                setattr(item, name, value)
+            # bulk_update doesn't touch auto_now fields
+            item.updated_at = now
+            to_update.append(item)
+        try:
+            with transaction.atomic():
+                Item.objects.bulk_create(to_create, batch_size=500)
+                Item.objects.bulk_update(
+                    to_update, [*cls.canal_json_fields, "updated_at"], batch_size=500
+                )
+        except IntegrityError:
+            # e.g. a variant id that moved between products or a slug taken
+            # concurrently, find out which
+            return super().bulk_create_or_update_from_canal_json(canal_jsons)
+        # bulk writes don't send signals. Canal doesn't set categories or
+        # labels, so only the created items move the counts.
+        for facet, count in Counter(
+            (item.category, item.label) for item in to_create
+        ).items():
+            ItemFacetCount.adjust(*facet, count)
+        return errors
+
+
+SLUG_MAX_LENGTH = Item._meta.get_field("slug").max_length
+# Room left after the base slug for a "-<n>" suffix
+SLUG_BASE_MAX_LENGTH = SLUG_MAX_LENGTH - 8
+
+
+def generate_item_slugs(titles: List[str]) -> List[str]:
+    """
+    Unique slugs for new items with these titles, in order. Titles that slugify
+    to a taken slug get the first free ``-2``, ``-3``... suffix. Takes at most
+    two queries for any number of titles: one for the plain slugs and, if some
+    are taken, one for the suffixed slugs already in use.
+    """
+    bases = [
+        slugify(title)[:SLUG_BASE_MAX_LENGTH].strip("-") or "item" for title in titles
+    ]
+    taken = set(Item.objects.filter(slug__in=set(bases)).values_list("slug", flat=True))
+    seen = set()
+    colliding = set()
+    for base in bases:
+        if base in taken or base in seen:
+            colliding.add(base)
+        seen.add(base)
+    if colliding:
+        suffixed = models.Q()
+        for base in colliding:
+            suffixed |= models.Q(slug__startswith=f"{base}-")
+        taken.update(Item.objects.filter(suffixed).values_list("slug", flat=True))
+
+    slugs = []
+    next_suffix: Dict[str, int] = {}
+    for base in bases:
+        slug = base
+        if slug in taken:
+            suffix = next_suffix.get(base, 2)
+            while f"{base}-{suffix}" in taken:
+                suffix += 1
+            next_suffix[base] = suffix + 1
+            slug = f"{base}-{suffix}"
+        taken.add(slug)
+        slugs.append(slug)
+    return slugs
+
+
+@lru_cache(maxsize=4096)
+def get_item_id_for_slug(slug: str) -> UUID:
+    """
+    Primary key of the item with this slug, cached per process. Use
+    get_item_by_slug, which notices entries gone stale after a slug changed.
+    """
+    return Item.objects.values_list("id", flat=True).get(slug=slug)
+
+
+def get_item_by_slug(slug: str, queryset: Optional[models.QuerySet] = None) -> Item:
+    """
+    The item with this slug, fetched by primary key through the slug cache.
+
+    Raises Item.DoesNotExist for an unknown slug.
+    """
+    if queryset is None:
+        queryset = Item.objects.all()
+    item_id = get_item_id_for_slug(slug)
+    try:
+        return queryset.get(pk=item_id, slug=slug)
+    except Item.DoesNotExist:
+        # the cached item was renamed or deleted since, look the slug up again
+        get_item_id_for_slug.cache_clear()
+    return queryset.get(pk=get_item_id_for_slug(slug), slug=slug)
+
+
+class ItemFacetCount(models.Model):
+    """
+    Number of items per category and label. Kept up to date by the Item signal
+    receivers (and adjusted after bulk writes), so the home page can show facet
+    counts without grouping the whole catalog on every request. ``rebuild``
+    recounts them from scratch, for repairs.
+    """
+
+    category = models.CharField(max_length=2)
+    label = models.CharField(max_length=1)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["category", "label"], name="unique_item_facet_count"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.category}/{self.label}: {self.count}"
+
+    @classmethod
+    def adjust(cls, category: str, label: str, delta: int) -> None:
+        counts = cls.objects.filter(category=category, label=label)
+        if counts.update(count=models.F("count") + delta):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(category=category, label=label, count=delta)
+        except IntegrityError:
+            # created by a concurrent request since the update
+            counts.update(count=models.F("count") + delta)
+
+    @classmethod
+    def rebuild(cls) -> None:
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(
+                cls(**row)
+                for row in Item.objects.values("category", "label")
+                .annotate(count=models.Count("id"))
+                .order_by()
+            )
+
+    @classmethod
+    def get_facet_counts(
+        cls, category: Optional[str] = None, label: Optional[str] = None
+    ) -> Dict[str, List[Tuple[str, str, int]]]:
+        """
+        ``(value, name, count)`` of every category among items with ``label``,
+        and of every label among items in ``category``.
+        """
+        categories: Dict[str, int] = {}
+        labels: Dict[str, int] = {}
+        for row in cls.objects.filter(count__gt=0):
+            if label is None or row.label == label:
+                categories[row.category] = categories.get(row.category, 0) + row.count
+            if category is None or row.category == category:
+                labels[row.label] = labels.get(row.label, 0) + row.count
+        return {
+            "category": [
+                (value, name, categories.get(value, 0))
+                for value, name in CATEGORY_CHOICES
+            ],
+            "label": [
+                (value, name, labels.get(value, 0)) for value, name in LABEL_CHOICES
+            ],
+        }
+
 
 class OrderItem(CanalModel):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -198,10 +665,67 @@ class OrderItem(CanalModel):
         "item__canal_variant_id": "variant_id",
         "quantity": "quantity",
     }
+    canal_select_related = ("item",)
+
+    class Meta:
+        constraints = [
+            # An item appears once in a cart, adding it again bumps the quantity
+            models.UniqueConstraint(
+                fields=["user", "item"],
+                condition=models.Q(ordered=False),
+                name="unique_active_order_item",
+            )
+        ]
 
     def __str__(self):
         return f"{self.quantity} of {self.item.title}"
 
+    @classmethod
+    def upsert_from_canal_json(
+        cls, line_items_json: List[Dict[str, Any]], user: models.Model
+    ) -> List["OrderItem"]:
+        """
+        Creates or updates the ordered items for Canal order line items with one
+        variant lookup, one order item lookup and bulk writes, however many
+        lines the order has.
+        """
+        variant_ids = {line_item["variant_id"] for line_item in line_items_json}
+        items = {
+            item.canal_variant_id: item
+            for item in Item.objects.filter(canal_variant_id__in=variant_ids)
+        }
+        missing = variant_ids - set(items)
+        if missing:
+            raise Item.DoesNotExist(f"No items for variants {sorted(missing)}")
+        existing = {
+            order_item.canal_id: order_item
+            for order_item in OrderItem.objects.filter(
+                canal_id__in=[line_item["id"] for line_item in line_items_json]
+            )
+        }
+        now = timezone.now()
+        to_create, to_update = {}, {}
+        for line_item in line_items_json:
+            order_item = existing.get(line_item["id"])
+            if order_item is None:
+                order_item = OrderItem(canal_id=line_item["id"])
+                to_create[line_item["id"]] = order_item
+            else:
+                # bulk_update doesn't touch auto_now fields
+                order_item.updated_at = now
+                to_update[line_item["id"]] = order_item
+            order_item.item = items[line_item["variant_id"]]
+            order_item.ordered = True
+            order_item.quantity = line_item["quantity"]
+            order_item.user = user
+        OrderItem.objects.bulk_create(to_create.values(), batch_size=500)
+        OrderItem.objects.bulk_update(
+            to_update.values(),
+            ["item", "ordered", "quantity", "user", "updated_at"],
+            batch_size=500,
+        )
+        return [*to_create.values(), *to_update.values()]
+
     def get_total_item_price(self):
         return self.quantity * self.item.price
 
@@ -250,7 +774,11 @@ class Order(CanalModel):
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
 
+    _total = None
+
     internal_to_canal_mapping = {}
+    canal_select_related = ("shipping_address__user",)
+    canal_prefetch_related = ("items__item",)
 
     """
     1. Item added to cart
@@ -263,16 +791,51 @@ class Order(CanalModel):
     6. Refunds
     """
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user"],
+                condition=models.Q(ordered=False),
+                name="unique_active_cart",
+            )
+        ]
+
     def __str__(self):
         return self.user.username
 
-    def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        if self.coupon:
-            total -= self.coupon.amount
-        return total
+    def get_total(self) -> float:
+        """
+        Order total after discounts and the coupon. Uses prefetched items when
+        there are some, otherwise it's summed by the database in one query. The
+        result is memoized on the instance, so templates can call it freely.
+        """
+        if self._total is None:
+            if "items" in getattr(self, "_prefetched_objects_cache", {}):
+                total = sum(
+                    order_item.get_final_price() for order_item in self.items.all()
+                )
+            else:
+                total = (
+                    self.items.aggregate(
+                        total=models.Sum(
+                            Coalesce(
+                                NullIf("item__discount_price", models.Value(0)),
+                                "item__price",
+                            )
+                            * models.F("quantity"),
+                            output_field=models.FloatField(),
+                        )
+                    )["total"]
+                    or 0
+                )
+            if self.coupon_id is not None:
+                total -= self.coupon.amount
+            self._total = total
+        return self._total
+
+    def refresh_from_db(self, *args: Any, **kwargs: Any) -> None:
+        super().refresh_from_db(*args, **kwargs)
+        self._total = None
 
     def transform_to_canal(self) -> Dict[str, Any]:
         canal_json = super().transform_to_canal()
@@ -318,13 +881,13 @@ class Order(CanalModel):
         )
         address = None
         if "shipping_address" in canal_json:
-            address, _ = Address.objects.get_or_create(
+            address = Address.get_or_add(
+                user,
+                "B",
                 street_address=canal_json["shipping_address"]["address1"],
                 apartment_address=canal_json["shipping_address"]["address2"] or "",
                 country=canal_json["shipping_address"]["country"],
                 zip=canal_json["shipping_address"]["zip"],
-                address_type="B",
-                user=user,
             )
         order, _ = Order.objects.update_or_create(
             canal_id=canal_json["id"],
@@ -335,21 +898,132 @@ class Order(CanalModel):
                 "ordered": True,
             },
         )
-        for line_item_json in canal_json["line_items"]:
-            order_item, _ = OrderItem.objects.update_or_create(
-                canal_id=line_item_json["id"],
-                defaults={
-                    "item": Item.objects.get(
-                        canal_variant_id=line_item_json["variant_id"]
-                    ),
-                    "ordered": True,
-                    "quantity": line_item_json["quantity"],
-                    "user": user,
-                },
-            )
-            order.items.add(order_item)
+        order.items.add(
+            *OrderItem.upsert_from_canal_json(canal_json["line_items"], user)
+        )
         return order
 
+    @classmethod
+    def bulk_create_or_update_from_canal_json(
+        cls, canal_jsons: List[Dict[str, Any]]
+    ) -> List[Optional[Exception]]:
+        """
+        Applies order webhooks with one lookup each for the addresses, orders,
+        variants and order items and bulk writes, however many orders and lines
+        the batch has. If any order can't be applied, each is retried on its
+        own to find out which.
+        """
+        try:
+            with transaction.atomic():
+                cls._bulk_create_or_update_from_canal_json(canal_jsons)
+        except Exception:
+            return super().bulk_create_or_update_from_canal_json(canal_jsons)
+        return [None] * len(canal_jsons)
+
+    @classmethod
+    def _bulk_create_or_update_from_canal_json(
+        cls, canal_jsons: List[Dict[str, Any]]
+    ) -> None:
+        # Placeholder rn, as in create_or_update_from_canal_json
+        user = apps.get_model(*settings.AUTH_USER_MODEL.split(".")).objects.get(
+            email="simon.xie@shopcanal.com"
+        )
+        # Later events for the same order win, their line items add up
+        latest: Dict[str, Dict[str, Any]] = {}
+        line_items_json: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for canal_json in canal_jsons:
+            latest[canal_json["id"]] = canal_json
+            line_items_json[canal_json["id"]].extend(canal_json["line_items"])
+
+        address_fields = {}
+        shipping_fingerprints: Dict[str, Optional[str]] = {}
+        for canal_id, canal_json in latest.items():
+            shipping_fingerprints[canal_id] = None
+            if "shipping_address" in canal_json:
+                fields = {
+                    "address_type": "B",
+                    "street_address": canal_json["shipping_address"]["address1"],
+                    "apartment_address": canal_json["shipping_address"]["address2"]
+                    or "",
+                    "country": canal_json["shipping_address"]["country"],
+                    "zip": canal_json["shipping_address"]["zip"],
+                }
+                fingerprint = address_fingerprint(**fields)
+                address_fields[fingerprint] = fields
+                shipping_fingerprints[canal_id] = fingerprint
+        addresses = {}
+        if address_fields:
+            addresses = {
+                address.fingerprint: address
+                for address in Address.objects.filter(
+                    user=user, fingerprint__in=list(address_fields)
+                )
+            }
+            new_fingerprints = [fp for fp in address_fields if fp not in addresses]
+            if new_fingerprints:
+                Address.objects.bulk_create(
+                    Address(user=user, fingerprint=fp, **address_fields[fp])
+                    for fp in new_fingerprints
+                )
+                # bulk_create only sets integer primary keys on some databases
+                addresses.update(
+                    (address.fingerprint, address)
+                    for address in Address.objects.filter(
+                        user=user, fingerprint__in=new_fingerprints
+                    )
+                )
+
+        existing = {
+            order.canal_id: order
+            for order in Order.objects.filter(canal_id__in=list(latest))
+        }
+        now = timezone.now()
+        orders, to_create, to_update = {}, [], []
+        for canal_id, fingerprint in shipping_fingerprints.items():
+            order = existing.get(canal_id)
+            if order is None:
+                order = Order(canal_id=canal_id)
+                to_create.append(order)
+            else:
+                # bulk_update doesn't touch auto_now fields
+                order.updated_at = now
+                to_update.append(order)
+            order.shipping_address = addresses.get(fingerprint)
+            order.ordered_date = now
+            order.user = user
+            order.ordered = True
+            orders[canal_id] = order
+        Order.objects.bulk_create(to_create, batch_size=500)
+        Order.objects.bulk_update(
+            to_update,
+            ["shipping_address", "ordered_date", "user", "ordered", "updated_at"],
+            batch_size=500,
+        )
+
+        order_items = {
+            order_item.canal_id: order_item
+            for order_item in OrderItem.upsert_from_canal_json(
+                [
+                    line_item
+                    for lines in line_items_json.values()
+                    for line_item in lines
+                ],
+                user,
+            )
+        }
+        Order.items.through.objects.bulk_create(
+            [
+                Order.items.through(
+                    order_id=orders[canal_id].id,
+                    orderitem_id=order_items[line_item["id"]].id,
+                )
+                for canal_id, lines in line_items_json.items()
+                for line_item in lines
+            ],
+            batch_size=500,
+            ignore_conflicts=True,
+        )
+
     def fulfill(self) -> "Fulfillment":
         tracking_number = randint(1000000000, 9999999999)
         fulfillment = Fulfillment.objects.create(
@@ -362,26 +1036,100 @@ class Order(CanalModel):
             tracking_number=str(tracking_number),
             tracking_url=f"https://www.ups.com/track?loc=en_US&tracknum={tracking_number}",
         )
-        for order_item in self.items.all():
-            FulfillmentLineItem.objects.create(
+        FulfillmentLineItem.objects.bulk_create(
+            FulfillmentLineItem(
                 fulfillment=fulfillment,
                 order_item=order_item,
                 quantity=order_item.quantity,
             )
-        create_fulfillment_url = os.path.join(
-            settings.SHOPCANAL_API_BASE_URL, "fulfillments/"
+            for order_item in self.items.all()
         )
-        response = requests.post(
-            create_fulfillment_url,
-            json=fulfillment.transform_to_canal(),
-            headers=SHOPCANAL_DEFAULT_HEADERS,
+        fulfillment = Fulfillment.objects.for_canal().get(id=fulfillment.id)
+        response_json = get_canal_client().create_fulfillment(
+            fulfillment.transform_to_canal()
         )
-        raise_response_status(response)
-        fulfillment.canal_id = response.json()["id"]
+        fulfillment.canal_id = response_json["id"]
         fulfillment.save()
 
 
+# Canal id -> order primary key, see get_order_id_for_canal_id
+_order_ids_by_canal_id: Dict[str, UUID] = {}
+ORDER_ID_CACHE_SIZE = 4096
+
+
+def get_order_id_for_canal_id(canal_id: str) -> UUID:
+    """
+    Primary key of the order with this Canal id, cached per process. An id
+    read inside a transaction is only cached once it commits, so an order that
+    is rolled back never is. Use get_order_by_canal_id, which notices entries
+    gone stale after the order was deleted by another process.
+    """
+    order_id = _order_ids_by_canal_id.get(canal_id)
+    if order_id is None:
+        order_id = Order.objects.values_list("id", flat=True).get(canal_id=canal_id)
+        transaction.on_commit(lambda: cache_order_id(canal_id, order_id))
+    return order_id
+
+
+def cache_order_id(canal_id: str, order_id: UUID) -> None:
+    if len(_order_ids_by_canal_id) >= ORDER_ID_CACHE_SIZE:
+        _order_ids_by_canal_id.clear()
+    _order_ids_by_canal_id[canal_id] = order_id
+
+
+def forget_order_id(canal_id: Optional[str] = None) -> None:
+    """
+    Drops the cached id of the order with this Canal id, or every cached id.
+    """
+    if canal_id is None:
+        _order_ids_by_canal_id.clear()
+    else:
+        _order_ids_by_canal_id.pop(canal_id, None)
+
+
+def get_order_by_canal_id(
+    canal_id: str, queryset: Optional[models.QuerySet] = None
+) -> Order:
+    """
+    The order with this Canal id, fetched by primary key through the id cache.
+
+    Raises Order.DoesNotExist for an unknown Canal id.
+    """
+    if queryset is None:
+        queryset = Order.objects.all()
+    try:
+        return queryset.get(pk=get_order_id_for_canal_id(canal_id), canal_id=canal_id)
+    except Order.DoesNotExist:
+        # the cached order was deleted since, look the Canal id up again
+        forget_order_id(canal_id)
+    return queryset.get(pk=get_order_id_for_canal_id(canal_id), canal_id=canal_id)
+
+
+def address_fingerprint(
+    address_type: str,
+    street_address: str,
+    apartment_address: str,
+    country: Any,
+    zip: str,
+) -> str:
+    """
+    Hash of an address with case and whitespace differences ignored, so the
+    same address typed twice has the same fingerprint.
+    """
+    parts = [address_type, street_address, apartment_address, str(country), zip]
+    normalized = "\x1f".join(
+        " ".join((part or "").split()).casefold() for part in parts
+    )
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
 class Address(models.Model):
+    """
+    An entry in a user's address book. Addresses are unique per user by their
+    fingerprint, and checkout reuses an existing entry instead of adding a copy.
+    A user has at most one default address of each type.
+    """
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     street_address = models.CharField(max_length=100)
     apartment_address = models.CharField(max_length=100)
@@ -389,21 +1137,100 @@ class Address(models.Model):
     zip = models.CharField(max_length=100)
     address_type = models.CharField(max_length=1, choices=ADDRESS_CHOICES)
     default = models.BooleanField(default=False)
+    fingerprint = models.CharField(max_length=64, editable=False)
 
     def __str__(self):
         return self.user.username
 
     class Meta:
         verbose_name_plural = "Addresses"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "fingerprint"], name="unique_address_fingerprint"
+            ),
+            # also the index get_defaults reads
+            models.UniqueConstraint(
+                fields=["user", "address_type"],
+                condition=models.Q(default=True),
+                name="unique_default_address",
+            ),
+        ]
+
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        self.fingerprint = address_fingerprint(
+            self.address_type,
+            self.street_address,
+            self.apartment_address,
+            self.country,
+            self.zip,
+        )
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def get_defaults(cls, user: models.Model) -> Dict[str, "Address"]:
+        """
+        The user's default addresses by address type, in one query.
+        """
+        return {
+            address.address_type: address
+            for address in cls.objects.filter(user=user, default=True)
+        }
+
+    @classmethod
+    def get_or_add(
+        cls,
+        user: models.Model,
+        address_type: str,
+        street_address: str,
+        apartment_address: str,
+        country: Any,
+        zip: str,
+        default: bool = False,
+    ) -> "Address":
+        """
+        The user's address book entry for this address, added if it's new, and
+        made their default of its type if ``default``. Takes one query for a
+        known address and at most three writes.
+        """
+        fingerprint = address_fingerprint(
+            address_type, street_address, apartment_address, country, zip
+        )
+        address = cls.objects.filter(user=user, fingerprint=fingerprint).first()
+        if address is None:
+            try:
+                with transaction.atomic():
+                    address = cls.objects.create(
+                        user=user,
+                        address_type=address_type,
+                        street_address=street_address,
+                        apartment_address=apartment_address or "",
+                        country=country,
+                        zip=zip,
+                    )
+            except IntegrityError:
+                # added by a concurrent request since the lookup
+                address = cls.objects.get(user=user, fingerprint=fingerprint)
+        if default and not address.default:
+            with transaction.atomic():
+                cls.objects.filter(
+                    user=user, address_type=address_type, default=True
+                ).update(default=False)
+                cls.objects.filter(pk=address.pk).update(default=True)
+            address.default = True
+        return address
 
 
 class Payment(models.Model):
+    # Empty while the charge is being made, see core.payments.claim_payment
     stripe_charge_id = models.CharField(max_length=50)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True, null=True
     )
     amount = models.FloatField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Identifies the submission that made the payment, and is passed on to the
+    # gateway, so a submission is only charged once
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True)
 
     def __str__(self):
         return self.user.username
@@ -456,6 +1283,8 @@ class Fulfillment(CanalModel):
         "tracking_number": (lambda x: [x], "tracking_numbers"),
         "tracking_url": (lambda x: [x], "tracking_urls"),
     }
+    canal_select_related = ("order",)
+    canal_prefetch_related = ("fulfillmentlineitem_set__order_item",)
     name = models.CharField(max_length=100)
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     status = models.CharField(choices=FULFILLMENT_STATUSES, max_length=100)
@@ -478,11 +1307,24 @@ class Fulfillment(CanalModel):
 
     @classmethod
     def create_or_update_from_canal_json(cls, canal_json: Dict[str, Any]) -> CanalModel:
+        line_items_json = canal_json.get("line_items", [])
+        order_item_ids = dict(
+            OrderItem.objects.filter(
+                canal_id__in=[line_item["id"] for line_item in line_items_json]
+            ).values_list("canal_id", "id")
+        )
+        missing = {line_item["id"] for line_item in line_items_json} - set(
+            order_item_ids
+        )
+        if missing:
+            raise OrderItem.DoesNotExist(f"No order items {sorted(missing)}")
         f, _ = Fulfillment.objects.update_or_create(
             canal_id=canal_json["id"],
             defaults={
                 "name": canal_json["name"],
-                "order": Order.objects.get(canal_id=canal_json["order_id"]),
+                "order": get_order_by_canal_id(
+                    canal_json["order_id"], Order.objects.only("id")
+                ),
                 "status": canal_json["status"],
                 "shipment_status": canal_json["shipment_status"],
                 "service": canal_json["service"],
@@ -491,13 +1333,146 @@ class Fulfillment(CanalModel):
                 "tracking_url": canal_json["tracking_urls"][0],
             },
         )
-        for line_item_json in canal_json.get("line_items", []):
-            order_item = OrderItem.objects.get(canal_id=line_item_json["id"])
-            FulfillmentLineItem.objects.update_or_create(
-                order_item=order_item,
-                fulfillment=f,
-                defaults={"quantity": line_item_json["quantity"]},
+        existing = {
+            line_item.order_item_id: line_item
+            for line_item in f.fulfillmentlineitem_set.all()
+        }
+        now = timezone.now()
+        to_create, to_update = [], []
+        for line_item_json in line_items_json:
+            order_item_id = order_item_ids[line_item_json["id"]]
+            line_item = existing.get(order_item_id)
+            if line_item is None:
+                to_create.append(
+                    FulfillmentLineItem(
+                        fulfillment=f,
+                        order_item_id=order_item_id,
+                        quantity=line_item_json["quantity"],
+                    )
+                )
+            else:
+                line_item.quantity = line_item_json["quantity"]
+                # bulk_update doesn't touch auto_now fields
+                line_item.updated_at = now
+                to_update.append(line_item)
+        FulfillmentLineItem.objects.bulk_create(to_create, batch_size=500)
+        FulfillmentLineItem.objects.bulk_update(
+            to_update, ["quantity", "updated_at"], batch_size=500
+        )
+        return f
+
+    @classmethod
+    def bulk_create_or_update_from_canal_json(
+        cls, canal_jsons: List[Dict[str, Any]]
+    ) -> List[Optional[Exception]]:
+        """
+        Applies fulfillment webhooks with one lookup each for the orders, order
+        items, fulfillments and their line items and bulk writes, however many
+        fulfillments and lines the batch has. If any fulfillment can't be
+        applied, each is retried on its own to find out which.
+        """
+        try:
+            with transaction.atomic():
+                cls._bulk_create_or_update_from_canal_json(canal_jsons)
+        except Exception:
+            return super().bulk_create_or_update_from_canal_json(canal_jsons)
+        return [None] * len(canal_jsons)
+
+    @classmethod
+    def _bulk_create_or_update_from_canal_json(
+        cls, canal_jsons: List[Dict[str, Any]]
+    ) -> None:
+        # Later events for the same fulfillment win, their line items add up
+        latest: Dict[str, Dict[str, Any]] = {}
+        line_items_json: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for canal_json in canal_jsons:
+            latest[canal_json["id"]] = canal_json
+            line_items_json[canal_json["id"]].extend(canal_json.get("line_items", []))
+
+        order_canal_ids = {canal_json["order_id"] for canal_json in latest.values()}
+        order_ids = dict(
+            Order.objects.filter(canal_id__in=order_canal_ids).values_list(
+                "canal_id", "id"
             )
+        )
+        missing = order_canal_ids - set(order_ids)
+        if missing:
+            raise Order.DoesNotExist(f"No orders {sorted(missing)}")
+        order_item_canal_ids = {
+            line_item["id"] for lines in line_items_json.values() for line_item in lines
+        }
+        order_item_ids = dict(
+            OrderItem.objects.filter(canal_id__in=order_item_canal_ids).values_list(
+                "canal_id", "id"
+            )
+        )
+        missing = order_item_canal_ids - set(order_item_ids)
+        if missing:
+            raise OrderItem.DoesNotExist(f"No order items {sorted(missing)}")
+
+        existing = {
+            f.canal_id: f for f in Fulfillment.objects.filter(canal_id__in=list(latest))
+        }
+        now = timezone.now()
+        fulfillments, to_create, to_update = {}, [], []
+        for canal_id, canal_json in latest.items():
+            f = existing.get(canal_id)
+            if f is None:
+                f = Fulfillment(canal_id=canal_id)
+                to_create.append(f)
+            else:
+                # bulk_update doesn't touch auto_now fields
+                f.updated_at = now
+                to_update.append(f)
+            f.name = canal_json["name"]
+            f.order_id = order_ids[canal_json["order_id"]]
+            f.status = canal_json["status"]
+            f.shipment_status = canal_json["shipment_status"]
+            f.service = canal_json["service"]
+            f.tracking_company = canal_json["tracking_company"]
+            f.tracking_number = canal_json["tracking_numbers"][0]
+            f.tracking_url = canal_json["tracking_urls"][0]
+            fulfillments[canal_id] = f
+        Fulfillment.objects.bulk_create(to_create, batch_size=500)
+        Fulfillment.objects.bulk_update(
+            to_update,
+            [
+                "name",
+                "order_id",
+                "status",
+                "shipment_status",
+                "service",
+                "tracking_company",
+                "tracking_number",
+                "tracking_url",
+                "updated_at",
+            ],
+            batch_size=500,
+        )
+
+        existing_lines = {
+            (line_item.fulfillment_id, line_item.order_item_id): line_item
+            for line_item in FulfillmentLineItem.objects.filter(
+                fulfillment__in=[f.id for f in to_update]
+            )
+        }
+        new_lines, updated_lines = {}, {}
+        for canal_id, lines in line_items_json.items():
+            f = fulfillments[canal_id]
+            for line_item_json in lines:
+                key = (f.id, order_item_ids[line_item_json["id"]])
+                line_item = existing_lines.get(key) or new_lines.get(key)
+                if line_item is None:
+                    line_item = FulfillmentLineItem(fulfillment=f, order_item_id=key[1])
+                    new_lines[key] = line_item
+                elif key in existing_lines:
+                    line_item.updated_at = now
+                    updated_lines[key] = line_item
+                line_item.quantity = line_item_json["quantity"]
+        FulfillmentLineItem.objects.bulk_create(new_lines.values(), batch_size=500)
+        FulfillmentLineItem.objects.bulk_update(
+            updated_lines.values(), ["quantity", "updated_at"], batch_size=500
+        )
 
 
 class FulfillmentLineItem(BaseModel):
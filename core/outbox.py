@@ -0,0 +1,84 @@
+from operator import attrgetter
+from typing import Callable, Dict
+
+from core import queue
+from core.canal_client import get_canal_client
+from core.models import CanalOutboxEntry, Item, Order, OrderItem
+
+OUTBOX_TOPIC_HANDLERS: Dict[str, Callable[[CanalOutboxEntry], None]] = {}
+
+
+def register_outbox_handler(topic: str) -> Callable:
+    def decorator(f: Callable[[CanalOutboxEntry], None]) -> Callable:
+        OUTBOX_TOPIC_HANDLERS[topic] = f
+        return f
+
+    return decorator
+
+
+def push_item_to_canal(item: Item) -> None:
+    """
+    Creates or updates the item's product and variant in Canal and records what
+    was sent in ``canal_synced_hash``.
+    """
+    client = get_canal_client()
+    sync_hash = item.get_canal_sync_hash()
+    if item.canal_id is None:
+        response_json = client.create_product(item.transform_to_canal())
+        Item.objects.filter(id=item.id).update(
+            canal_id=response_json["id"],
+            canal_variant_id=response_json["variants"][0]["id"],
+            canal_synced_hash=sync_hash,
+        )
+    else:
+        client.update_product(item.canal_id, item.transform_to_canal())
+        if item.canal_variant_id is not None:
+            client.update_variant(item.canal_variant_id, item.variant_json)
+        Item.objects.filter(id=item.id).update(canal_synced_hash=sync_hash)
+
+
+@register_outbox_handler("product/upsert")
+def push_item(entry: CanalOutboxEntry) -> None:
+    item = Item.objects.filter(id=entry.object_id).first()
+    if item is None or item.added_from_canal:
+        return
+    push_item_to_canal(item)
+
+
+@register_outbox_handler("product/delete")
+def delete_item(entry: CanalOutboxEntry) -> None:
+    get_canal_client().delete_product(entry.canal_id)
+
+
+@register_outbox_handler("order/create")
+def push_order(entry: CanalOutboxEntry) -> None:
+    order = Order.objects.for_canal().filter(id=entry.object_id).first()
+    if order is None or not order.ordered or order.canal_id is not None:
+        return
+    response_json = get_canal_client().create_order(order.transform_to_canal())
+    Order.objects.filter(id=order.id).update(canal_id=response_json["id"])
+    order_items = {
+        order_item.item.canal_variant_id: order_item for order_item in order.items.all()
+    }
+    for line_item in response_json["line_items"]:
+        if line_item["variant_id"] in order_items:
+            order_items[line_item["variant_id"]].canal_id = line_item["id"]
+    OrderItem.objects.bulk_update(order_items.values(), ["canal_id"])
+
+
+def process_outbox_entry(entry: CanalOutboxEntry) -> None:
+    OUTBOX_TOPIC_HANDLERS[entry.topic](entry)
+
+
+def drain(workers: int = 4, batch_size: int = 100) -> int:
+    """
+    Sends due outbox entries until none are left and returns how many were
+    sent. Entries for the same object are sent in order.
+    """
+    return queue.drain(
+        CanalOutboxEntry,
+        process_outbox_entry,
+        group_key=attrgetter("object_id"),
+        workers=workers,
+        batch_size=batch_size,
+    )
@@ -0,0 +1,102 @@
+import hashlib
+from datetime import datetime
+from functools import wraps
+from typing import Callable, Optional
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.db.models import Max
+from django.http import HttpRequest, HttpResponse
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from core.models import Item
+
+# Catalog pages only change when an item does, so their rendered HTML is cached
+# keyed on the newest Item.updated_at. The user's part of the navbar (login
+# links or the cart badge) is rendered as a placeholder in the cached body and
+# filled in on each request.
+NAVBAR_USER_PLACEHOLDER = "<!-- navbar-user -->"
+
+CATALOG_DELETED_AT_KEY = "catalog-deleted-at"
+
+
+def touch_catalog() -> None:
+    """
+    Records that an item was deleted, which the newest updated_at can't show.
+    """
+    cache.set(CATALOG_DELETED_AT_KEY, timezone.now(), None)
+
+
+def get_catalog_last_modified() -> Optional[datetime]:
+    last_modified = Item.objects.aggregate(last_modified=Max("updated_at"))[
+        "last_modified"
+    ]
+    deleted_at = cache.get(CATALOG_DELETED_AT_KEY)
+    if deleted_at is not None and (last_modified is None or deleted_at > last_modified):
+        return deleted_at
+    return last_modified
+
+
+def cache_catalog_page(view: Callable) -> Callable:
+    """
+    Serves GETs of a catalog view from the page cache. Anonymous visitors also
+    get ETag and Last-Modified headers, and a 304 when their copy is current.
+    Requests with messages waiting to be shown are always rendered.
+    """
+
+    @wraps(view)
+    def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        timeout = settings.CATALOG_PAGE_CACHE_TIMEOUT
+        if (
+            not timeout
+            or request.method != "GET"
+            or len(messages.get_messages(request))
+        ):
+            return view(request, *args, **kwargs)
+
+        last_modified = get_catalog_last_modified()
+        version = last_modified.isoformat() if last_modified else ""
+        digest = hashlib.md5(
+            f"{request.get_full_path()}|{version}".encode()
+        ).hexdigest()
+        anonymous = not request.user.is_authenticated
+        if anonymous:
+            response = get_conditional_response(
+                request,
+                etag=quote_etag(digest),
+                last_modified=last_modified and int(last_modified.timestamp()),
+            )
+            if response is not None:
+                return response
+
+        key = f"catalog-page:{digest}"
+        body = cache.get(key)
+        if body is None:
+            request.punch_navbar = True
+            response = view(request, *args, **kwargs)
+            if hasattr(response, "render"):
+                response.render()
+            body = response.content.decode(response.charset)
+            if response.status_code == 200:
+                cache.set(key, body, timeout)
+        else:
+            response = HttpResponse()
+
+        response.content = body.replace(
+            NAVBAR_USER_PLACEHOLDER,
+            render_to_string("navbar_user.html", request=request),
+        )
+        if anonymous:
+            response["ETag"] = quote_etag(digest)
+            if last_modified is not None:
+                response["Last-Modified"] = http_date(last_modified.timestamp())
+            patch_cache_control(response, no_cache=True)
+        else:
+            patch_cache_control(response, private=True)
+        return response
+
+    return wrapper
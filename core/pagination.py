@@ -0,0 +1,104 @@
+import base64
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+from uuid import UUID
+
+from django.db import models
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+# Keyset ("cursor") pagination over (created_at, id), newest first. A page is
+# fetched with a WHERE on the last row of the previous page instead of an
+# OFFSET, and no COUNT(*) is run, so every page costs one indexed range scan
+# however deep it is.
+
+
+def encode_cursor(obj: models.Model) -> str:
+    key = json.dumps([obj.created_at.isoformat(), str(obj.pk)])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    try:
+        created_at, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        created_at, pk = parse_datetime(created_at), UUID(pk)
+    except (AttributeError, TypeError, ValueError):
+        created_at = None
+    if created_at is None:
+        raise Http404("Invalid cursor")
+    return created_at, pk
+
+
+class CursorPage:
+    """
+    A page of a keyset paginated queryset, with the cursors of the pages either
+    side of it.
+    """
+
+    def __init__(
+        self,
+        object_list: List[models.Model],
+        has_next: bool,
+        has_previous: bool,
+    ):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self) -> int:
+        return len(self.object_list)
+
+    def has_next(self) -> bool:
+        return self._has_next
+
+    def has_previous(self) -> bool:
+        return self._has_previous
+
+    def has_other_pages(self) -> bool:
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        return encode_cursor(self.object_list[-1]) if self._has_next else None
+
+    @property
+    def previous_cursor(self) -> Optional[str]:
+        return encode_cursor(self.object_list[0]) if self._has_previous else None
+
+
+def paginate_by_cursor(
+    queryset: models.QuerySet,
+    per_page: int,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+) -> CursorPage:
+    """
+    Returns the ``per_page`` rows of ``queryset`` following the ``after`` cursor,
+    or preceding the ``before`` cursor, or the first page if neither is given.
+    """
+    if before:
+        created_at, pk = decode_cursor(before)
+        rows = list(
+            queryset.filter(
+                models.Q(created_at__gt=created_at)
+                | models.Q(created_at=created_at, pk__gt=pk)
+            ).order_by("created_at", "pk")[: per_page + 1]
+        )
+        if rows:
+            has_previous = len(rows) > per_page
+            return CursorPage(rows[:per_page][::-1], True, has_previous)
+        # nothing newer than the cursor any more, start from the top
+        after = None
+
+    if after:
+        created_at, pk = decode_cursor(after)
+        queryset = queryset.filter(
+            models.Q(created_at__lt=created_at)
+            | models.Q(created_at=created_at, pk__lt=pk)
+        )
+    rows = list(queryset.order_by("-created_at", "-pk")[: per_page + 1])
+    return CursorPage(rows[:per_page], len(rows) > per_page, bool(after))
@@ -0,0 +1,315 @@
+import hashlib
+import itertools
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import stripe
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from core.models import Order, Payment
+
+# A card as the payment pages use it: {"id", "last4", "exp_month", "exp_year"}
+Card = Dict[str, Any]
+
+# UserProfile fields get_default_card caches the card in
+DEFAULT_CARD_FIELDS = [
+    "default_card_id",
+    "default_card_last4",
+    "default_card_exp_month",
+    "default_card_exp_year",
+    "default_card_checked_at",
+]
+
+
+class PaymentGateway(ABC):
+    """
+    The card payment calls the shop makes. Errors are raised as
+    ``stripe.error.StripeError`` subclasses whichever gateway is used, so
+    callers handle them one way.
+    """
+
+    @abstractmethod
+    def create_customer(self, email: str) -> str:
+        """
+        Creates a customer for ``email`` and returns its id.
+        """
+
+    @abstractmethod
+    def add_card(self, customer_id: str, token: str) -> Card:
+        """
+        Saves the card ``token`` stands for to the customer and returns it.
+        """
+
+    @abstractmethod
+    def get_default_card(self, customer_id: str) -> Optional[Card]:
+        """
+        The customer's default card, or None if they have no card.
+        """
+
+    @abstractmethod
+    def charge(
+        self,
+        amount: int,
+        currency: str = "usd",
+        customer_id: Optional[str] = None,
+        token: Optional[str] = None,
+        idempotency_key: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Charges ``amount`` cents to the customer's default card, or once to
+        the card ``token`` stands for. Repeating a call with the same
+        ``idempotency_key`` returns the first call's result without charging
+        again.
+        """
+
+
+def card_from_stripe(source: Dict[str, Any]) -> Card:
+    return {
+        "id": source["id"],
+        "last4": source["last4"],
+        "exp_month": source["exp_month"],
+        "exp_year": source["exp_year"],
+    }
+
+
+class StripeGateway(PaymentGateway):
+    def __init__(self, api_key: Optional[str] = None):
+        self.api_key = api_key or settings.STRIPE_SECRET_KEY
+
+    def create_customer(self, email: str) -> str:
+        return stripe.Customer.create(email=email, api_key=self.api_key)["id"]
+
+    def add_card(self, customer_id: str, token: str) -> Card:
+        # straight to the nested endpoint, without retrieving the customer first
+        return card_from_stripe(
+            stripe.Customer.create_source(
+                customer_id, source=token, api_key=self.api_key
+            )
+        )
+
+    def get_default_card(self, customer_id: str) -> Optional[Card]:
+        cards = stripe.Customer.list_sources(
+            customer_id, limit=1, object="card", api_key=self.api_key
+        )["data"]
+        return card_from_stripe(cards[0]) if cards else None
+
+    def charge(
+        self,
+        amount: int,
+        currency: str = "usd",
+        customer_id: Optional[str] = None,
+        token: Optional[str] = None,
+        idempotency_key: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        if customer_id is not None:
+            params = {"customer": customer_id}
+        else:
+            params = {"source": token}
+        return stripe.Charge.create(
+            amount=amount,
+            currency=currency,
+            api_key=self.api_key,
+            idempotency_key=idempotency_key,
+            **params,
+        )
+
+
+# Stripe's test token for a declined card
+DECLINED_TOKEN = "tok_chargeDeclined"
+
+
+class FakeGateway(PaymentGateway):
+    """
+    An in-memory gateway for tests and benchmarks. Every call is recorded in
+    ``calls`` and can be made to take ``latency`` seconds, like a round trip.
+    Charging ``DECLINED_TOKEN`` raises a ``CardError``.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: List[Tuple[str, Tuple[Any, ...]]] = []
+        self.cards: Dict[str, List[Card]] = {}
+        self.charges: List[Dict[str, Any]] = []
+        self.idempotent_results: Dict[str, Dict[str, Any]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _call(self, name: str, *args: Any) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls.append((name, args))
+            return str(next(self._ids))
+
+    def create_customer(self, email: str) -> str:
+        customer_id = f"cus_fake{self._call('create_customer', email)}"
+        self.cards[customer_id] = []
+        return customer_id
+
+    def add_card(self, customer_id: str, token: str) -> Card:
+        n = self._call("add_card", customer_id, token)
+        card = {
+            "id": f"card_fake{n}",
+            "last4": "4242",
+            "exp_month": 12,
+            "exp_year": 2030,
+        }
+        self.cards.setdefault(customer_id, []).append(card)
+        return card
+
+    def get_default_card(self, customer_id: str) -> Optional[Card]:
+        self._call("get_default_card", customer_id)
+        cards = self.cards.get(customer_id)
+        return cards[0] if cards else None
+
+    def charge(
+        self,
+        amount: int,
+        currency: str = "usd",
+        customer_id: Optional[str] = None,
+        token: Optional[str] = None,
+        idempotency_key: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        n = self._call("charge", amount, currency, customer_id, token)
+        if idempotency_key in self.idempotent_results:
+            return self.idempotent_results[idempotency_key]
+        if token == DECLINED_TOKEN:
+            raise stripe.error.CardError(
+                "Your card was declined.",
+                None,
+                "card_declined",
+                json_body={"error": {"message": "Your card was declined."}},
+            )
+        charge = {"id": f"ch_fake{n}", "amount": amount, "currency": currency}
+        self.charges.append(charge)
+        if idempotency_key is not None:
+            self.idempotent_results[idempotency_key] = charge
+        return charge
+
+
+@lru_cache(maxsize=None)
+def get_payment_gateway() -> PaymentGateway:
+    """
+    Returns the process wide instance of the ``PAYMENT_GATEWAY`` class.
+    """
+    return import_string(settings.PAYMENT_GATEWAY)()
+
+
+def clear_payment_gateway(*, setting: str, **kwargs: Any) -> None:
+    if setting == "PAYMENT_GATEWAY":
+        get_payment_gateway.cache_clear()
+
+
+setting_changed.connect(clear_payment_gateway)
+
+
+def get_default_card(userprofile: Any) -> Optional[Card]:
+    """
+    The customer's default card, as cached on their profile. The gateway is
+    only asked once ``PAYMENT_CARD_CACHE_TIMEOUT`` seconds have passed since
+    the card was last looked up or saved.
+    """
+    if not userprofile.stripe_customer_id:
+        return None
+    checked_at = userprofile.default_card_checked_at
+    if checked_at is None or timezone.now() - checked_at > timedelta(
+        seconds=settings.PAYMENT_CARD_CACHE_TIMEOUT
+    ):
+        set_default_card(
+            userprofile,
+            get_payment_gateway().get_default_card(userprofile.stripe_customer_id),
+        )
+    if not userprofile.default_card_id:
+        return None
+    return {
+        "id": userprofile.default_card_id,
+        "last4": userprofile.default_card_last4,
+        "exp_month": userprofile.default_card_exp_month,
+        "exp_year": userprofile.default_card_exp_year,
+    }
+
+
+def set_default_card(userprofile: Any, card: Optional[Card]) -> None:
+    """
+    Caches the customer's default card (None for no card) on their profile.
+    """
+    card = card or {}
+    userprofile.default_card_id = card.get("id", "")
+    userprofile.default_card_last4 = card.get("last4", "")
+    userprofile.default_card_exp_month = card.get("exp_month")
+    userprofile.default_card_exp_year = card.get("exp_year")
+    userprofile.default_card_checked_at = timezone.now()
+    userprofile.save(update_fields=DEFAULT_CARD_FIELDS)
+
+
+def forget_default_card(userprofile: Any) -> None:
+    """
+    Makes the next get_default_card ask the gateway again.
+    """
+    userprofile.default_card_checked_at = None
+    userprofile.save(update_fields=["default_card_checked_at"])
+
+
+def payment_idempotency_key(order: Order, amount: int) -> str:
+    """
+    Key identifying the payment of ``amount`` cents for the order. Every
+    submission for the order shares it, whichever card it's made with, so only
+    one can charge; a changed cart gives a new key.
+    """
+    return hashlib.sha256(f"{order.pk}:{amount}".encode()).hexdigest()
+
+
+def charge_idempotency_key(payment: Payment) -> str:
+    """
+    Key the gateway is asked to charge a claimed payment with. A released claim
+    is claimed again as a new Payment row, so a retry with another card after
+    a decline isn't answered with the declined charge; a taken over claim keeps
+    its row and so gets the first charge back.
+    """
+    return f"{payment.idempotency_key}:{payment.pk}"
+
+
+def claim_payment(user: Any, amount: float, key: str) -> Tuple[Payment, bool]:
+    """
+    Records that the payment ``key`` identifies is being made, and returns it
+    with whether this call claimed it. A payment already claimed by another
+    request is returned unclaimed, with its charge id once it's been charged.
+
+    A claim that's gone ``PAYMENT_CLAIM_TIMEOUT`` seconds without a charge is
+    taken over, as its request must have died. That's safe even if the charge
+    went through, as the gateway returns the same charge for the same key.
+    """
+    try:
+        with transaction.atomic():
+            payment = Payment.objects.create(
+                idempotency_key=key, user=user, amount=amount, stripe_charge_id=""
+            )
+        return payment, True
+    except IntegrityError:
+        payment = Payment.objects.get(idempotency_key=key)
+    now = timezone.now()
+    if not payment.stripe_charge_id and payment.timestamp < now - timedelta(
+        seconds=settings.PAYMENT_CLAIM_TIMEOUT
+    ):
+        taken_over = Payment.objects.filter(
+            pk=payment.pk, stripe_charge_id="", timestamp=payment.timestamp
+        ).update(timestamp=now)
+        if taken_over:
+            payment.timestamp = now
+            return payment, True
+    return payment, False
+
+
+def release_payment(payment: Payment) -> None:
+    """
+    Drops the claim on a payment that wasn't charged, so it can be retried.
+    """
+    Payment.objects.filter(pk=payment.pk, stripe_charge_id="").delete()
@@ -0,0 +1,172 @@
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from typing import Any, Callable, List, Type
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.canal_client import get_canal_client
+
+# Queue tables (the Canal outbox and webhook inbox) share these columns:
+# status, attempts, last_error and available_at.
+
+
+def claim_entries(model: Type[models.Model], batch_size: int) -> List[models.Model]:
+    """
+    Marks up to ``batch_size`` due entries as running and returns them, oldest
+    first. A running entry is leased to its worker for ``CANAL_QUEUE_LEASE``
+    seconds (its available_at), after which it's taken to have died with the
+    entry and the entry is claimed again.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            model.objects.select_for_update(skip_locked=True)
+            .filter(status__in=["P", "R"], available_at__lte=now)
+            .order_by("created_at")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        model.objects.filter(id__in=ids).update(
+            status="R",
+            attempts=F("attempts") + 1,
+            available_at=now + timedelta(seconds=settings.CANAL_QUEUE_LEASE),
+        )
+    return list(model.objects.filter(id__in=ids).order_by("created_at"))
+
+
+def requeue_entry(entry: models.Model, **fields: Any) -> None:
+    """
+    Puts an entry back to pending. An entry whose object has had a newer entry
+    queued since (see unique_pending_outbox_entry) is marked superseded
+    instead, as the newer one sends the latest state.
+    """
+    entries = type(entry).objects.filter(id=entry.id)
+    try:
+        with transaction.atomic():
+            entries.update(status="P", **fields)
+    except IntegrityError:
+        entries.update(status="X", **fields)
+
+
+def run_entry(handler: Callable[[Any], None], entry: models.Model) -> bool:
+    """
+    Runs ``handler`` for one claimed entry and records the outcome. Failures
+    are retried with exponential backoff until ``CANAL_QUEUE_MAX_ATTEMPTS``.
+    """
+    model = type(entry)
+    try:
+        handler(entry)
+    except Exception as e:
+        if entry.attempts >= settings.CANAL_QUEUE_MAX_ATTEMPTS:
+            model.objects.filter(id=entry.id).update(status="F", last_error=repr(e))
+        else:
+            requeue_entry(
+                entry,
+                available_at=timezone.now() + timedelta(seconds=2**entry.attempts),
+                last_error=repr(e),
+            )
+        return False
+    model.objects.filter(id=entry.id).update(status="S", last_error="")
+    return True
+
+
+def _run_entries(handler: Callable[[Any], None], entries: List[models.Model]) -> int:
+    try:
+        return sum(run_entry(handler, entry) for entry in entries)
+    finally:
+        # worker threads open their own connections, don't leak them
+        connections.close_all()
+
+
+def drain(
+    model: Type[models.Model],
+    handler: Callable[[Any], None],
+    group_key: Callable[[Any], Any],
+    workers: int = 4,
+    batch_size: int = 100,
+) -> int:
+    """
+    Processes due entries until none are left and returns how many succeeded.
+    Entries with the same ``group_key`` run in order on one thread, different
+    groups run concurrently.
+    """
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            entries = claim_entries(model, batch_size)
+            if not entries:
+                return done
+            groups = defaultdict(list)
+            for entry in entries:
+                groups[group_key(entry)].append(entry)
+            done += sum(executor.map(partial(_run_entries, handler), groups.values()))
+
+
+class QueueWorkerCommand(BaseCommand, ABC):
+    """
+    Base for commands that keep draining a queue table with a thread pool.
+    """
+
+    model: Type[models.Model]
+
+    @abstractmethod
+    def drain(self, workers: int, batch_size: int) -> int:
+        """
+        Processes due entries until none are left and returns how many
+        succeeded.
+        """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=4, help="Number of worker threads"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of entries claimed at a time",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait when the queue is empty",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is drained instead of polling",
+        )
+
+    def handle(self, *args, **kwargs):
+        # Entries left running by a worker that died are claimed again once
+        # their lease is up, see claim_entries
+        while True:
+            started = time.monotonic()
+            done = self.drain(
+                workers=kwargs["workers"], batch_size=kwargs["batch_size"]
+            )
+            if done:
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f"Processed {done} entries in {elapsed:.2f}s "
+                    f"({done / elapsed:.1f}/s)"
+                )
+                if kwargs["verbosity"] > 1:
+                    for endpoint, stats in get_canal_client().stats().items():
+                        self.stdout.write(
+                            f"  {endpoint}: {stats['count']} calls, "
+                            f"{stats['errors']} errors, "
+                            f"avg {stats['avg'] * 1000:.0f}ms, "
+                            f"max {stats['max'] * 1000:.0f}ms"
+                        )
+            if kwargs["once"]:
+                return
+            time.sleep(kwargs["poll_interval"])
@@ -0,0 +1,164 @@
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+from core.models import Item
+
+# Full-text search over item titles and descriptions. The index itself is made
+# by migrations 0019 and 0029: an FTS5 table on SQLite, a tsvector column with
+# a GIN index on Postgres. Titles weigh more than descriptions in the ranking.
+
+# The SQLite index is an FTS5 table whose rowids are assigned through
+# core_item_search_id, an ordinary table mapping item ids to them. A rebuild of
+# core_item by a migration leaves both tables alone but drops the triggers with
+# the old table, ensure_search_triggers puts them back.
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_insert AFTER INSERT ON core_item BEGIN
+        INSERT INTO core_item_search_id (item_id) VALUES (new.id);
+        INSERT INTO core_item_search (rowid, title, description)
+        VALUES (
+            (SELECT rowid FROM core_item_search_id WHERE item_id = new.id),
+            new.title,
+            new.description
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_delete AFTER DELETE ON core_item BEGIN
+        DELETE FROM core_item_search WHERE rowid = (
+            SELECT rowid FROM core_item_search_id WHERE item_id = old.id
+        );
+        DELETE FROM core_item_search_id WHERE item_id = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_item_search_update AFTER UPDATE OF title, description
+    ON core_item BEGIN
+        DELETE FROM core_item_search WHERE rowid = (
+            SELECT rowid FROM core_item_search_id WHERE item_id = old.id
+        );
+        INSERT INTO core_item_search (rowid, title, description)
+        VALUES (
+            (SELECT rowid FROM core_item_search_id WHERE item_id = new.id),
+            new.title,
+            new.description
+        );
+    END
+    """,
+]
+
+SQLITE_REINDEX = [
+    "DELETE FROM core_item_search",
+    "DELETE FROM core_item_search_id",
+    "INSERT INTO core_item_search_id (item_id) SELECT id FROM core_item",
+    """
+    INSERT INTO core_item_search (rowid, title, description)
+    SELECT core_item_search_id.rowid, core_item.title, core_item.description
+    FROM core_item
+    JOIN core_item_search_id ON core_item_search_id.item_id = core_item.id
+    """,
+]
+
+SEARCH_BACKENDS: Dict[str, Callable] = {}
+
+
+def register_search_backend(vendor: str) -> Callable:
+    def decorator(f: Callable) -> Callable:
+        SEARCH_BACKENDS[vendor] = f
+        return f
+
+    return decorator
+
+
+def category_filter(category: Optional[str]) -> str:
+    return "AND core_item.category = %s" if category else ""
+
+
+@register_search_backend("sqlite")
+def search_sqlite(terms: List[str], category: Optional[str], limit: int) -> List[Any]:
+    # every term, as a prefix, so "shi" finds shirts
+    match = " ".join(f'"{term}"*' for term in terms)
+    sql = f"""
+        SELECT core_item.id FROM core_item_search
+        JOIN core_item_search_id
+            ON core_item_search_id.rowid = core_item_search.rowid
+        JOIN core_item ON core_item.id = core_item_search_id.item_id
+        WHERE core_item_search MATCH %s {category_filter(category)}
+        ORDER BY bm25(core_item_search, 10.0, 1.0)
+        LIMIT %s
+    """
+    params = [match, category, limit] if category else [match, limit]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+@register_search_backend("postgresql")
+def search_postgresql(
+    terms: List[str], category: Optional[str], limit: int
+) -> List[Any]:
+    query = " & ".join(f"{term}:*" for term in terms)
+    sql = f"""
+        SELECT core_item.id FROM core_item, to_tsquery('english', %s) query
+        WHERE core_item.search_vector @@ query {category_filter(category)}
+        ORDER BY ts_rank(core_item.search_vector, query) DESC
+        LIMIT %s
+    """
+    params = [query, category, limit] if category else [query, limit]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def ensure_search_triggers(using: str = DEFAULT_DB_ALIAS, **kwargs: Any) -> None:
+    """
+    Puts back the SQLite index triggers, and reindexes, if a migration that
+    rebuilt core_item dropped them. Connected to post_migrate.
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return
+    trigger_names = [
+        "core_item_search_insert",
+        "core_item_search_delete",
+        "core_item_search_update",
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'core_item_search_id'"
+            " OR (type = 'trigger' AND tbl_name = 'core_item')"
+        )
+        names = {row[0] for row in cursor.fetchall()}
+        # not migrated as far as 0029 yet
+        if "core_item_search_id" not in names:
+            return
+        if names.issuperset(trigger_names):
+            return
+        for sql in [*SQLITE_REINDEX, *SQLITE_TRIGGERS]:
+            cursor.execute(sql)
+
+
+def search_items(
+    query: str, category: Optional[str] = None, limit: int = 48
+) -> List[Item]:
+    """
+    Returns up to ``limit`` items matching every word of ``query``, best match
+    first, optionally only from one category.
+    """
+    terms = re.findall(r"\w+", query.lower())
+    if not terms:
+        return []
+    backend = SEARCH_BACKENDS.get(connection.vendor)
+    if backend is None:
+        # no index on this database, fall back to a scan
+        items = Item.objects.only(*Item.card_fields)
+        for term in terms:
+            items = items.filter(title__icontains=term)
+        if category:
+            items = items.filter(category=category)
+        return list(items.order_by("title")[:limit])
+    ids = [Item._meta.pk.to_python(pk) for pk in backend(terms, category, limit)]
+    items = Item.objects.only(*Item.card_fields).in_bulk(ids)
+    return [items[pk] for pk in ids if pk in items]
@@ -1,139 +1,119 @@
-import os
-import requests
-from requests.models import Response
-from typing import Any, Type, TYPE_CHECKING, Callable
+from datetime import datetime
+from typing import Any, Iterable, Optional, Type, TYPE_CHECKING
+from uuid import UUID
 
 from django.apps import apps
-from django.conf import settings
-
-from core.constants import SHOPCANAL_DEFAULT_HEADERS
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db import IntegrityError, transaction
 
 if TYPE_CHECKING:
-    from core.models import Item, Order
+    from core.models import CanalOutboxEntry, Item, Order
+
 
+def enqueue_canal_sync(
+    topic: str, object_id: UUID, canal_id: Optional[str] = None
+) -> "CanalOutboxEntry":
+    """
+    Records a Canal API call in the outbox. A pending entry for the same object
+    and topic is reused, since the worker always sends the latest state.
+    """
+    CanalOutboxEntry = apps.get_model("core", "CanalOutboxEntry")
+    pending = CanalOutboxEntry.objects.filter(
+        topic=topic, object_id=object_id, status="P"
+    )
+    entry = pending.first()
+    if entry is not None:
+        return entry
+    try:
+        with transaction.atomic():
+            return CanalOutboxEntry.objects.create(
+                topic=topic, object_id=object_id, canal_id=canal_id
+            )
+    except IntegrityError:
+        # queued by a concurrent save, see unique_pending_outbox_entry
+        return pending.get()
 
-def try_catch_wrapper(f: Callable) -> Any:
-    def decorator(*args: Any, **kwargs: Any) -> Any:
-        try:
-            return f(*args, **kwargs)
-        except Exception:
-            pass
 
-    return decorator
+# {% cache %} fragments rendered per item, keyed on its id and updated_at
+ITEM_FRAGMENTS = ("item_card", "item_detail")
 
 
-@try_catch_wrapper
-def raise_response_status(response: Response):
-    try:
-        response.raise_for_status()
-    except Exception as e:
-        print(response.text)
-        print(response.json())
-        raise type(e)(response.text) from e
+def invalidate_item_fragments(item_id: UUID, updated_at: Optional[datetime]) -> None:
+    """
+    Drops the cached fragments of one version of an item. A save gives the item
+    a new updated_at and so new fragment keys anyway, this frees the old ones.
+    """
+    if updated_at is None:
+        return
+    cache.delete_many(
+        [
+            make_template_fragment_key(name, [item_id, updated_at])
+            for name in ITEM_FRAGMENTS
+        ]
+    )
+
+
+def update_item_facet_counts(
+    item: "Item", created: bool, update_fields: Optional[Iterable[str]] = None
+) -> None:
+    """
+    Moves a saved item between the category / label facet counts.
+    """
+    ItemFacetCount = apps.get_model("core", "ItemFacetCount")
+    if not created and (
+        item._loaded_facet is None or not item.writes_facet(update_fields)
+    ):
+        # neither was written, see Item.save
+        return
+    facet = (item.category, item.label)
+    if created:
+        ItemFacetCount.adjust(*facet, 1)
+    elif item._loaded_facet != facet:
+        ItemFacetCount.adjust(*item._loaded_facet, -1)
+        ItemFacetCount.adjust(*facet, 1)
+    item._loaded_facet = facet
 
 
-@try_catch_wrapper
 def item_post_save_receiver(
     sender: Type["Item"], instance: "Item", created: bool, **kwargs: Any
 ) -> None:
+    invalidate_item_fragments(instance.id, instance._loaded_updated_at)
+    instance._loaded_updated_at = instance.updated_at
+    update_item_facet_counts(instance, created, kwargs.get("update_fields"))
     if instance.added_from_canal:
         return
-    if instance.canal_id is None:
-        # POST /products/
-        create_product_url = os.path.join(settings.SHOPCANAL_API_BASE_URL, "products/")
-        response = requests.post(
-            create_product_url,
-            json=instance.transform_to_canal(),
-            headers=SHOPCANAL_DEFAULT_HEADERS,
-        )
-        raise_response_status(response)
-        Item = apps.get_model("core", "Item")
-        response_json = response.json()
-        Item.objects.filter(id=instance.id).update(
-            canal_id=response_json["id"],
-            canal_variant_id=response_json["variants"][0]["id"],
-        )
-    else:
-        # PUT /products/{id}
-        update_product_url = (
-            os.path.join(
-                settings.SHOPCANAL_API_BASE_URL, "products", str(instance.canal_id)
-            )
-            + "/"
-        )
-        response = requests.put(
-            update_product_url,
-            json=instance.transform_to_canal(),
-            headers=SHOPCANAL_DEFAULT_HEADERS,
-        )
-        raise_response_status(response)
-        if instance.canal_variant_id is not None:
-            # PUT /variants/{id}
-            variant_json = instance.variant_json
-            update_variant_url = (
-                os.path.join(
-                    settings.SHOPCANAL_API_BASE_URL,
-                    "variants",
-                    str(instance.canal_variant_id),
-                )
-                + "/"
-            )
-            response = requests.put(
-                update_variant_url, json=variant_json, headers=SHOPCANAL_DEFAULT_HEADERS
-            )
-            raise_response_status(response)
+    enqueue_canal_sync("product/upsert", instance.id)
 
 
-@try_catch_wrapper
 def item_post_delete_receiver(
     sender: Type["Item"], instance: "Item", **kwargs: Any
 ) -> None:
+    from core.page_cache import touch_catalog
+
+    invalidate_item_fragments(instance.id, instance._loaded_updated_at)
+    touch_catalog()
+    apps.get_model("core", "ItemFacetCount").adjust(
+        *(instance._loaded_facet or (instance.category, instance.label)), -1
+    )
     if instance.canal_id is None:
         return
-    # DELETE /variants/{id}
-    delete_product_url = (
-        os.path.join(
-            settings.SHOPCANAL_API_BASE_URL, "products", str(instance.canal_id)
-        )
-        + "/"
-    )
-    response = requests.delete(delete_product_url, headers=SHOPCANAL_DEFAULT_HEADERS)
-    raise_response_status(response)
+    enqueue_canal_sync("product/delete", instance.id, canal_id=instance.canal_id)
 
 
-@try_catch_wrapper
 def order_post_save_receiver(
     sender: Type["Order"], instance: "Order", created: bool, **kwargs: Any
 ) -> None:
-    if not instance.ordered:
+    if not instance.ordered or instance.canal_id is not None:
         return
-    if instance.canal_id is None:
-        # POST /orders/
-        create_order_url = os.path.join(settings.SHOPCANAL_API_BASE_URL, "orders/")
-        response = requests.post(
-            create_order_url,
-            json=instance.transform_to_canal(),
-            headers=SHOPCANAL_DEFAULT_HEADERS,
-        )
-        raise_response_status(response)
-        response_json = response.json()
-        Order = apps.get_model("core", "Order")
-        Order.objects.filter(id=instance.id).update(canal_id=response_json["id"])
-        for line_item in response.json()["line_items"]:
-            instance.items.all().filter(
-                item__canal_variant_id=line_item["variant_id"]
-            ).update(canal_id=line_item["id"])
-
-    # update orders isn't supported
-    # else:
-    #     # PUT /orders/{id}/
-    #     update_order_url = (
-    #         os.path.join(settings.SHOPCANAL_API_BASE_URL, "orders", str(instance.id))
-    #         + "/"
-    #     )
-    #     response = requests.put(
-    #         update_order_url,
-    #         json=instance.transform_to_canal(),
-    #         headers=SHOPCANAL_DEFAULT_HEADERS,
-    #     )
-    #     raise_response_status(response)
+    # update orders isn't supported, so only new orders are pushed
+    enqueue_canal_sync("order/create", instance.id)
+
+
+def order_post_delete_receiver(
+    sender: Type["Order"], instance: "Order", **kwargs: Any
+) -> None:
+    from core.models import forget_order_id
+
+    if instance.canal_id is not None:
+        forget_order_id(instance.canal_id)
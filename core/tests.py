@@ -1,3 +1,1476 @@
-from django.test import TestCase
+import itertools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import (
+    Client,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_script_prefix, reverse, set_script_prefix
+from django.utils import timezone
+
+from core.canal_client import CanalAPIError, CanalClient
+from core.models import (
+    Address,
+    CanalModel,
+    CanalOutboxEntry,
+    CanalWebhookEvent,
+    Coupon,
+    Fulfillment,
+    FulfillmentLineItem,
+    Item,
+    ItemFacetCount,
+    Order,
+    OrderItem,
+    Payment,
+    generate_item_slugs,
+    get_item_by_slug,
+    get_item_id_for_slug,
+    forget_order_id,
+    get_order_by_canal_id,
+    get_order_id_for_canal_id,
+)
+from core.outbox import drain
+from core.queue import claim_entries, run_entry
+from core.payments import (
+    DECLINED_TOKEN,
+    PaymentGateway,
+    claim_payment,
+    get_payment_gateway,
+    payment_idempotency_key,
+)
+from core.search import ensure_search_triggers, search_items
+from core.signals import ITEM_FRAGMENTS
+from core import cart, webhooks
+from core.templatetags.cart_template_tags import cart_item_count
+from core.url_templates import core_url, get_url_templates
+
+
+class StubCanalHandler(BaseHTTPRequestHandler):
+    def _respond(self, body):
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"null")
+        self.server.calls.append((self.command, self.path, payload))
+        data = json.dumps(body(payload) if callable(body) else body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.endswith("/orders/"):
+            self._respond(
+                lambda order: {
+                    "id": "canal-order",
+                    "line_items": [
+                        {"id": f"canal-line-{i}", "variant_id": line["variant_id"]}
+                        for i, line in enumerate(order["line_items"])
+                    ],
+                }
+            )
+        else:
+            n = next(self.server.ids)
+            self._respond(
+                {"id": f"canal-product-{n}", "variants": [{"id": f"canal-variant-{n}"}]}
+            )
+
+    def do_PUT(self):
+        self._respond({})
+
+    def do_DELETE(self):
+        self._respond({})
+
+    def log_message(self, *args):
+        pass
+
+
+class StubCanalServerMixin:
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubCanalHandler)
+        self.server.calls = []
+        self.server.ids = itertools.count()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        settings_override = override_settings(
+            SHOPCANAL_API_BASE_URL=f"http://127.0.0.1:{self.server.server_port}"
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+
+class CanalOutboxTests(StubCanalServerMixin, TransactionTestCase):
+    def create_item(self, **kwargs):
+        defaults = {
+            "title": "Shirt",
+            "price": 10.0,
+            "category": "S",
+            "label": "P",
+            "slug": "shirt",
+            "description": "A shirt",
+            "image": "shirt.jpg",
+        }
+        defaults.update(kwargs)
+        return Item.objects.create(**defaults)
+
+    def test_item_save_is_queued_without_calling_canal(self):
+        item = self.create_item()
+        item.title = "Better shirt"
+        item.save()
+        self.assertEqual(self.server.calls, [])
+        entry = CanalOutboxEntry.objects.get()
+        self.assertEqual((entry.topic, entry.object_id), ("product/upsert", item.id))
+
+    def test_drain_creates_product_then_updates_it(self):
+        item = self.create_item()
+        self.assertEqual(drain(workers=2), 1)
+        item.refresh_from_db()
+        self.assertEqual(item.canal_id, "canal-product-0")
+        self.assertEqual(item.canal_variant_id, "canal-variant-0")
+
+        item.price = 12.0
+        item.save()
+        self.assertEqual(drain(workers=2), 1)
+        self.assertEqual(
+            [(method, path) for method, path, _ in self.server.calls],
+            [
+                ("POST", "/products/"),
+                ("PUT", "/products/canal-product-0/"),
+                ("PUT", "/variants/canal-variant-0/"),
+            ],
+        )
+        self.assertFalse(CanalOutboxEntry.objects.exclude(status="S").exists())
+
+    def test_failed_entry_is_retried_later(self):
+        self.create_item()
+        with override_settings(
+            SHOPCANAL_API_BASE_URL="http://127.0.0.1:1", CANAL_CLIENT_MAX_RETRIES=1
+        ):
+            self.assertEqual(drain(), 0)
+        entry = CanalOutboxEntry.objects.get()
+        self.assertEqual((entry.status, entry.attempts), ("P", 1))
+        self.assertGreater(entry.available_at, timezone.now())
+        self.assertTrue(entry.last_error)
+
+    def test_running_entries_are_only_claimed_again_once_their_lease_is_up(self):
+        self.create_item()
+        with override_settings(CANAL_QUEUE_LEASE=-1):
+            self.assertEqual(len(claim_entries(CanalOutboxEntry, 10)), 1)
+        # the worker holding it died
+        (entry,) = claim_entries(CanalOutboxEntry, 10)
+        self.assertEqual((entry.status, entry.attempts), ("R", 2))
+        # while it's being sent, e.g. by a second worker starting up
+        self.assertEqual(claim_entries(CanalOutboxEntry, 10), [])
+
+    def test_failed_entry_superseded_by_a_newer_one_is_not_requeued(self):
+        item = self.create_item()
+        (running,) = claim_entries(CanalOutboxEntry, 10)
+        item.save()
+
+        def fail(entry):
+            raise CanalAPIError("boom")
+
+        self.assertFalse(run_entry(fail, running))
+        running.refresh_from_db()
+        self.assertEqual(running.status, "X")
+        # still one pending entry, which later saves reuse
+        item.save()
+        self.assertEqual(CanalOutboxEntry.objects.filter(status="P").count(), 1)
+
+    def test_ordered_order_is_pushed(self):
+        user = get_user_model().objects.create(username="buyer")
+        item = self.create_item(canal_id="canal-product", canal_variant_id="v1")
+        order_item = OrderItem.objects.create(user=user, item=item, ordered=True)
+        order = Order.objects.create(user=user, ordered_date=timezone.now())
+        order.items.add(order_item)
+        order.shipping_address = Address.objects.create(
+            user=user, street_address="1 Main St", country="US", zip="94105"
+        )
+        order.ordered = True
+        order.save()
+        CanalOutboxEntry.objects.filter(topic="product/upsert").delete()
+
+        self.assertEqual(drain(), 1)
+        _, path, payload = self.server.calls[0]
+        self.assertEqual(path, "/orders/")
+        self.assertEqual(payload["line_items"], [{"variant_id": "v1", "quantity": 1}])
+        order_item.refresh_from_db()
+        self.assertEqual(order_item.canal_id, "canal-line-0")
+        self.assertEqual(Order.objects.get().canal_id, "canal-order")
+
+
+class CanalClientTests(StubCanalServerMixin, TransactionTestCase):
+    def test_calls_reuse_one_connection_and_record_latency(self):
+        client = CanalClient(f"http://127.0.0.1:{self.server.server_port}")
+        client.update_product("p1", {"title": "Shirt"})
+        client.update_product("p2", {"title": "Pants"})
+        client.update_variant("v1", {"price": "1.0"})
+        self.assertEqual(
+            len(client.session.get_adapter("http://").poolmanager.pools), 1
+        )
+        stats = client.stats()
+        self.assertEqual(stats["PUT /products/{id}/"]["count"], 2)
+        self.assertEqual(stats["PUT /variants/{id}/"]["count"], 1)
+
+    def test_client_errors_are_not_retried(self):
+        StubCanalHandler.do_PATCH = lambda handler: handler.send_error(404)
+        self.addCleanup(delattr, StubCanalHandler, "do_PATCH")
+        client = CanalClient(f"http://127.0.0.1:{self.server.server_port}")
+        with self.assertRaises(CanalAPIError):
+            client.request("PATCH", "products", "missing")
+        self.assertEqual(client.stats()["PATCH /products/{id}/"]["errors"], 1)
+
+    def test_posts_are_only_retried_when_not_applied(self):
+        statuses = iter([429, 503])
+        self.addCleanup(setattr, StubCanalHandler, "do_POST", StubCanalHandler.do_POST)
+        StubCanalHandler.do_POST = lambda handler: handler.send_error(next(statuses))
+        client = CanalClient(f"http://127.0.0.1:{self.server.server_port}")
+        with self.assertRaises(CanalAPIError):
+            client.create_order({})
+        # the 429 is retried, the 503 may have created the order
+        self.assertEqual(client.stats()["POST /orders/"]["count"], 2)
+
+        client = CanalClient("http://127.0.0.1:1", max_retries=2)
+        with self.assertRaises(requests.ConnectionError):
+            client.create_order({})
+        self.assertEqual(client.stats()["POST /orders/"]["count"], 2)
+
+
+class CanalSyncCatalogTests(StubCanalServerMixin, TransactionTestCase):
+    def sync_catalog(self):
+        call_command("canal_sync_catalog", "--chunk-size=2", stdout=StringIO())
+
+    def test_pushes_only_items_changed_since_last_sync(self):
+        Item.objects.bulk_create(
+            Item(
+                title=f"Shirt {i}",
+                price=10.0,
+                category="S",
+                label="P",
+                slug=f"shirt-{i}",
+                description="A shirt",
+                image="shirt.jpg",
+            )
+            for i in range(5)
+        )
+        self.sync_catalog()
+        self.assertEqual(len(self.server.calls), 5)
+        self.assertFalse(Item.objects.filter(canal_synced_hash=None).exists())
+
+        self.server.calls.clear()
+        self.sync_catalog()
+        self.assertEqual(self.server.calls, [])
+
+        Item.objects.filter(slug="shirt-3").update(price=12.0)
+        item = Item.objects.get(slug="shirt-3")
+        self.sync_catalog()
+        self.assertEqual(
+            [(method, path) for method, path, _ in self.server.calls],
+            [
+                ("PUT", f"/products/{item.canal_id}/"),
+                ("PUT", f"/variants/{item.canal_variant_id}/"),
+            ],
+        )
+
+
+class TransformToCanalTests(SimpleTestCase):
+    def test_related_fields_and_transforms(self):
+        fulfillment = Fulfillment(
+            name="Fulfillment",
+            order=Order(canal_id="canal-order"),
+            status="success",
+            shipment_status="delivered",
+            service="manual",
+            tracking_company="UPS",
+            tracking_number="123",
+            tracking_url="https://www.ups.com/track?tracknum=123",
+            canal_id="canal-fulfillment",
+        )
+        self.assertEqual(
+            CanalModel.transform_to_canal(fulfillment),
+            {
+                "name": "Fulfillment",
+                "order_id": "canal-order",
+                "status": "success",
+                "shipment_status": "delivered",
+                "service": "manual",
+                "tracking_company": "UPS",
+                "tracking_numbers": ["123"],
+                "tracking_urls": ["https://www.ups.com/track?tracknum=123"],
+                "id": "canal-fulfillment",
+            },
+        )
+
+    def test_image_url(self):
+        item = Item(title="Shirt", description="A shirt", image="shirt.jpg")
+        self.assertEqual(
+            CanalModel.transform_to_canal(item),
+            {"title": "Shirt", "body_html": "A shirt", "image_src": "/media/shirt.jpg"},
+        )
+        item.image = None
+        self.assertIsNone(CanalModel.transform_to_canal(item)["image_src"])
+
+
+class ForCanalQueryCountTests(TestCase):
+    def test_serializing_orders_takes_constant_queries(self):
+        user = get_user_model().objects.create(username="buyer")
+        address = Address.objects.create(
+            user=user, street_address="1 Main St", country="US", zip="94105"
+        )
+        for i in range(5):
+            order = Order.objects.create(
+                user=user,
+                ordered_date=timezone.now(),
+                shipping_address=address,
+                ordered=True,
+                canal_id=f"o{i}",
+            )
+            for j in range(4):
+                item = Item.objects.create(
+                    title=f"Shirt {i}-{j}",
+                    price=10.0,
+                    slug=f"shirt-{i}-{j}",
+                    canal_variant_id=f"v-{i}-{j}",
+                )
+                order.items.add(
+                    OrderItem.objects.create(user=user, item=item, ordered=True)
+                )
+
+        # orders with address and user, order items, items
+        with self.assertNumQueries(3):
+            orders = [order.transform_to_canal() for order in Order.objects.for_canal()]
+        self.assertEqual(len(orders), 5)
+        self.assertEqual([len(order["line_items"]) for order in orders], [4] * 5)
+
+
+def canal_product_json(n, title=None, price="10.00"):
+    return {
+        "id": f"p{n}",
+        "title": title or f"Shirt {n}",
+        "body_html": "A shirt",
+        "image_src": "shirt.jpg",
+        "variants": [{"id": f"v{n}", "price": price}],
+    }
+
+
+class CanalWebhookBatchTests(TestCase):
+    def post_batch(self, events):
+        response = self.client.post(
+            reverse("core:canal-webhook"),
+            json.dumps(events),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"]
+
+    def test_mixed_topics_with_per_event_status(self):
+        get_user_model().objects.create(
+            username="simon", email="simon.xie@shopcanal.com"
+        )
+        Item.objects.create(
+            title="Old", price=1.0, slug="old", canal_id="p1", added_from_canal=True
+        )
+        results = self.post_batch(
+            [
+                {
+                    "topic": "order/create",
+                    "data": {
+                        "id": "o1",
+                        "line_items": [{"id": "l1", "variant_id": "v2", "quantity": 2}],
+                    },
+                },
+                {"topic": "product/update", "data": canal_product_json(1, price="5")},
+                {"topic": "product/create", "data": canal_product_json(2)},
+                {"topic": "product/create", "data": {"id": "p3"}},
+                {"topic": "refund/create", "data": {}},
+            ]
+        )
+        self.assertEqual(
+            [result["status"] for result in results],
+            ["ok", "ok", "ok", "error", "error"],
+        )
+        self.assertEqual(
+            [result.get("error") for result in results],
+            [None, None, None, "invalid_data", "unknown_topic"],
+        )
+        self.assertEqual(Item.objects.get(canal_id="p1").price, 5.0)
+        self.assertEqual(
+            Order.objects.get(canal_id="o1").items.get().item.canal_id, "p2"
+        )
+
+    def test_products_are_written_with_grouped_queries(self):
+        self.post_batch([{"topic": "product/create", "data": canal_product_json(0)}])
+        with CaptureQueriesContext(connection) as queries:
+            self.post_batch(
+                [
+                    {"topic": "product/update", "data": canal_product_json(n)}
+                    for n in range(100)
+                ]
+            )
+        self.assertEqual(Item.objects.count(), 100)
+        # including a constant few to rebuild the facet counts and pick slugs
+        self.assertLessEqual(len(queries), 13)
+
+    def test_canal_json_fields_are_the_ones_set(self):
+        self.assertCountEqual(
+            Item.fields_from_canal_json(canal_product_json(1)),
+            Item.canal_json_fields,
+        )
+
+    def post_orders_and_fulfillments(self, prefix, count, quantity):
+        events = []
+        for n in range(count):
+            lines = [
+                {"id": f"{prefix}{n}-l{i}", "variant_id": f"v{i}", "quantity": quantity}
+                for i in range(3)
+            ]
+            events.append(
+                {
+                    "topic": "order/create",
+                    "data": {
+                        "id": f"{prefix}{n}",
+                        "line_items": lines,
+                        "shipping_address": {
+                            "address1": f"{n % 2} {prefix} St",
+                            "address2": None,
+                            "country": "US",
+                            "zip": "94105",
+                        },
+                    },
+                }
+            )
+            events.append(
+                {
+                    "topic": "fulfillment/create",
+                    "data": {
+                        "id": f"{prefix}-f{n}",
+                        "name": "Fulfillment",
+                        "order_id": f"{prefix}{n}",
+                        "status": "success",
+                        "shipment_status": "delivered",
+                        "service": "manual",
+                        "tracking_company": "UPS",
+                        "tracking_numbers": ["123"],
+                        "tracking_urls": ["https://www.ups.com/track?tracknum=123"],
+                        "line_items": [
+                            {"id": line["id"], "quantity": quantity} for line in lines
+                        ],
+                    },
+                }
+            )
+        with CaptureQueriesContext(connection) as queries:
+            results = self.post_batch(events)
+        self.assertEqual({result["status"] for result in results}, {"ok"})
+        return len(queries)
+
+    def test_orders_and_fulfillments_are_written_with_grouped_queries(self):
+        get_user_model().objects.create(
+            username="simon", email="simon.xie@shopcanal.com"
+        )
+        Item.objects.bulk_create(
+            Item(title=f"Shirt {i}", price=1.0, slug=f"s{i}", canal_variant_id=f"v{i}")
+            for i in range(3)
+        )
+        self.assertEqual(
+            self.post_orders_and_fulfillments("a", 2, 1),
+            self.post_orders_and_fulfillments("b", 30, 1),
+        )
+        # and the same again to update them
+        self.assertEqual(
+            self.post_orders_and_fulfillments("a", 2, 2),
+            self.post_orders_and_fulfillments("b", 30, 2),
+        )
+        self.assertEqual(Order.objects.count(), 32)
+        self.assertEqual(Address.objects.count(), 4)
+        order = Order.objects.get(canal_id="b29")
+        self.assertEqual(set(order.items.values_list("quantity", flat=True)), {2})
+        self.assertEqual(order.fulfillment_set.get().fulfillmentlineitem_set.count(), 3)
+        self.assertEqual(FulfillmentLineItem.objects.count(), 96)
+        self.assertFalse(FulfillmentLineItem.objects.exclude(quantity=2).exists())
+
+
+class CanalWebhookInboxTests(TransactionTestCase):
+    def post_event(self, topic, canal_json, **headers):
+        return self.client.post(
+            reverse("core:canal-webhook"),
+            json.dumps(canal_json),
+            content_type="application/json",
+            HTTP_X_CANAL_TOPIC=topic,
+            **headers,
+        )
+
+    def test_event_is_acknowledged_then_applied_once(self):
+        response = self.post_event("product/create", canal_product_json(1))
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(Item.objects.exists())
+
+        response = self.post_event("product/create", canal_product_json(1))
+        self.assertEqual(response.json(), {"status": "duplicate"})
+        self.assertEqual(webhooks.drain(workers=2), 1)
+        self.assertEqual(Item.objects.get().canal_variant_id, "v1")
+        self.assertEqual(CanalWebhookEvent.objects.get().status, "S")
+
+    def test_event_id_header_is_the_dedup_key(self):
+        self.post_event(
+            "product/update", canal_product_json(1), HTTP_X_CANAL_EVENT_ID="e1"
+        )
+        self.post_event(
+            "product/update",
+            canal_product_json(1, price="12.00"),
+            HTTP_X_CANAL_EVENT_ID="e1",
+        )
+        self.post_event(
+            "product/update",
+            canal_product_json(1, price="15.00"),
+            HTTP_X_CANAL_EVENT_ID="e2",
+        )
+        self.assertEqual(webhooks.drain(), 2)
+        self.assertEqual(Item.objects.get().price, 15.0)
+
+    def test_unknown_topic_is_rejected(self):
+        response = self.post_event("refund/create", {"id": "r1"})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CanalWebhookEvent.objects.exists())
+
+    def test_body_that_is_not_an_object_is_rejected(self):
+        for body in ("shirt", 1, None):
+            response = self.post_event("product/create", body)
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            reverse("core:canal-webhook"), "{", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CanalWebhookEvent.objects.exists())
+
+
+class OrderFromCanalTests(TestCase):
+    def test_line_items_are_upserted_in_constant_queries(self):
+        get_user_model().objects.create(
+            username="simon", email="simon.xie@shopcanal.com"
+        )
+        Item.objects.bulk_create(
+            Item(title=f"Shirt {i}", price=1.0, slug=f"s{i}", canal_variant_id=f"v{i}")
+            for i in range(30)
+        )
+
+        def order_json(quantity):
+            return {
+                "id": "o1",
+                "line_items": [
+                    {"id": f"l{i}", "variant_id": f"v{i}", "quantity": quantity}
+                    for i in range(30)
+                ],
+            }
+
+        Order.create_or_update_from_canal_json(order_json(1))
+        with CaptureQueriesContext(connection) as queries:
+            order = Order.create_or_update_from_canal_json(order_json(3))
+        self.assertLessEqual(len(queries), 12)
+        self.assertEqual(order.items.count(), 30)
+        self.assertEqual(set(order.items.values_list("quantity", flat=True)), {3})
+        self.assertEqual(OrderItem.objects.count(), 30)
+
+
+class OrderIdCacheTests(TransactionTestCase):
+    def setUp(self):
+        forget_order_id()
+        self.user = get_user_model().objects.create(username="buyer")
+
+    def create_order(self):
+        return Order.objects.create(
+            user=self.user, ordered_date=timezone.now(), ordered=True, canal_id="o1"
+        )
+
+    def test_ids_read_in_a_rolled_back_transaction_are_not_cached(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.create_order()
+            get_order_id_for_canal_id("o1")
+            raise RuntimeError
+        order = self.create_order()
+        self.assertEqual(get_order_id_for_canal_id("o1"), order.id)
+
+    def test_stale_id_is_looked_up_again(self):
+        old = self.create_order()
+        self.assertEqual(get_order_by_canal_id("o1"), old)
+        # as if deleted and created again by another process
+        Order.objects.filter(pk=old.pk).update(canal_id=None)
+        new = self.create_order()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_order_id_for_canal_id("o1"), old.id)
+        self.assertEqual(get_order_by_canal_id("o1"), new)
+        self.assertEqual(get_order_id_for_canal_id("o1"), new.id)
+
+
+class FulfillmentFromCanalTests(TestCase):
+    def setUp(self):
+        forget_order_id()
+        user = get_user_model().objects.create(username="buyer")
+        self.order = Order.objects.create(
+            user=user, ordered_date=timezone.now(), ordered=True, canal_id="o1"
+        )
+        item = Item.objects.create(title="Shirt", price=1.0, slug="shirt")
+        for i in range(20):
+            self.order.items.add(
+                OrderItem.objects.create(
+                    user=user, item=item, ordered=True, canal_id=f"l{i}"
+                )
+            )
+
+    def fulfillment_json(self, quantity):
+        return {
+            "id": "f1",
+            "name": "Fulfillment",
+            "order_id": "o1",
+            "status": "success",
+            "shipment_status": "delivered",
+            "service": "manual",
+            "tracking_company": "UPS",
+            "tracking_numbers": ["123"],
+            "tracking_urls": ["https://www.ups.com/track?tracknum=123"],
+            "line_items": [{"id": f"l{i}", "quantity": quantity} for i in range(20)],
+        }
+
+    def test_line_items_are_upserted_in_constant_queries(self):
+        Fulfillment.create_or_update_from_canal_json(self.fulfillment_json(1))
+        with CaptureQueriesContext(connection) as queries:
+            fulfillment = Fulfillment.create_or_update_from_canal_json(
+                self.fulfillment_json(2)
+            )
+        # the order id is only cached on commit, which never comes in a TestCase
+        self.assertLessEqual(len(queries), 9)
+        self.assertEqual(fulfillment.order, self.order)
+        self.assertEqual(
+            list(
+                FulfillmentLineItem.objects.values_list(
+                    "quantity", flat=True
+                ).distinct()
+            ),
+            [2],
+        )
+        self.assertEqual(FulfillmentLineItem.objects.count(), 20)
+
+    def test_unknown_order_item_is_an_error(self):
+        canal_json = self.fulfillment_json(1)
+        canal_json["line_items"].append({"id": "missing", "quantity": 1})
+        with self.assertRaises(OrderItem.DoesNotExist):
+            Fulfillment.create_or_update_from_canal_json(canal_json)
+
+
+class CartTestMixin:
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = get_user_model().objects.create(username="shopper")
+        self.client.force_login(self.user)
+
+    def create_items(self, count, **kwargs):
+        items = [
+            Item(
+                title=f"Shirt {i}",
+                price=10.0,
+                category="S",
+                label="P",
+                slug=f"shirt-{i}",
+                description="A shirt",
+                image="shirt.jpg",
+                **kwargs,
+            )
+            for i in range(count)
+        ]
+        Item.objects.bulk_create(items)
+        return items
+
+
+class CartSummaryTests(CartTestMixin, TestCase):
+    def test_navbar_count_is_cached_until_the_cart_changes(self):
+        item, other = self.create_items(2)
+        self.client.get(reverse("core:add-to-cart", args=[item.slug]))
+        self.assertEqual(cart_item_count(self.user), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(cart_item_count(self.user), 1)
+
+        self.client.get(reverse("core:add-to-cart", args=[other.slug]))
+        self.assertEqual(cart_item_count(self.user), 2)
+        self.client.get(reverse("core:remove-from-cart", args=[item.slug]))
+        self.assertEqual(cart_item_count(self.user), 1)
+
+
+class CartServiceTests(CartTestMixin, TestCase):
+    def test_adding_an_item_already_in_the_cart_is_one_update(self):
+        (item,) = self.create_items(1)
+        cart.add_to_cart(self.user, item.slug)
+        with self.assertNumQueries(1):
+            self.assertFalse(cart.add_to_cart(self.user, item.slug))
+        self.assertEqual(OrderItem.objects.get().quantity, 2)
+
+    def test_remove_single_item_removes_the_last_one(self):
+        (item,) = self.create_items(1)
+        cart.add_to_cart(self.user, item.slug)
+        cart.add_to_cart(self.user, item.slug)
+        self.assertTrue(cart.remove_single_item_from_cart(self.user, item.slug))
+        self.assertEqual(OrderItem.objects.get().quantity, 1)
+        self.assertTrue(cart.remove_single_item_from_cart(self.user, item.slug))
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertFalse(Order.objects.get().items.exists())
+        self.assertFalse(cart.remove_single_item_from_cart(self.user, item.slug))
+
+    def test_unknown_slug_is_a_404(self):
+        response = self.client.get(reverse("core:add-to-cart", args=["missing"]))
+        self.assertEqual(response.status_code, 404)
+
+
+class CartConcurrencyTests(CartTestMixin, TransactionTestCase):
+    def test_parallel_adds_to_one_cart(self):
+        items = self.create_items(2)
+
+        def add(i):
+            try:
+                cart.add_to_cart(self.user, items[i % 2].slug)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(add, range(40)))
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(
+            sorted(order.items.values_list("quantity", flat=True)), [20, 20]
+        )
+
+
+class OrderTotalTests(CartTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        full_price, discounted, zero_discount = self.create_items(3)
+        Item.objects.filter(pk=discounted.pk).update(discount_price=8.0)
+        Item.objects.filter(pk=zero_discount.pk).update(discount_price=0)
+        self.order = Order.objects.create(user=self.user, ordered_date=timezone.now())
+        self.order.items.add(
+            *OrderItem.objects.bulk_create(
+                OrderItem(user=self.user, item=item, quantity=2)
+                for item in (full_price, discounted, zero_discount)
+            )
+        )
+
+    def test_total_is_one_memoized_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.order.get_total(), 56.0)
+            self.assertEqual(self.order.get_total(), 56.0)
+
+    def test_total_uses_prefetched_items(self):
+        order = Order.objects.prefetch_related("items__item").get(pk=self.order.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(order.get_total(), 56.0)
+
+    def test_coupon_is_subtracted(self):
+        self.order.coupon = Coupon.objects.create(code="TEN", amount=10.0)
+        self.order.save()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.get_total(), 46.0)
+
+    def test_empty_order(self):
+        self.order.items.clear()
+        self.assertEqual(self.order.get_total(), 0)
+
+
+# The debug toolbar's URLs are only mounted when DEBUG is on, which it isn't in
+# tests, so pages are rendered without it.
+without_debug_toolbar = override_settings(
+    MIDDLEWARE=[m for m in settings.MIDDLEWARE if not m.startswith("debug_toolbar")]
+)
+
+
+@without_debug_toolbar
+class OrderSummaryQueryCountTests(CartTestMixin, TestCase):
+    def fill_cart(self, count):
+        order = Order.objects.create(user=self.user, ordered_date=timezone.now())
+        order.items.add(
+            *OrderItem.objects.bulk_create(
+                OrderItem(user=self.user, item=item, quantity=2)
+                for item in self.create_items(count, discount_price=8.0)
+            )
+        )
+        # the navbar summary is cached separately
+        cart.get_cart_summary(self.user)
+
+    def test_50_item_cart(self):
+        self.fill_cart(50)
+        # session, user, order + coupon, order items, items (+ default addresses)
+        for name, num_queries in (("core:order-summary", 5), ("core:checkout", 6)):
+            with self.subTest(name), self.assertNumQueries(num_queries):
+                response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, "Shirt 49")
+
+
+@without_debug_toolbar
+@override_settings(CATALOG_PAGE_CACHE_TIMEOUT=0)
+class HomeViewPaginationTests(CartTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.logout()
+        self.create_items(25)
+        self.expected = list(
+            Item.objects.order_by("-created_at", "-id").values_list("title", flat=True)
+        )
+
+    def get_page(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("core:home"), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries if "COUNT(" in q["sql"]])
+        # the page of items and the facet counts
+        self.assertEqual(len(queries), 2)
+        return response.context["page_obj"]
+
+    def test_walk_forwards_and_back(self):
+        pages = [self.get_page()]
+        while pages[-1].has_next():
+            pages.append(self.get_page(after=pages[-1].next_cursor))
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([item.title for page in pages for item in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+
+        previous = self.get_page(before=pages[2].previous_cursor)
+        self.assertEqual([item.title for item in previous], self.expected[10:20])
+        self.assertTrue(previous.has_previous())
+
+    def test_description_is_not_loaded(self):
+        item = self.get_page().object_list[0]
+        self.assertIn("description", item.get_deferred_fields())
+
+    def test_invalid_cursor_is_a_404(self):
+        response = self.client.get(reverse("core:home"), {"after": "nonsense"})
+        self.assertEqual(response.status_code, 404)
+
+
+@without_debug_toolbar
+class ItemFragmentCacheTests(CartTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.item = Item.objects.create(
+            title="Shirt",
+            price=10.0,
+            category="S",
+            label="P",
+            slug="shirt",
+            description="A shirt",
+            image="shirt.jpg",
+        )
+
+    def fragment_key(self, name, item):
+        return make_template_fragment_key(name, [item.id, item.updated_at])
+
+    def test_fragments_are_cached_and_dropped_on_save(self):
+        self.client.get(reverse("core:home"))
+        self.client.get(self.item.get_absolute_url())
+        item = Item.objects.get()
+        for name in ITEM_FRAGMENTS:
+            self.assertIsNotNone(cache.get(self.fragment_key(name, item)))
+
+        old_keys = [self.fragment_key(name, item) for name in ITEM_FRAGMENTS]
+        item.title = "Renamed shirt"
+        item.save()
+        self.assertEqual(cache.get_many(old_keys), {})
+        self.assertContains(self.client.get(reverse("core:home")), "Renamed shirt")
+
+    def test_fragments_are_dropped_on_delete(self):
+        self.client.get(self.item.get_absolute_url())
+        item = Item.objects.get()
+        key = self.fragment_key("item_detail", item)
+        self.assertIsNotNone(cache.get(key))
+        item.delete()
+        self.assertIsNone(cache.get(key))
+
+
+@without_debug_toolbar
+class CatalogPageCacheTests(CartTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.logout()
+        (self.item,) = self.create_items(1)
+
+    def test_anonymous_pages_are_cached_and_revalidated(self):
+        response = self.client.get(reverse("core:home"))
+        self.assertContains(response, "Shirt 0")
+        self.assertContains(response, "Login")
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+
+        with self.assertNumQueries(1):
+            cached = self.client.get(reverse("core:home"))
+        self.assertEqual(cached.content, response.content)
+
+        not_modified = self.client.get(reverse("core:home"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, 304)
+        not_modified = self.client.get(
+            reverse("core:home"), HTTP_IF_MODIFIED_SINCE=last_modified
+        )
+        self.assertEqual(not_modified.status_code, 304)
+
+        item = Item.objects.get()
+        item.title = "Renamed shirt"
+        item.save()
+        response = self.client.get(reverse("core:home"), HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, "Renamed shirt")
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_deleted_items_drop_out(self):
+        self.assertContains(self.client.get(reverse("core:home")), "Shirt 0")
+        Item.objects.get().delete()
+        self.assertNotContains(self.client.get(reverse("core:home")), "Shirt 0")
+
+    def test_logged_in_navbar_is_filled_in(self):
+        self.client.get(reverse("core:home"))
+        self.client.force_login(self.user)
+        cart.add_to_cart(self.user, self.item.slug)
+        cart.add_to_cart(self.user, self.item.slug)
+        response = self.client.get(reverse("core:home"))
+        self.assertContains(response, "Logout")
+        self.assertNotContains(response, "Login")
+        self.assertFalse(response.has_header("ETag"))
+        self.assertContains(response, "Shirt 0")
+
+    def test_pages_with_messages_are_not_cached(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse("core:add-to-cart", args=[self.item.slug]))
+        response = self.client.get(self.item.get_absolute_url())
+        self.assertContains(response, "This item was added to your cart.")
+        response = self.client.get(self.item.get_absolute_url())
+        self.assertNotContains(response, "This item was added to your cart.")
+
+
+@without_debug_toolbar
+class SearchTests(CartTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.shirt, self.jacket, self.hoodie = Item.objects.bulk_create(
+            [
+                Item(
+                    title="Linen shirt",
+                    price=10.0,
+                    category="S",
+                    label="P",
+                    slug="linen-shirt",
+                    description="Light and airy",
+                    image="shirt.jpg",
+                ),
+                Item(
+                    title="Rain jacket",
+                    price=50.0,
+                    category="OW",
+                    label="P",
+                    slug="rain-jacket",
+                    description="Wear it over a shirt",
+                    image="jacket.jpg",
+                ),
+                Item(
+                    title="Running hoodie",
+                    price=30.0,
+                    category="SW",
+                    label="S",
+                    slug="running-hoodie",
+                    description="Warm",
+                    image="hoodie.jpg",
+                ),
+            ]
+        )
+
+    def titles(self, query, category=None):
+        return [item.title for item in search_items(query, category=category)]
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(self.titles("shirt"), ["Linen shirt", "Rain jacket"])
+        self.assertEqual(self.titles("shi"), ["Linen shirt", "Rain jacket"])
+        self.assertEqual(self.titles("rain shirt"), ["Rain jacket"])
+        self.assertEqual(self.titles("  "), [])
+
+    def test_category_filter(self):
+        self.assertEqual(self.titles("shirt", category="OW"), ["Rain jacket"])
+
+    def test_index_follows_writes(self):
+        Item.objects.filter(pk=self.hoodie.pk).update(title="Running shirt")
+        self.assertIn("Running shirt", self.titles("shirt"))
+        self.jacket.delete()
+        self.assertEqual(self.titles("jacket"), [])
+
+    def test_dropped_triggers_are_put_back_after_migrate(self):
+        # as a migration rebuilding core_item leaves things
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER core_item_search_update")
+        Item.objects.filter(pk=self.hoodie.pk).update(title="Running shirt")
+        self.assertNotIn("Running shirt", self.titles("shirt"))
+        ensure_search_triggers()
+        self.assertIn("Running shirt", self.titles("shirt"))
+        Item.objects.filter(pk=self.shirt.pk).update(title="Linen blouse")
+        self.assertEqual(self.titles("blouse"), ["Linen blouse"])
+
+    def test_search_page(self):
+        response = self.client.get(reverse("core:search"), {"q": "hoodie"})
+        self.assertContains(response, "Running hoodie")
+        self.assertNotContains(response, "Linen shirt")
+
+
+@without_debug_toolbar
+@override_settings(CATALOG_PAGE_CACHE_TIMEOUT=0)
+class ItemFacetTests(CartTestMixin, TestCase):
+    def create_item(self, n, category, label, price=10.0):
+        return Item.objects.create(
+            title=f"Item {n}",
+            price=price,
+            category=category,
+            label=label,
+            slug=f"item-{n}",
+            description="An item",
+            image="item.jpg",
+        )
+
+    def counts(self, **kwargs):
+        return {
+            facet: {value: count for value, _, count in counts if count}
+            for facet, counts in ItemFacetCount.get_facet_counts(**kwargs).items()
+        }
+
+    def test_counts_follow_saves_and_deletes(self):
+        shirt = self.create_item(1, "S", "P")
+        self.create_item(2, "S", "D")
+        jacket = self.create_item(3, "OW", "D")
+        self.assertEqual(
+            self.counts(), {"category": {"S": 2, "OW": 1}, "label": {"P": 1, "D": 2}}
+        )
+        self.assertEqual(
+            self.counts(label="D"),
+            {"category": {"S": 1, "OW": 1}, "label": {"P": 1, "D": 2}},
+        )
+
+        shirt = Item.objects.get(pk=shirt.pk)
+        shirt.category = "SW"
+        shirt.save()
+        Item.objects.get(pk=jacket.pk).delete()
+        self.assertEqual(
+            self.counts(), {"category": {"S": 1, "SW": 1}, "label": {"P": 1, "D": 1}}
+        )
+
+        counts = list(ItemFacetCount.objects.values_list("category", "label", "count"))
+        ItemFacetCount.rebuild()
+        self.assertCountEqual(
+            ItemFacetCount.objects.filter(count__gt=0).values_list(
+                "category", "label", "count"
+            ),
+            [c for c in counts if c[2]],
+        )
+
+    def test_partly_loaded_items_move_between_counts(self):
+        shirt = self.create_item(1, "S", "P")
+        shirt = Item.objects.only("title").get(pk=shirt.pk)
+        shirt.title = "Renamed"
+        shirt.save()
+        shirt.category = "SW"
+        shirt.save()
+        shirt = Item.objects.only("title", "label").get(pk=shirt.pk)
+        shirt.label = "D"
+        shirt.save()
+        self.assertEqual(self.counts(), {"category": {"SW": 1}, "label": {"D": 1}})
+
+    def test_canal_batches_adjust_counts_for_created_items(self):
+        self.create_item(1, "S", "P")
+        with CaptureQueriesContext(connection) as queries:
+            Item.bulk_create_or_update_from_canal_json(
+                [canal_product_json(n) for n in range(3)]
+            )
+            Item.bulk_create_or_update_from_canal_json([canal_product_json(0)])
+        self.assertFalse(
+            [q for q in queries if q["sql"].startswith("DELETE")], "rebuilt"
+        )
+        self.assertEqual(
+            dict(ItemFacetCount.objects.values_list("category", "count")),
+            {"S": 1, "": 3},
+        )
+
+    def test_filters(self):
+        self.create_item(1, "S", "P", price=5.0)
+        self.create_item(2, "S", "D", price=15.0)
+        self.create_item(3, "OW", "D", price=25.0)
+
+        def titles(**params):
+            response = self.client.get(reverse("core:home"), params)
+            return sorted(item.title for item in response.context["object_list"])
+
+        self.assertEqual(titles(category="S"), ["Item 1", "Item 2"])
+        self.assertEqual(titles(label="D"), ["Item 2", "Item 3"])
+        self.assertEqual(titles(category="S", label="D"), ["Item 2"])
+        self.assertEqual(titles(price_min=10, price_max=20), ["Item 2"])
+        self.assertEqual(titles(category="nonsense"), ["Item 1", "Item 2", "Item 3"])
+
+        response = self.client.get(reverse("core:home"), {"category": "S"})
+        links = {link["name"]: link for link in response.context["label_links"]}
+        self.assertEqual(links["danger"]["count"], 1)
+        self.assertEqual(links["danger"]["query"], "category=S&label=D")
+
+
+class ItemSlugTests(CartTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        get_item_id_for_slug.cache_clear()
+
+    def test_colliding_titles_get_suffixes(self):
+        self.create_items(1)
+        Item.objects.create(title="Shirt 0", price=1.0, slug="shirt-0-2")
+        with self.assertNumQueries(2):
+            slugs = generate_item_slugs(["Shirt 0", "Shirt 0", "Rain Jacket!", ""])
+        self.assertEqual(slugs, ["shirt-0-3", "shirt-0-4", "rain-jacket", "item"])
+        with self.assertNumQueries(1):
+            self.assertEqual(generate_item_slugs(["New shirt"]), ["new-shirt"])
+
+    def test_canal_imports_with_the_same_title(self):
+        webhooks.apply_canal_events(
+            [
+                {"topic": "product/create", "data": canal_product_json(n, "A Shirt")}
+                for n in range(3)
+            ]
+        )
+        Item.create_or_update_from_canal_json(canal_product_json(3, "A Shirt"))
+        self.assertCountEqual(
+            Item.objects.values_list("slug", flat=True),
+            ["a-shirt", "a-shirt-2", "a-shirt-3", "a-shirt-4"],
+        )
+        # updates keep the slug
+        Item.create_or_update_from_canal_json(canal_product_json(3, "Renamed"))
+        self.assertEqual(Item.objects.get(canal_id="p3").slug, "a-shirt-4")
+
+    def test_lookups_are_cached_by_slug(self):
+        (item,) = self.create_items(1)
+        self.assertEqual(get_item_by_slug(item.slug).pk, item.pk)
+        with CaptureQueriesContext(connection) as queries:
+            get_item_by_slug(item.slug)
+        self.assertEqual(len(queries), 1)
+        self.assertIn(f".\"id\" = '{item.pk.hex}'", queries[0]["sql"])
+
+        Item.objects.filter(pk=item.pk).update(slug="renamed")
+        with self.assertRaises(Item.DoesNotExist):
+            get_item_by_slug(item.slug)
+        self.assertEqual(get_item_by_slug("renamed").pk, item.pk)
+        response = self.client.get(reverse("core:product", args=[item.slug]))
+        self.assertEqual(response.status_code, 404)
+
+
+class URLTemplateTests(SimpleTestCase):
+    def test_urls_match_reverse(self):
+        self.assertEqual(get_url_templates()["product"], "product/{slug}/")
+        for name, kwargs in (
+            ("home", {}),
+            ("product", {"slug": "linen-shirt"}),
+            ("remove-single-item-from-cart", {"slug": "linen-shirt"}),
+            ("payment", {"payment_option": "a b ü?"}),
+        ):
+            with self.subTest(name):
+                self.assertEqual(
+                    core_url(name, **kwargs), reverse(f"core:{name}", kwargs=kwargs)
+                )
+
+    def test_script_prefix(self):
+        set_script_prefix("/shop/")
+        self.addCleanup(clear_script_prefix)
+        item = Item(slug="linen-shirt")
+        self.assertEqual(item.get_absolute_url(), "/shop/product/linen-shirt/")
+        self.assertEqual(
+            item.get_add_to_cart_url(), reverse("core:add-to-cart", args=[item.slug])
+        )
+
+
+class AddressBookTests(CartTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        (self.item,) = self.create_items(1)
+        cart.add_to_cart(self.user, self.item.slug)
+
+    def checkout(self, **data):
+        data.setdefault("payment_option", "S")
+        response = self.client.post(reverse("core:checkout"), data)
+        self.assertEqual(response.status_code, 302)
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def test_identical_addresses_are_reused(self):
+        for street_address in ("1 Main St", " 1  main st "):
+            order = self.checkout(
+                shipping_address=street_address,
+                shipping_country="US",
+                shipping_zip="94105",
+                same_billing_address="on",
+            )
+        self.assertEqual(Address.objects.count(), 2)
+        self.assertEqual(order.shipping_address.address_type, "S")
+        self.assertEqual(order.billing_address.address_type, "B")
+        self.assertEqual(order.billing_address.street_address, "1 Main St")
+
+    def test_defaults(self):
+        for street_address in ("1 Main St", "2 Main St"):
+            self.checkout(
+                shipping_address=street_address,
+                shipping_country="US",
+                shipping_zip="94105",
+                set_default_shipping="on",
+                billing_address="3 Main St",
+                billing_country="US",
+                billing_zip="94105",
+                set_default_billing="on",
+            )
+        with self.assertNumQueries(1):
+            defaults = Address.get_defaults(self.user)
+        self.assertEqual(defaults["S"].street_address, "2 Main St")
+        self.assertEqual(defaults["B"].street_address, "3 Main St")
+        self.assertEqual(Address.objects.filter(default=True).count(), 2)
+
+        order = self.checkout(use_default_shipping="on", use_default_billing="on")
+        self.assertEqual(order.shipping_address, defaults["S"])
+        self.assertEqual(order.billing_address, defaults["B"])
+        self.assertEqual(Address.objects.count(), 3)
+
+
+@without_debug_toolbar
+class CheckoutQueryCountTests(CartTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        (item,) = self.create_items(1)
+        cart.add_to_cart(self.user, item.slug)
+
+    def test_queries_per_submit(self):
+        new_address = {
+            "shipping_address": "1 Main St",
+            "shipping_country": "US",
+            "shipping_zip": "94105",
+            "set_default_shipping": "on",
+            "same_billing_address": "on",
+            "payment_option": "S",
+        }
+        # (queries, writes), savepoints included in the queries: session, user,
+        # order; then per new address a lookup and an insert, making one the
+        # default takes two updates; then the one order update
+        for label, data, expected in (
+            ("new addresses", new_address, (18, 5)),
+            ("known addresses", new_address, (7, 0)),
+            (
+                "defaults",
+                {"use_default_shipping": "on", "payment_option": "S"},
+                (6, 0),
+            ),
+        ):
+            with self.subTest(label), CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse("core:checkout"), data)
+                self.assertRedirects(
+                    response,
+                    reverse("core:payment", args=["stripe"]),
+                    fetch_redirect_response=False,
+                )
+                writes = [
+                    q
+                    for q in queries
+                    if q["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+                ]
+                self.assertEqual((len(queries), len(writes)), expected)
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.shipping_address.street_address, "1 Main St")
+        self.assertEqual(order.billing_address.address_type, "B")
+
+    def test_missing_default_writes_nothing(self):
+        self.client.post(
+            reverse("core:checkout"),
+            {
+                "shipping_address": "1 Main St",
+                "shipping_country": "US",
+                "shipping_zip": "94105",
+                "use_default_billing": "on",
+                "payment_option": "S",
+            },
+        )
+        self.assertFalse(Address.objects.exists())
+        self.assertIsNone(Order.objects.get().shipping_address)
+
+
+@without_debug_toolbar
+@override_settings(PAYMENT_GATEWAY="core.payments.FakeGateway")
+class PaymentGatewayTests(CartTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        (item,) = self.create_items(1)
+        cart.add_to_cart(self.user, item.slug)
+        address = Address.get_or_add(
+            self.user,
+            "B",
+            street_address="1 Main St",
+            apartment_address="",
+            country="US",
+            zip="94105",
+        )
+        Order.objects.update(billing_address=address)
+        # a fresh fake for each test
+        get_payment_gateway.cache_clear()
+        self.gateway = get_payment_gateway()
+
+    def pay(self, **data):
+        return self.client.post(reverse("core:payment", args=["stripe"]), data)
+
+    def test_default_card_is_cached_on_the_profile(self):
+        self.pay(stripeToken="tok_visa", save="on")
+        self.assertEqual(
+            [name for name, _ in self.gateway.calls],
+            ["create_customer", "add_card", "charge"],
+        )
+        self.assertTrue(Order.objects.get().ordered)
+
+        cart.add_to_cart(self.user, Item.objects.get().slug)
+        Order.objects.filter(ordered=False).update(
+            billing_address=Address.objects.get()
+        )
+        self.gateway.calls.clear()
+        for _ in range(2):
+            response = self.client.get(reverse("core:payment", args=["stripe"]))
+            self.assertContains(response, "**** **** **** 4242")
+        self.assertEqual(self.gateway.calls, [])
+
+        with override_settings(PAYMENT_CARD_CACHE_TIMEOUT=-1):
+            self.client.get(reverse("core:payment", args=["stripe"]))
+        self.assertEqual([name for name, _ in self.gateway.calls], ["get_default_card"])
+
+    def test_incomplete_gateway_cannot_be_created(self):
+        class NoChargeGateway(PaymentGateway):
+            def create_customer(self, email):
+                return "cus_1"
+
+            def add_card(self, customer_id, token):
+                return {}
+
+            def get_default_card(self, customer_id):
+                return None
+
+        with self.assertRaises(TypeError):
+            NoChargeGateway()
+
+    def test_declined_card(self):
+        response = self.pay(stripeToken=DECLINED_TOKEN)
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+        self.assertFalse(Order.objects.get().ordered)
+        self.assertEqual(self.gateway.charges, [])
+        # the claim is released, so the order can be paid with another card
+        self.assertFalse(Payment.objects.exists())
+        self.pay(stripeToken="tok_visa")
+        self.assertTrue(Order.objects.get().ordered)
+
+    def test_resubmitted_payment_is_charged_once(self):
+        for _ in range(2):
+            response = self.pay(stripeToken="tok_visa")
+            self.assertRedirects(response, "/", fetch_redirect_response=False)
+        self.assertEqual(len(self.gateway.charges), 1)
+        self.assertEqual(Order.objects.get().payment, Payment.objects.get())
+
+    def test_submit_with_another_card_while_paying_is_not_charged(self):
+        order = Order.objects.get()
+        amount = int(order.get_total() * 100)
+        claim_payment(
+            self.user, order.get_total(), payment_idempotency_key(order, amount)
+        )
+        response = self.pay(stripeToken="tok_mastercard")
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+        self.assertEqual(self.gateway.calls, [])
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_stale_claim_is_taken_over(self):
+        payment, claimed = claim_payment(self.user, 10.0, "key")
+        self.assertTrue(claimed)
+        self.assertEqual(claim_payment(self.user, 10.0, "key"), (payment, False))
+        with override_settings(PAYMENT_CLAIM_TIMEOUT=-1):
+            self.assertEqual(claim_payment(self.user, 10.0, "key"), (payment, True))
+        Payment.objects.update(stripe_charge_id="ch_1")
+        with override_settings(PAYMENT_CLAIM_TIMEOUT=-1):
+            self.assertFalse(claim_payment(self.user, 10.0, "key")[1])
+
+
+@without_debug_toolbar
+@override_settings(PAYMENT_GATEWAY="core.payments.FakeGateway")
+class PaymentConcurrencyTests(CartTestMixin, TransactionTestCase):
+    def test_concurrent_submits_make_one_charge(self):
+        (item,) = self.create_items(1)
+        cart.add_to_cart(self.user, item.slug)
+        get_payment_gateway.cache_clear()
+        gateway = get_payment_gateway()
+        # long enough for every submit to arrive while the first is charging
+        gateway.latency = 0.2
+
+        def pay(i):
+            try:
+                client = Client()
+                client.force_login(self.user)
+                return client.post(
+                    reverse("core:payment", args=["stripe"]),
+                    {"stripeToken": "tok_visa"},
+                ).status_code
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            self.assertEqual(set(executor.map(pay, range(8))), {302})
+
+        self.assertEqual([name for name, _ in gateway.calls], ["charge"])
+        self.assertTrue(Order.objects.get().ordered)
+        self.assertEqual(Payment.objects.count(), 1)
+
+
+@without_debug_toolbar
+@override_settings(PAYMENT_GATEWAY="core.payments.FakeGateway")
+class OrderFinalizationTests(CartTestMixin, TestCase):
+    def pay_for_cart(self, count):
+        Order.objects.all().delete()
+        OrderItem.objects.all().delete()
+        Item.objects.all().delete()
+        order = Order.objects.create(
+            user=self.user,
+            ordered_date=timezone.now(),
+            billing_address=Address.get_or_add(
+                self.user,
+                "B",
+                street_address="1 Main St",
+                apartment_address="",
+                country="US",
+                zip="94105",
+            ),
+        )
+        order.items.add(
+            *OrderItem.objects.bulk_create(
+                OrderItem(user=self.user, item=item)
+                for item in self.create_items(count)
+            )
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(
+                reverse("core:payment", args=["stripe"]), {"stripeToken": "tok_visa"}
+            )
+        return len(queries)
+
+    def test_constant_queries(self):
+        self.assertEqual(self.pay_for_cart(1), 19)
+        self.assertEqual(self.pay_for_cart(30), 19)
+        order = Order.objects.get()
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment.amount, 300.0)
+        self.assertEqual(len(order.ref_code), 20)
+        self.assertFalse(OrderItem.objects.filter(ordered=False).exists())
+        self.assertTrue(
+            CanalOutboxEntry.objects.filter(
+                topic="order/create", object_id=order.id
+            ).exists()
+        )
@@ -0,0 +1,75 @@
+import re
+from functools import lru_cache
+from typing import Any, Dict
+from urllib.parse import quote
+
+from django.core.signals import setting_changed
+from django.urls import NoReverseMatch, get_script_prefix, reverse
+from django.urls.resolvers import RoutePattern
+
+# reverse() resolves a URL name against the whole URLconf on every call, which
+# adds up on pages linking to every item several times. The core URLconf's
+# routes are plain path() patterns, so each one is reversed once with marker
+# arguments and kept as a format string that later calls just fill in.
+
+# What reverse() leaves unquoted in arguments
+SAFE_CHARACTERS = "!$&'()*+,;=/~:@"
+needs_quoting = re.compile(r"[^-A-Za-z0-9_.!$&'()*+,;=/~:@]").search
+
+
+def url_marker(name: str) -> str:
+    # matches the str and slug converters and survives quoting
+    return f"urltemplate0{name}0"
+
+
+@lru_cache(maxsize=None)
+def get_url_templates() -> Dict[str, str]:
+    """
+    Format strings of the named ``core`` URLs without the script prefix, e.g.
+    ``{"product": "product/{slug}/"}``. Built the first time a URL is asked for
+    and then kept for the life of the process.
+    """
+    from core import urls
+
+    templates = {}
+    for pattern in urls.urlpatterns:
+        if not pattern.name or not isinstance(pattern.pattern, RoutePattern):
+            continue
+        params = list(pattern.pattern.converters)
+        try:
+            url = reverse(
+                f"{urls.app_name}:{pattern.name}",
+                kwargs={param: url_marker(param) for param in params},
+            )
+        except NoReverseMatch:
+            # e.g. an int converter, left to reverse()
+            continue
+        template = url[len(get_script_prefix()) :].replace("{", "{{").replace("}", "}}")
+        for param in params:
+            template = template.replace(url_marker(param), f"{{{param}}}")
+        templates[pattern.name] = template
+    return templates
+
+
+def core_url(name: str, **kwargs: Any) -> str:
+    """
+    ``reverse(f"core:{name}", kwargs=kwargs)`` from the precompiled templates.
+    """
+    template = get_url_templates().get(name)
+    if template is None:
+        return reverse(f"core:{name}", kwargs=kwargs)
+    for param, value in kwargs.items():
+        value = str(value)
+        # slugs, the usual argument, never need it
+        if needs_quoting(value):
+            value = quote(value, safe=SAFE_CHARACTERS)
+        kwargs[param] = value
+    return get_script_prefix() + template.format(**kwargs)
+
+
+def clear_url_templates(*, setting: str, **kwargs: Any) -> None:
+    if setting == "ROOT_URLCONF":
+        get_url_templates.cache_clear()
+
+
+setting_changed.connect(clear_url_templates)
@@ -3,6 +3,7 @@ from .views import (
     ItemDetailView,
     CheckoutView,
     HomeView,
+    SearchView,
     OrderSummaryView,
     add_to_cart,
     remove_from_cart,
@@ -14,13 +15,18 @@ from .views import (
 )
 from django.views.decorators.csrf import csrf_exempt
 
+from .page_cache import cache_catalog_page
+
 app_name = "core"
 
 urlpatterns = [
-    path("", HomeView.as_view(), name="home"),
+    path("", cache_catalog_page(HomeView.as_view()), name="home"),
+    path("search/", cache_catalog_page(SearchView.as_view()), name="search"),
     path("checkout/", CheckoutView.as_view(), name="checkout"),
     path("order-summary/", OrderSummaryView.as_view(), name="order-summary"),
-    path("product/<slug>/", ItemDetailView.as_view(), name="product"),
+    path(
+        "product/<slug>/", cache_catalog_page(ItemDetailView.as_view()), name="product"
+    ),
     path("add-to-cart/<slug>/", add_to_cart, name="add-to-cart"),
     path("add-coupon/", AddCouponView.as_view(), name="add-coupon"),
     path("remove-from-cart/<slug>/", remove_from_cart, name="remove-from-cart"),
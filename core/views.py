@@ -1,6 +1,4 @@
 import json
-import random
-import string
 from typing import Any
 
 import stripe
@@ -9,30 +7,33 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponse
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import redirect
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import render
 from django.utils import timezone
+from django.utils.http import urlencode
 from django.views.generic import ListView, DetailView, View
 
-from .forms import CheckoutForm, CouponForm, RefundForm, PaymentForm
+from . import cart, payments
+from .cart import invalidate_cart_summary
+from .forms import CheckoutForm, CouponForm, ItemFilterForm, RefundForm, PaymentForm
+from .pagination import paginate_by_cursor
 from .models import (
     Item,
+    ItemFacetCount,
     OrderItem,
     Order,
     Address,
-    Payment,
     Coupon,
     Refund,
     UserProfile,
     CANAL_WEBHOOK_TOPIC_MODEL,
+    CATEGORY_CHOICES,
+    get_item_by_slug,
 )
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
-
-def create_ref_code():
-    return "".join(random.choices(string.ascii_lowercase + string.digits, k=20))
+from .search import search_items
+from .webhooks import apply_canal_events, record_canal_event
 
 
 def products(request):
@@ -40,6 +41,10 @@ def products(request):
     return render(request, "products.html", context)
 
 
+# URL argument of the payment page for each CheckoutForm payment option
+PAYMENT_OPTIONS = {"S": "stripe", "T": "test", "P": "paypal"}
+
+
 def is_valid_form(values):
     valid = True
     for field in values:
@@ -51,7 +56,7 @@ def is_valid_form(values):
 class CheckoutView(View):
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = cart.get_active_order(self.request.user)
             form = CheckoutForm()
             context = {
                 "form": form,
@@ -60,158 +65,105 @@ class CheckoutView(View):
                 "DISPLAY_COUPON_FORM": True,
             }
 
-            shipping_address_qs = Address.objects.filter(
-                user=self.request.user, address_type="S", default=True
-            )
-            if shipping_address_qs.exists():
-                context.update({"default_shipping_address": shipping_address_qs[0]})
-
-            billing_address_qs = Address.objects.filter(
-                user=self.request.user, address_type="B", default=True
-            )
-            if billing_address_qs.exists():
-                context.update({"default_billing_address": billing_address_qs[0]})
+            defaults = Address.get_defaults(self.request.user)
+            if "S" in defaults:
+                context.update({"default_shipping_address": defaults["S"]})
+            if "B" in defaults:
+                context.update({"default_billing_address": defaults["B"]})
             return render(self.request, "checkout.html", context)
         except ObjectDoesNotExist:
             messages.info(self.request, "You do not have an active order")
             return redirect("core:checkout")
 
+    def add_entered_address(self, form, kind, address_type):
+        """
+        The ``kind`` ("shipping" or "billing") address typed into the form,
+        from the user's address book, or None if it's incomplete.
+        """
+        street_address = form.cleaned_data.get(f"{kind}_address")
+        country = form.cleaned_data.get(f"{kind}_country")
+        zip = form.cleaned_data.get(f"{kind}_zip")
+        if not is_valid_form([street_address, country, zip]):
+            messages.info(
+                self.request, f"Please fill in the required {kind} address fields"
+            )
+            return None
+        return Address.get_or_add(
+            self.request.user,
+            address_type,
+            street_address=street_address,
+            apartment_address=form.cleaned_data.get(f"{kind}_address2"),
+            country=country,
+            zip=zip,
+            default=form.cleaned_data.get(f"set_default_{kind}"),
+        )
+
     def post(self, *args, **kwargs):
         form = CheckoutForm(self.request.POST or None)
-        try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            if form.is_valid():
-
-                use_default_shipping = form.cleaned_data.get("use_default_shipping")
-                if use_default_shipping:
-                    print("Using the defualt shipping address")
-                    address_qs = Address.objects.filter(
-                        user=self.request.user, address_type="S", default=True
-                    )
-                    if address_qs.exists():
-                        shipping_address = address_qs[0]
-                        order.shipping_address = shipping_address
-                        order.save()
-                    else:
-                        messages.info(
-                            self.request, "No default shipping address available"
-                        )
-                        return redirect("core:checkout")
-                else:
-                    print("User is entering a new shipping address")
-                    shipping_address1 = form.cleaned_data.get("shipping_address")
-                    shipping_address2 = form.cleaned_data.get("shipping_address2")
-                    shipping_country = form.cleaned_data.get("shipping_country")
-                    shipping_zip = form.cleaned_data.get("shipping_zip")
-
-                    if is_valid_form(
-                        [shipping_address1, shipping_country, shipping_zip]
-                    ):
-                        shipping_address = Address(
-                            user=self.request.user,
-                            street_address=shipping_address1,
-                            apartment_address=shipping_address2,
-                            country=shipping_country,
-                            zip=shipping_zip,
-                            address_type="S",
-                        )
-                        shipping_address.save()
-
-                        order.shipping_address = shipping_address
-                        order.save()
-
-                        set_default_shipping = form.cleaned_data.get(
-                            "set_default_shipping"
-                        )
-                        if set_default_shipping:
-                            shipping_address.default = True
-                            shipping_address.save()
-
-                    else:
-                        messages.info(
-                            self.request,
-                            "Please fill in the required shipping address fields",
-                        )
-
-                use_default_billing = form.cleaned_data.get("use_default_billing")
-                same_billing_address = form.cleaned_data.get("same_billing_address")
-
-                if same_billing_address:
-                    billing_address = shipping_address
-                    billing_address.pk = None
-                    billing_address.save()
-                    billing_address.address_type = "B"
-                    billing_address.save()
-                    order.billing_address = billing_address
-                    order.save()
-
-                elif use_default_billing:
-                    print("Using the defualt billing address")
-                    address_qs = Address.objects.filter(
-                        user=self.request.user, address_type="B", default=True
-                    )
-                    if address_qs.exists():
-                        billing_address = address_qs[0]
-                        order.billing_address = billing_address
-                        order.save()
-                    else:
-                        messages.info(
-                            self.request, "No default billing address available"
-                        )
-                        return redirect("core:checkout")
-                else:
-                    print("User is entering a new billing address")
-                    billing_address1 = form.cleaned_data.get("billing_address")
-                    billing_address2 = form.cleaned_data.get("billing_address2")
-                    billing_country = form.cleaned_data.get("billing_country")
-                    billing_zip = form.cleaned_data.get("billing_zip")
-
-                    if is_valid_form([billing_address1, billing_country, billing_zip]):
-                        billing_address = Address(
-                            user=self.request.user,
-                            street_address=billing_address1,
-                            apartment_address=billing_address2,
-                            country=billing_country,
-                            zip=billing_zip,
-                            address_type="B",
-                        )
-                        billing_address.save()
+        if not form.is_valid():
+            messages.warning(self.request, "Invalid payment option selected")
+            return redirect("core:checkout")
+        data = form.cleaned_data
 
-                        order.billing_address = billing_address
-                        order.save()
+        # One unit of work: the addresses are resolved first and the order is
+        # written once at the end, or not at all when checkout bails out.
+        with transaction.atomic():
+            try:
+                order = Order.objects.select_for_update().get(
+                    user=self.request.user, ordered=False
+                )
+            except ObjectDoesNotExist:
+                messages.warning(self.request, "You do not have an active order")
+                return redirect("core:order-summary")
 
-                        set_default_billing = form.cleaned_data.get(
-                            "set_default_billing"
-                        )
-                        if set_default_billing:
-                            billing_address.default = True
-                            billing_address.save()
+            if data.get("use_default_shipping") or data.get("use_default_billing"):
+                defaults = Address.get_defaults(self.request.user)
 
-                    else:
-                        messages.info(
-                            self.request,
-                            "Please fill in the required billing address fields",
-                        )
+            if data.get("use_default_shipping"):
+                shipping_address = defaults.get("S")
+                if shipping_address is None:
+                    messages.info(self.request, "No default shipping address available")
+                    return redirect("core:checkout")
+            else:
+                shipping_address = self.add_entered_address(form, "shipping", "S")
+
+            if data.get("same_billing_address"):
+                billing_address = shipping_address and Address.get_or_add(
+                    self.request.user,
+                    "B",
+                    street_address=shipping_address.street_address,
+                    apartment_address=shipping_address.apartment_address,
+                    country=shipping_address.country,
+                    zip=shipping_address.zip,
+                )
+            elif data.get("use_default_billing"):
+                billing_address = defaults.get("B")
+                if billing_address is None:
+                    transaction.set_rollback(True)
+                    messages.info(self.request, "No default billing address available")
+                    return redirect("core:checkout")
+            else:
+                billing_address = self.add_entered_address(form, "billing", "B")
 
-                payment_option = form.cleaned_data.get("payment_option")
+            update_fields = []
+            for field, address in (
+                ("shipping_address", shipping_address),
+                ("billing_address", billing_address),
+            ):
+                if address is not None and getattr(order, f"{field}_id") != address.pk:
+                    setattr(order, field, address)
+                    update_fields.append(field)
+            if update_fields:
+                order.save(update_fields=[*update_fields, "updated_at"])
 
-                if payment_option == "S":
-                    return redirect("core:payment", payment_option="stripe")
-                elif payment_option == "T":
-                    return redirect("core:payment", payment_option="test")
-                elif payment_option == "P":
-                    return redirect("core:payment", payment_option="paypal")
-                else:
-                    messages.warning(self.request, "Invalid payment option selected")
-                    return redirect("core:checkout")
-        except ObjectDoesNotExist:
-            messages.warning(self.request, "You do not have an active order")
-            return redirect("core:order-summary")
+        return redirect(
+            "core:payment", payment_option=PAYMENT_OPTIONS[data["payment_option"]]
+        )
 
 
 class PaymentView(View):
     def get(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
+        order = cart.get_active_order(self.request.user)
         if order.billing_address:
             context = {
                 "order": order,
@@ -220,80 +172,78 @@ class PaymentView(View):
             }
             userprofile = self.request.user.userprofile
             if userprofile.one_click_purchasing:
-                # fetch the users card list
-                cards = stripe.Customer.list_sources(
-                    userprofile.stripe_customer_id, limit=3, object="card"
-                )
-                card_list = cards["data"]
-                if len(card_list) > 0:
-                    # update the context with the default card
-                    context.update({"card": card_list[0]})
+                card = payments.get_default_card(userprofile)
+                if card is not None:
+                    context.update({"card": card})
             return render(self.request, "payment.html", context)
         else:
             messages.warning(self.request, "You have not added a billing address")
             return redirect("core:checkout")
 
     def post(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
+        try:
+            order = cart.get_active_order(self.request.user)
+        except ObjectDoesNotExist:
+            # e.g. a resubmission of a payment that has gone through since
+            messages.info(self.request, "You do not have an active order")
+            return redirect("/")
         form = PaymentForm(self.request.POST)
         userprofile = UserProfile.objects.get(user=self.request.user)
         if form.is_valid():
             token = form.cleaned_data.get("stripeToken")
             save = form.cleaned_data.get("save")
             use_default = form.cleaned_data.get("use_default")
+            gateway = payments.get_payment_gateway()
 
-            if save:
-                if (
-                    userprofile.stripe_customer_id != ""
-                    and userprofile.stripe_customer_id is not None
-                ):
-                    customer = stripe.Customer.retrieve(userprofile.stripe_customer_id)
-                    customer.sources.create(source=token)
+            amount = int(order.get_total() * 100)
 
+            # Every submission for the order shares its key, double clicks and
+            # other tabs alike, only the request claiming the payment charges
+            key = payments.payment_idempotency_key(order, amount)
+            payment, claimed = payments.claim_payment(
+                self.request.user, order.get_total(), key
+            )
+            charge_key = payments.charge_idempotency_key(payment)
+            if not claimed:
+                if payment.stripe_charge_id:
+                    messages.success(self.request, "Your order was successful!")
                 else:
-                    customer = stripe.Customer.create(
-                        email=self.request.user.email,
-                    )
-                    customer.sources.create(source=token)
-                    userprofile.stripe_customer_id = customer["id"]
-                    userprofile.one_click_purchasing = True
-                    userprofile.save()
-
-            amount = int(order.get_total() * 100)
+                    messages.info(self.request, "Your payment is being processed")
+                return redirect("/")
 
+            charged = False
             try:
+                if save:
+                    if userprofile.stripe_customer_id:
+                        gateway.add_card(userprofile.stripe_customer_id, token)
+                        # an added card only becomes the default if it's the first
+                        payments.forget_default_card(userprofile)
+                    else:
+                        userprofile.stripe_customer_id = gateway.create_customer(
+                            self.request.user.email
+                        )
+                        userprofile.one_click_purchasing = True
+                        userprofile.save()
+                        payments.set_default_card(
+                            userprofile,
+                            gateway.add_card(userprofile.stripe_customer_id, token),
+                        )
 
                 if use_default or save:
                     # charge the customer because we cannot charge the token more than once
-                    charge = stripe.Charge.create(
-                        amount=amount,  # cents
-                        currency="usd",
-                        customer=userprofile.stripe_customer_id,
+                    charge = gateway.charge(
+                        amount,
+                        customer_id=userprofile.stripe_customer_id,
+                        idempotency_key=charge_key,
                     )
                 else:
                     # charge once off on the token
-                    charge = stripe.Charge.create(
-                        amount=amount, currency="usd", source=token  # cents
+                    charge = gateway.charge(
+                        amount, token=token, idempotency_key=charge_key
                     )
+                charged = True
 
-                # create the payment
-                payment = Payment()
-                payment.stripe_charge_id = charge["id"]
-                payment.user = self.request.user
-                payment.amount = order.get_total()
-                payment.save()
-
-                # assign the payment to the order
-
-                order_items = order.items.all()
-                order_items.update(ordered=True)
-                for item in order_items:
-                    item.save()
-
-                order.ordered = True
-                order.payment = payment
-                order.ref_code = create_ref_code()
-                order.save()
+                cart.finalize_order(order, payment, charge["id"])
 
                 messages.success(self.request, "Your order was successful!")
                 return redirect("/")
@@ -342,6 +292,10 @@ class PaymentView(View):
                 )
                 return redirect("/")
 
+            finally:
+                if not charged:
+                    payments.release_payment(payment)
+
         messages.warning(self.request, "Invalid data received")
         return redirect("/payment/stripe/")
 
@@ -351,23 +305,102 @@ class HomeView(ListView):
     paginate_by = 10
     template_name = "home.html"
 
+    def get_queryset(self):
+        form = ItemFilterForm(self.request.GET)
+        form.is_valid()
+        # invalid filters are left out rather than failing the page
+        self.filters = {
+            name: value
+            for name, value in form.cleaned_data.items()
+            if value not in (None, "")
+        }
+        items = Item.objects.only(*Item.card_fields)
+        if "category" in self.filters:
+            items = items.filter(category=self.filters["category"])
+        if "label" in self.filters:
+            items = items.filter(label=self.filters["label"])
+        if "price_min" in self.filters:
+            items = items.filter(price__gte=self.filters["price_min"])
+        if "price_max" in self.filters:
+            items = items.filter(price__lte=self.filters["price_max"])
+        return items
+
+    def get_facet_links(self, facet, counts):
+        other_filters = {
+            name: value for name, value in self.filters.items() if name != facet
+        }
+        return [
+            {
+                "name": name,
+                "count": count,
+                "query": urlencode({**other_filters, facet: value}),
+                "active": self.filters.get(facet) == value,
+            }
+            for value, name, count in counts
+        ]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        facet_counts = ItemFacetCount.get_facet_counts(
+            category=self.filters.get("category"), label=self.filters.get("label")
+        )
+        context.update(
+            {
+                "filters": self.filters,
+                "filter_query": urlencode(self.filters),
+                "all_categories_query": urlencode(
+                    {
+                        name: value
+                        for name, value in self.filters.items()
+                        if name != "category"
+                    }
+                ),
+                "category_links": self.get_facet_links(
+                    "category", facet_counts["category"]
+                ),
+                "label_links": self.get_facet_links("label", facet_counts["label"]),
+            }
+        )
+        return context
+
+    def paginate_queryset(self, queryset, page_size):
+        page = paginate_by_cursor(
+            queryset,
+            page_size,
+            after=self.request.GET.get("after"),
+            before=self.request.GET.get("before"),
+        )
+        return None, page, page.object_list, page.has_other_pages()
+
+
+class SearchView(ListView):
+    template_name = "search.html"
+
+    def get_queryset(self):
+        return search_items(
+            self.request.GET.get("q", ""),
+            category=self.request.GET.get("category") or None,
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(
+            {
+                "query": self.request.GET.get("q", ""),
+                "category": self.request.GET.get("category", ""),
+                "categories": CATEGORY_CHOICES,
+            }
+        )
+        return context
+
 
 class OrderSummaryView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = cart.get_active_order(self.request.user)
         except ObjectDoesNotExist:
             messages.warning(self.request, "You do not have an active order")
             return redirect("/")
-        except Order.MultipleObjectsReturned:
-            order = (
-                Order.objects.filter(user=self.request.user, ordered=False)
-                .order_by("-created_at")
-                .first()
-            )
-            Order.objects.filter(user=self.request.user, ordered=False).exclude(
-                id=order.id
-            ).delete()
         context = {"object": order}
         return render(self.request, "order_summary.html", context)
 
@@ -376,81 +409,52 @@ class ItemDetailView(DetailView):
     model = Item
     template_name = "product.html"
 
+    def get_object(self, queryset=None):
+        try:
+            return get_item_by_slug(self.kwargs["slug"], queryset)
+        except Item.DoesNotExist:
+            raise Http404("No Item matches the given query.")
+
 
 @login_required
 def add_to_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item, user=request.user, ordered=False
-    )
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "This item quantity was updated.")
-            return redirect("core:order-summary")
-        else:
-            order.items.add(order_item)
-            messages.info(request, "This item was added to your cart.")
-            return redirect("core:order-summary")
-    else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
+    try:
+        created = cart.add_to_cart(request.user, slug)
+    except Item.DoesNotExist:
+        raise Http404("No Item matches the given query.")
+    if created:
         messages.info(request, "This item was added to your cart.")
-        return redirect("core:order-summary")
+    else:
+        messages.info(request, "This item quantity was updated.")
+    return redirect("core:order-summary")
 
 
-@login_required
-def remove_from_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False
-            )[0]
-            order.items.remove(order_item)
-            order_item.delete()
-            messages.info(request, "This item was removed from your cart.")
-            return redirect("core:order-summary")
-        else:
-            messages.info(request, "This item was not in your cart")
-            return redirect("core:product", slug=slug)
+def cart_item_missing(request, slug):
+    try:
+        get_item_by_slug(slug, Item.objects.only("id"))
+    except Item.DoesNotExist:
+        raise Http404("No Item matches the given query.")
+    if Order.objects.filter(user=request.user, ordered=False).exists():
+        messages.info(request, "This item was not in your cart")
     else:
         messages.info(request, "You do not have an active order")
-        return redirect("core:product", slug=slug)
+    return redirect("core:product", slug=slug)
+
+
+@login_required
+def remove_from_cart(request, slug):
+    if not cart.remove_from_cart(request.user, slug):
+        return cart_item_missing(request, slug)
+    messages.info(request, "This item was removed from your cart.")
+    return redirect("core:order-summary")
 
 
 @login_required
 def remove_single_item_from_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False
-            )[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order.items.remove(order_item)
-            messages.info(request, "This item quantity was updated.")
-            return redirect("core:order-summary")
-        else:
-            messages.info(request, "This item was not in your cart")
-            return redirect("core:product", slug=slug)
-    else:
-        messages.info(request, "You do not have an active order")
-        return redirect("core:product", slug=slug)
+    if not cart.remove_single_item_from_cart(request.user, slug):
+        return cart_item_missing(request, slug)
+    messages.info(request, "This item quantity was updated.")
+    return redirect("core:order-summary")
 
 
 def get_coupon(request, code):
@@ -471,6 +475,7 @@ class AddCouponView(View):
                 order = Order.objects.get(user=self.request.user, ordered=False)
                 order.coupon = get_coupon(self.request, code)
                 order.save()
+                invalidate_cart_summary(self.request.user)
                 messages.success(self.request, "Successfully added coupon")
                 return redirect("core:checkout")
             except ObjectDoesNotExist:
@@ -512,10 +517,31 @@ class RequestRefundView(View):
 
 
 class CanalWebhookView(View):
+    """
+    Receives Canal webhooks. A single event, with its topic in the X-Canal-Topic
+    header, is stored in the inbox and acknowledged straight away; the
+    ``canal_webhook_worker`` command applies it. A batch, a list of
+    ``{"topic", "data"}`` objects, is applied right away and answered with a
+    status per event, see apply_canal_events.
+    """
+
     def post(self, *args: Any, **kwargs: Any) -> HttpResponse:
-        model = CANAL_WEBHOOK_TOPIC_MODEL[self.request.headers["X-Canal-Topic"]]
-        print(self.request.headers["X-Canal-Topic"])
-        canal_json = json.loads(self.request.body.decode())
-        print(canal_json)
-        obj = model.create_or_update_from_canal_json(canal_json=canal_json)
-        return HttpResponse({})
+        body = self.request.body.decode()
+        try:
+            canal_json = json.loads(body)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid JSON")
+        if isinstance(canal_json, list):
+            return JsonResponse({"results": apply_canal_events(canal_json)})
+        if not isinstance(canal_json, dict):
+            return HttpResponseBadRequest("Expected a JSON object or list")
+        topic = self.request.headers.get("X-Canal-Topic")
+        if topic not in CANAL_WEBHOOK_TOPIC_MODEL:
+            return HttpResponseBadRequest(f"Unknown topic {topic!r}")
+        event, created = record_canal_event(
+            topic, body, event_id=self.request.headers.get("X-Canal-Event-Id")
+        )
+        return JsonResponse(
+            {"status": "queued" if created else "duplicate"},
+            status=202 if created else 200,
+        )
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+from collections import defaultdict
+from operator import attrgetter
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, transaction
+
+from core import queue
+from core.models import CANAL_WEBHOOK_TOPIC_MODEL, CanalWebhookEvent
+
+logger = logging.getLogger(__name__)
+
+
+def record_canal_event(
+    topic: str, body: str, event_id: Optional[str] = None
+) -> Tuple[CanalWebhookEvent, bool]:
+    """
+    Stores a webhook in the inbox and returns it with whether it is new. The
+    event is keyed on Canal's event id when there is one, otherwise on the
+    payload itself, so a redelivery finds the stored event. A redelivered event
+    that had failed for good is queued again.
+    """
+    key_source = f"{topic}:{event_id}" if event_id else f"{topic}:{body}"
+    event_key = hashlib.sha256(key_source.encode()).hexdigest()
+    canal_json = json.loads(body)
+    try:
+        with transaction.atomic():
+            event = CanalWebhookEvent.objects.create(
+                event_key=event_key,
+                topic=topic,
+                payload=body,
+                canal_object_id=canal_json.get("id"),
+            )
+    except IntegrityError:
+        CanalWebhookEvent.objects.filter(event_key=event_key, status="F").update(
+            status="P", attempts=0
+        )
+        return CanalWebhookEvent.objects.get(event_key=event_key), False
+    return event, True
+
+
+def process_webhook_event(event: CanalWebhookEvent) -> None:
+    model = CANAL_WEBHOOK_TOPIC_MODEL[event.topic]
+    with transaction.atomic():
+        model.create_or_update_from_canal_json(json.loads(event.payload))
+
+
+def drain(workers: int = 4, batch_size: int = 100) -> int:
+    """
+    Applies pending webhook events until none are left and returns how many
+    were applied. Events for the same Canal object are applied in the order
+    they were received.
+    """
+    return queue.drain(
+        CanalWebhookEvent,
+        process_webhook_event,
+        group_key=attrgetter("canal_object_id"),
+        workers=workers,
+        batch_size=batch_size,
+    )
+
+
+def canal_error_code(error: Exception) -> str:
+    """
+    What a batch result says about an event that failed, without the internal
+    exception text, which is logged instead.
+    """
+    if isinstance(error, ObjectDoesNotExist):
+        return "not_found"
+    if isinstance(error, IntegrityError):
+        return "conflict"
+    if isinstance(error, (KeyError, IndexError, TypeError, ValueError)):
+        return "invalid_data"
+    return "internal_error"
+
+
+def apply_canal_events(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Applies a batch of ``{"topic": ..., "data": {...}}`` webhook events in one
+    transaction and returns a status for each. Events are grouped by model so
+    each model can look its rows up together, and models are applied in
+    registration order (products, orders, fulfillments) so references between
+    events in the same batch resolve.
+
+    Batches skip the inbox on purpose: they're Canal's bulk sync, which reads
+    the per-event results to decide what to resend, so they can't be answered
+    before they're applied. Each event is an upsert keyed on Canal ids, so a
+    redelivered batch leaves the same rows as applying it once, and a failed
+    event is retried by Canal resending it rather than by the worker.
+    """
+    results: List[Dict[str, Any]] = []
+    events_by_model = defaultdict(list)
+    for index, event in enumerate(events):
+        topic = event.get("topic") if isinstance(event, dict) else None
+        data = event.get("data") if isinstance(event, dict) else None
+        results.append({"topic": topic, "status": "ok"})
+        if topic not in CANAL_WEBHOOK_TOPIC_MODEL:
+            results[index].update(status="error", error="unknown_topic")
+        elif not isinstance(data, dict):
+            results[index].update(status="error", error="invalid_data")
+        else:
+            results[index]["id"] = data.get("id")
+            events_by_model[CANAL_WEBHOOK_TOPIC_MODEL[topic]].append((index, data))
+
+    with transaction.atomic():
+        for model in dict.fromkeys(CANAL_WEBHOOK_TOPIC_MODEL.values()):
+            if model not in events_by_model:
+                continue
+            indexes, canal_jsons = zip(*events_by_model[model])
+            errors = model.bulk_create_or_update_from_canal_json(list(canal_jsons))
+            for index, error in zip(indexes, errors):
+                if error is not None:
+                    logger.warning(
+                        "Canal %s event %s failed",
+                        results[index]["topic"],
+                        results[index]["id"],
+                        exc_info=error,
+                    )
+                    results[index].update(status="error", error=canal_error_code(error))
+    return results
@@ -77,3 +77,43 @@ LOGIN_REDIRECT_URL = "/"
 # CRISPY FORMS
 
 CRISPY_TEMPLATE_PACK = "bootstrap4"
+
+# CANAL
+
+# Outbox and webhook inbox entries that keep failing are given up on after this many tries
+CANAL_QUEUE_MAX_ATTEMPTS = 5
+
+# Seconds a worker has to process an entry it claimed before another worker
+# takes it over, so set it well above the slowest Canal call with its retries
+CANAL_QUEUE_LEASE = 300
+
+# Connections kept open to the Canal API, per worker process
+CANAL_CLIENT_POOL_SIZE = 10
+# Seconds before a Canal API call times out
+CANAL_CLIENT_TIMEOUT = 10
+# Attempts per Canal API call on connection errors and 5xx responses
+CANAL_CLIENT_MAX_RETRIES = 3
+
+# CART
+
+# Seconds a cart summary stays cached; cart views invalidate it on change,
+# this only bounds staleness from edits made elsewhere (e.g. the admin)
+CART_SUMMARY_CACHE_TIMEOUT = 300
+
+# CATALOG
+
+# Seconds a rendered home / product page stays cached for; it's keyed on the
+# newest Item.updated_at, so item changes show up straight away. 0 disables it
+CATALOG_PAGE_CACHE_TIMEOUT = 300
+
+# PAYMENTS
+
+# Class the payment views charge cards through, see core.payments
+PAYMENT_GATEWAY = "core.payments.StripeGateway"
+# Seconds a customer's default card stays cached on their profile before the
+# payment page asks the gateway for it again; saving a card refreshes it
+PAYMENT_CARD_CACHE_TIMEOUT = 3600
+# Seconds a payment submission may take to charge before a resubmission takes
+# it over; the gateway dedups the charge, so this only bounds how long a
+# submission whose request died blocks retries
+PAYMENT_CLAIM_TIMEOUT = 120
@@ -42,6 +42,9 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": os.environ.get("DB_PATH", os.path.join(BASE_DIR, "db.sqlite3")),
+        # A file rather than the in-memory default, so tests can write to it
+        # from several threads at once
+        "TEST": {"NAME": os.path.join(BASE_DIR, "test_db.sqlite3")},
     }
 }
 